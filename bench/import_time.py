@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+"""
+Import time benchmark.
+
+Imports hana in fresh interpreters and checks the median time against a
+budget. Also checks that dependencies only needed by some builds aren't
+imported up front. Exits with status 1 if either check fails.
+
+    python bench/import_time.py --budget 0.05
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MODULES = ('hana', 'hana.plugins.file_loader', 'hana.plugins.file_writer')
+
+# Loaded lazily, when a build needs them
+LAZY_MODULES = ('yaml', 'pathspec', 'pkg_resources', 'hashlib', 'numpy')
+
+SCRIPT = '''
+import sys, time
+start = time.perf_counter()
+{imports}
+elapsed = time.perf_counter() - start
+print(elapsed)
+print(' '.join(module for module in {lazy!r} if module in sys.modules))
+'''
+
+def measure(modules=MODULES):
+    """Return import time in seconds and lazy modules that were imported
+    """
+    script = SCRIPT.format(imports='\n'.join('import {}'.format(module) for module in modules),
+                           lazy=LAZY_MODULES)
+
+    output = subprocess.check_output([sys.executable, '-c', script], cwd=ROOT_DIR,
+                                     universal_newlines=True)
+    lines = output.splitlines() + ['']
+
+    return float(lines[0]), lines[1].split()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Measure hana import time')
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--budget', type=float, default=0.1, help='budget for median import time, in seconds')
+    args = parser.parse_args(argv)
+
+    # The first run may compile bytecode
+    measure()
+
+    times = []
+    imported = set([])
+
+    for _ in range(args.runs):
+        elapsed, lazy = measure()
+        times.append(elapsed)
+        imported.update(lazy)
+
+    median = statistics.median(times)
+    print('import {}: median {:.1f}ms, min {:.1f}ms, budget {:.1f}ms'.format(
+        ', '.join(MODULES), median * 1000, min(times) * 1000, args.budget * 1000))
+
+    failed = False
+
+    if median > args.budget:
+        print('OVER BUDGET by {:.1f}ms'.format((median - args.budget) * 1000))
+        failed = True
+
+    if imported:
+        print('Imported eagerly: {}'.format(', '.join(sorted(imported))))
+        failed = True
+
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+"""
+Hana benchmark suite.
+
+Generates a synthetic site (see sitegen.py) and times the main parts of a
+build: scanning and loading sources, pattern, metadata and ordered queries,
+loading and hashing contents, and writing output.
+
+    python bench/run.py --files 10k
+    python bench/run.py --files 10k --save
+
+Results are compared with the baseline stored for the same number of files,
+and benchmarks slower than the baseline by more than the threshold are
+flagged; the exit status is then 1. --save stores the results as the new
+baseline. Baselines depend on the machine, so they aren't kept in the
+repository.
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+import hana
+from hana.metadata import MD
+from hana.plugins.file_loader import FileLoader
+from hana.plugins.file_writer import FileWriter
+
+from sitegen import generate_site, site_metadata
+
+DEFAULT_BASELINE = os.path.join(BENCH_DIR, 'baseline.json')
+DEFAULT_SITES = os.path.join(BENCH_DIR, 'sites')
+
+def parse_count(value):
+    """Parse number of files, with optional k or m suffix
+    """
+    multiplier = {'k': 1000, 'm': 1000 * 1000}.get(value[-1:].lower(), 1)
+
+    return int(value[:-1] if multiplier > 1 else value) * multiplier
+
+def load_site(source, seed):
+    """Return Hana with the site loaded and metadata set
+    """
+    b = hana.Hana()
+    b.plugin(FileLoader(source_path=source))
+    b.build()
+
+    for filename, f in b.files:
+        f.update(site_metadata(filename, seed))
+
+    return b
+
+def upper_contents(files, hana):
+    for filename, f in files:
+        if not f.is_binary:
+            f['contents'] = f['contents'].upper()
+
+def benchmarks(source, output, seed):
+    """Return list of (name, setup, run) benchmarks.
+
+    setup() returns the state passed to run(), only run() is timed.
+    """
+    loaded = lambda: load_site(source, seed)
+
+    def indexed():
+        b = loaded()
+        b.files.add_index('category')
+        b.files.add_index('weight', kind='sorted')
+        return b
+
+    def write(b):
+        if os.path.isdir(output):
+            shutil.rmtree(output)
+        FileWriter(deploy_path=output)(b.files.filter(), b)
+
+    def modified():
+        b = loaded()
+        upper_contents(b.files.filter().patterns('*.md'), b)
+        return b
+
+    return [
+        ('scan', lambda: FileLoader(source_path=source), lambda loader: loader.scan()),
+        ('load', lambda: None, lambda _: loaded()),
+        ('filter_patterns', loaded, lambda b: list(b.files.filter().patterns('*.md', 'd1/**'))),
+        ('filter_metadata', loaded,
+         lambda b: list(b.files.filter().metadata(MD('category') == 'blog', MD('weight') > 50))),
+        ('filter_metadata_indexed', indexed,
+         lambda b: list(b.files.filter().metadata(MD('category') == 'blog', MD('weight') > 50))),
+        ('filter_order_limit', loaded,
+         lambda b: list(b.files.filter().patterns('*.md').order(MD('date').desc()).limit(10))),
+        ('contents', loaded, lambda b: [f['contents'] for _, f in b.files]),
+        ('hash', loaded, lambda b: [f.sha1sum() for _, f in b.files]),
+        ('write_passthrough', loaded, write),
+        ('write_modified', modified, write),
+    ]
+
+def run(source, output, seed, repeat, only=None):
+    """Run benchmarks, return best time of each in seconds
+    """
+    results = {}
+
+    for name, setup, func in benchmarks(source, output, seed):
+        if only and name not in only:
+            continue
+
+        times = []
+
+        for _ in range(repeat):
+            state = setup()
+            start = time.perf_counter()
+            func(state)
+            times.append(time.perf_counter() - start)
+
+        results[name] = min(times)
+
+    return results
+
+def compare(results, baseline, threshold):
+    """Return list of (name, time, baseline time) of regressed benchmarks
+    """
+    regressions = []
+
+    for name, seconds in sorted(results.items()):
+        previous = baseline.get(name)
+
+        if previous and seconds > previous * (1 + threshold):
+            regressions.append((name, seconds, previous))
+
+    return regressions
+
+def load_baselines(path):
+    if not os.path.isfile(path):
+        return {}
+
+    with open(path) as fin:
+        return json.load(fin)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run Hana benchmarks')
+    parser.add_argument('--files', default='1k', help='number of files, e.g. 1000, 10k, 1m')
+    parser.add_argument('--binary-ratio', type=float, default=0.1, help='fraction of binary files')
+    parser.add_argument('--depth', type=int, default=4, help='maximum directory depth')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3, help='runs of each benchmark, the best is kept')
+    parser.add_argument('--only', nargs='*', help='benchmarks to run')
+    parser.add_argument('--sites', default=DEFAULT_SITES, help='directory to generate sites in')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help='baseline results file')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='flag benchmarks slower than baseline by this fraction')
+    parser.add_argument('--save', action='store_true', help='save results as baseline')
+    args = parser.parse_args(argv)
+
+    files = parse_count(args.files)
+    key = '{}-{}-{}-{}'.format(files, args.binary_ratio, args.depth, args.seed)
+
+    source = os.path.join(args.sites, key)
+    print('Generating {} files in {}'.format(files, source))
+    generate_site(source, files, args.binary_ratio, args.depth, args.seed)
+
+    output = tempfile.mkdtemp(prefix='hana-bench-')
+
+    try:
+        results = run(source, os.path.join(output, 'out'), args.seed, args.repeat, args.only)
+    finally:
+        shutil.rmtree(output, ignore_errors=True)
+
+    baselines = load_baselines(args.baseline)
+    baseline = baselines.get(key, {})
+
+    for name, seconds in sorted(results.items()):
+        previous = baseline.get(name)
+        change = ' ({:+.1%})'.format(seconds / previous - 1) if previous else ''
+        print('{:<26} {:10.4f}s{}'.format(name, seconds, change))
+
+    regressions = compare(results, baseline, args.threshold)
+
+    for name, seconds, previous in regressions:
+        print('REGRESSION {}: {:.4f}s, baseline {:.4f}s'.format(name, seconds, previous))
+
+    if args.save:
+        baselines[key] = results
+
+        with open(args.baseline, 'w') as fout:
+            json.dump(baselines, fout, indent=2, sort_keys=True)
+
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,102 @@
+"""
+Synthetic site generator for benchmarks.
+
+Generates a reproducible tree of text and binary files in nested directories.
+The same parameters always produce the same site. Metadata isn't stored in
+the files, site_metadata() returns it for a file so benchmarks can set it
+after loading.
+"""
+import datetime
+import os
+import random
+
+WORDS = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor '
+         'incididunt ut labore et dolore magna aliqua enim ad minim veniam quis nostrud').split()
+
+TEXT_EXTENSIONS = ('.md', '.md', '.md', '.html', '.css', '.txt')
+BINARY_EXTENSIONS = ('.jpg', '.png', '.woff2')
+
+TAGS = ('python', 'travel', 'food', 'music', 'photos', 'code', 'notes', 'books')
+CATEGORIES = ('blog', 'pages', 'projects', 'gallery')
+
+# Average number of files per directory
+FILES_PER_DIRECTORY = 50
+
+COMPLETE_MARKER = '.hana-bench-complete'
+
+def generate_site(path, files=1000, binary_ratio=0.1, max_depth=4, seed=0):
+    """Generate site in path, return sorted list of relative paths.
+
+    If path already holds a complete site generated with the same
+    parameters, it is reused.
+    """
+    parameters = '{} {} {} {}'.format(files, binary_ratio, max_depth, seed)
+    marker = os.path.join(path, COMPLETE_MARKER)
+
+    rng = random.Random(seed)
+    directories = _directories(rng, max(1, files // FILES_PER_DIRECTORY), max_depth)
+    relpaths = []
+
+    for idx in range(files):
+        binary = rng.random() < binary_ratio
+        extension = rng.choice(BINARY_EXTENSIONS if binary else TEXT_EXTENSIONS)
+        relpaths.append(os.path.join(rng.choice(directories), 'file{}{}'.format(idx, extension)))
+
+    if os.path.isfile(marker):
+        with open(marker) as fin:
+            if fin.read() == parameters:
+                return sorted(relpaths)
+
+    for relpath in relpaths:
+        full_path = os.path.join(path, relpath)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+
+        file_rng = random.Random('{}:{}'.format(seed, relpath))
+
+        with open(full_path, 'wb') as fout:
+            if relpath.endswith(BINARY_EXTENSIONS):
+                fout.write(_binary_contents(file_rng))
+            else:
+                fout.write(_text_contents(file_rng, relpath).encode('utf-8'))
+
+    with open(marker, 'w') as fout:
+        fout.write(parameters)
+
+    return sorted(relpaths)
+
+def site_metadata(relpath, seed=0):
+    """Return metadata of generated file
+    """
+    rng = random.Random('{}:{}:metadata'.format(seed, relpath))
+
+    return {
+        'title': ' '.join(rng.choice(WORDS) for _ in range(rng.randint(2, 6))).title(),
+        'date': datetime.datetime(2010, 1, 1) + datetime.timedelta(minutes=rng.randrange(10 * 365 * 24 * 60)),
+        'tags': rng.sample(TAGS, rng.randint(0, 3)),
+        'category': rng.choice(CATEGORIES),
+        'draft': rng.random() < 0.1,
+        'weight': rng.randrange(100),
+    }
+
+def _directories(rng, count, max_depth):
+    directories = set([''])
+
+    # Ten directories per level
+    count = min(count, sum(10 ** depth for depth in range(1, max_depth + 1)))
+
+    while len(directories) < count + 1:
+        depth = rng.randint(1, max_depth)
+        directories.add(os.path.join(*('d{}'.format(rng.randrange(10)) for _ in range(depth))))
+
+    return sorted(directories)
+
+def _text_contents(rng, relpath):
+    words = [rng.choice(WORDS) for _ in range(rng.randint(20, 600))]
+
+    return '---\ntitle: {}\n---\n\n{}\n'.format(relpath, ' '.join(words))
+
+def _binary_contents(rng):
+    size = rng.randint(512, 16 * 1024)
+
+    # NUL bytes early on, so the file is detected as binary
+    return b'\0\x01\x02\x03' + rng.getrandbits(size * 8).to_bytes(size, 'little')
@@ -0,0 +1,62 @@
+import asyncio
+import logging
+
+from hana.parallel import _merge_file
+
+def is_async_plugin(plugin):
+    """Return True if plugin is a coroutine function, or has a coroutine __call__
+    """
+    return (asyncio.iscoroutinefunction(plugin)
+            or asyncio.iscoroutinefunction(getattr(plugin, '__call__', None)))
+
+class AsyncPerFilePlugin(object):
+    """
+    Plugin processing each file with a coroutine function, concurrently.
+
+    func is awaited with (filename, file) for every file and should modify the
+    file in place or return a new File, whose values are merged into the
+    original file. Errors are raised once all files were processed, the one
+    of the earliest failing file first.
+
+    concurrency: maximum number of files processed at once
+    load_contents: load contents in the executor before func is called, so
+                   reading them doesn't block the event loop
+
+    Under Hana.build() the files are processed in an event loop of their own.
+    """
+    def __init__(self, func, concurrency=16, load_contents=True):
+        self.func = func
+        self.concurrency = concurrency
+        self.load_contents = load_contents
+        self.logger = logging.getLogger(self.__module__)
+
+    def __call__(self, files, hana):
+        asyncio.run(self.run_async(files, hana))
+
+    async def run_async(self, files, hana):
+        errors = {}
+        pending = enumerate(list(files))
+
+        async def worker():
+            for idx, (filename, hfile) in pending:
+                try:
+                    await self._process(filename, hfile)
+                except Exception as err:
+                    errors[idx] = err
+
+        await asyncio.gather(*[worker() for _ in range(self.concurrency)])
+
+        if errors:
+            raise errors[min(errors)]
+
+    async def _process(self, filename, hfile):
+        if self.load_contents:
+            try:
+                await hfile.contents_async()
+            except KeyError:
+                pass
+
+        result = await self.func(filename, hfile)
+
+        if result is not None and result is not hfile:
+            _merge_file(hfile, dict(result))
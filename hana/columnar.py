@@ -0,0 +1,447 @@
+import datetime
+from functools import reduce
+import operator
+import threading
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from hana.metadata import MD, MDAnd, MDNot, MDOr
+
+_MISSING = object()
+
+DTYPES = {
+    'int': 'int64',
+    'float': 'float64',
+    'bool': 'bool',
+    'datetime': 'datetime64[us]',
+    'date': 'datetime64[D]',
+    'str': 'int32',
+    'object': 'object',
+}
+
+# Kinds stored as native NumPy values, compared directly
+NATIVE_KINDS = ('int', 'float', 'bool', 'datetime', 'date')
+
+COMPARISONS = {
+    'eq': operator.eq,
+    'ne': operator.ne,
+    'lt': operator.lt,
+    'le': operator.le,
+    'gt': operator.gt,
+    'ge': operator.ge,
+}
+
+class ColumnarView(object):
+    """
+    Columnar copy of FileSet metadata, for vectorized filtering with NumPy.
+
+    Every metadata key is kept in a NumPy array with a row per file: numbers,
+    booleans and dates natively, strings as codes into a list of distinct
+    values, anything else as Python objects. MD predicates are evaluated as
+    masks over the whole set at once; string predicates only need to be
+    evaluated once per distinct value.
+
+    The view is brought up to date with the FileSet journal before every
+    query, so only files added, removed, renamed or changed since are read
+    again. As with indexes, changes to nested values can't be detected; use
+    rebuild() after making them.
+
+    keys: metadata keys (names, tuples of nested names or MD keys) to keep.
+          By default, all top level keys except contents are kept, and other
+          keys get a column when a query first uses them.
+    """
+
+    def __init__(self, file_set, keys=None):
+        if numpy is None:
+            raise ImportError('ColumnarView requires numpy')
+
+        self.file_set = file_set
+        self._lock = threading.RLock()
+
+        self._all_keys = not keys
+        self._names = []
+
+        for key in keys or ():
+            name = getattr(key, 'name', key)
+            self._names.append((name,) if isinstance(name, str) else tuple(name))
+
+        self.rebuild()
+
+    def __len__(self):
+        return self._size - self._dead
+
+    def rebuild(self):
+        """Read metadata of all files again
+        """
+        # The FileSet is locked after the view, so the snapshot matches the version
+        with self._lock, self.file_set._lock:
+            files = self.file_set.snapshot()
+
+            self.version = self.file_set.version
+            self._size = len(files)
+            self._dead = 0
+            self._capacity = max(16, self._size)
+
+            self._filenames = [filename for filename, _ in files]
+            self._rows = dict((filename, row) for row, filename in enumerate(self._filenames))
+            self._alive = numpy.zeros(self._capacity, bool)
+            self._alive[:self._size] = True
+
+            names = list(self._names)
+
+            if self._all_keys:
+                found = {}
+                for _, hfile in files:
+                    found.update(dict.fromkeys(key for key in dict.keys(hfile) if key != 'contents'))
+                names.extend((key,) for key in found)
+
+            self._columns = {}
+
+            for name in names:
+                column = _Column(self._capacity)
+                column.load([_lookup(hfile, name) for _, hfile in files])
+                self._columns[name] = column
+
+    def refresh(self):
+        """Apply changes made to the FileSet since the view was last updated
+        """
+        # Files can't change between reading the journal and reading them
+        with self._lock, self.file_set._lock:
+            if self.version == self.file_set.version:
+                return
+
+            changes = self.file_set.changes_since(self.version)
+
+            if changes is None or len(changes.changed()) + len(changes.removed) > len(self) // 2:
+                self.rebuild()
+                return
+
+            for filename in changes.removed:
+                self._remove_row(filename)
+
+            rows = [(new_name, self._rows.pop(filename)) for filename, new_name in changes.renamed.items()]
+            for new_name, row in rows:
+                self._rows[new_name] = row
+                self._filenames[row] = new_name
+
+            for filename in changes.added:
+                self._add_row(filename)
+
+            for filename in changes.modified | set(changes.renamed.values()):
+                self._update_row(self._rows[filename], self.file_set[filename])
+
+            self.version = changes.version
+
+            # Removed rows are only dropped when rebuilding
+            if self._dead > self._size // 2:
+                self.rebuild()
+
+    def _remove_row(self, filename):
+        row = self._rows.pop(filename)
+        self._filenames[row] = None
+        self._alive[row] = False
+        self._dead += 1
+
+    def _add_row(self, filename):
+        if self._size == self._capacity:
+            self._capacity *= 2
+            self._alive = _resize(self._alive, self._capacity)
+
+            for column in self._columns.values():
+                column.resize(self._capacity)
+
+        row = self._size
+        self._size += 1
+
+        self._rows[filename] = row
+        self._filenames.append(filename)
+        self._alive[row] = True
+
+        self._update_row(row, self.file_set[filename])
+
+    def _update_row(self, row, hfile):
+        if self._all_keys:
+            for key in dict.keys(hfile):
+                if key != 'contents' and (key,) not in self._columns:
+                    self._columns[(key,)] = _Column(self._capacity)
+
+        for name, column in self._columns.items():
+            column.set(row, _lookup(hfile, name))
+
+    def supports(self, expression):
+        """Return True if all keys used by the expression are in the view
+        """
+        if isinstance(expression, (MDAnd, MDOr)):
+            return all(self.supports(child) for child in expression.children)
+
+        if isinstance(expression, MDNot):
+            return self.supports(expression.child)
+
+        if isinstance(expression, MD):
+            name = expression.name
+            # Other keys get a column when first used
+            return name in self._columns or (self._all_keys and name[0] != 'contents')
+
+        return False
+
+    def mask(self, expression):
+        """Return boolean array of files matching expression, by row
+        """
+        with self._lock:
+            self.refresh()
+            return self._mask(expression) & self._alive[:self._size]
+
+    def lookup(self, expression):
+        """Return filenames of files matching expression, in FileSet order
+        """
+        with self._lock:
+            mask = self.mask(expression)
+            filenames = [self._filenames[row] for row in numpy.flatnonzero(mask)]
+
+        # Rows of renamed files stay in place, while the set moves them to the end
+        return self.file_set.in_order(filenames)
+
+    def filter(self, *predicates):
+        """Return FileSetFilter of files matching predicates, evaluated by the view
+        """
+        return self.file_set.filter().metadata(*predicates)
+
+    def _mask(self, expression):
+        if isinstance(expression, MDAnd):
+            return reduce(operator.and_, (self._mask(child) for child in expression.children),
+                          numpy.ones(self._size, bool))
+
+        if isinstance(expression, MDOr):
+            return reduce(operator.or_, (self._mask(child) for child in expression.children),
+                          numpy.zeros(self._size, bool))
+
+        if isinstance(expression, MDNot):
+            return ~self._mask(expression.child)
+
+        column = self._columns.get(expression.name)
+
+        if column is None:
+            column = self._columns[expression.name] = _Column(self._capacity)
+            files = self.file_set
+            column.load([_lookup(files[filename], expression.name) if filename is not None else _MISSING
+                         for filename in self._filenames])
+
+        return column.mask(expression, self._size)
+
+
+class _Column(object):
+    """Values of a single key, with a mask of files that have it
+    """
+
+    def __init__(self, capacity):
+        self.kind = None
+        self.data = None
+        self.present = numpy.zeros(capacity, bool)
+
+        # Distinct values of strings, and their codes
+        self.categories = []
+        self.codes = {}
+
+    def resize(self, capacity):
+        self.present = _resize(self.present, capacity)
+
+        if self.data is not None:
+            self.data = _resize(self.data, capacity)
+
+    def load(self, values):
+        """Set values of all rows at once
+        """
+        kind = None
+
+        for value in values:
+            if value is not _MISSING:
+                kind = _merge(kind, _kind(value))
+
+        if kind is None:
+            return
+
+        self.kind = kind
+        self.data = numpy.zeros(len(self.present), DTYPES[kind])
+
+        present = [value is not _MISSING for value in values]
+        self.present[:len(values)] = present
+
+        encoded = [self._encode(value) if value is not _MISSING else None for value in values]
+
+        if kind == 'object':
+            for row, value in enumerate(encoded):
+                self.data[row] = value
+        else:
+            rows = numpy.flatnonzero(self.present[:len(values)])
+            self.data[rows] = numpy.array([encoded[row] for row in rows], DTYPES[kind])
+
+    def set(self, row, value):
+        if value is _MISSING:
+            self.present[row] = False
+            return
+
+        kind = _merge(self.kind, _kind(value))
+
+        if kind != self.kind:
+            self._convert(kind)
+
+        self.data[row] = self._encode(value)
+        self.present[row] = True
+
+    def get(self, row):
+        """Return Python value of row
+        """
+        if not self.present[row]:
+            return _MISSING
+
+        if self.kind == 'str':
+            return self.categories[self.data[row]]
+
+        if self.kind == 'object':
+            return self.data[row]
+
+        return self.data[row].item()
+
+    def _convert(self, kind):
+        values = [self.get(row) for row in range(len(self.present))]
+
+        self.kind = kind
+        self.data = numpy.zeros(len(self.present), DTYPES[kind])
+        self.categories = []
+        self.codes = {}
+
+        for row, value in enumerate(values):
+            if value is not _MISSING:
+                self.data[row] = self._encode(value)
+
+    def _encode(self, value):
+        if self.kind == 'str':
+            code = self.codes.get(value)
+
+            if code is None:
+                code = self.codes[value] = len(self.categories)
+                self.categories.append(value)
+
+            return code
+
+        if self.kind == 'datetime':
+            return numpy.datetime64(value, 'us')
+
+        if self.kind == 'date':
+            return numpy.datetime64(value, 'D')
+
+        return value
+
+    def mask(self, predicate, size):
+        present = self.present[:size]
+
+        if predicate.op is None or self.kind is None:
+            # No file has the key when there is no kind
+            return present.copy()
+
+        data = self.data[:size]
+        opname = predicate.opname
+        value = predicate.value
+
+        if self.kind in NATIVE_KINDS and _compatible(self.kind, value):
+            if opname in COMPARISONS:
+                return COMPARISONS[opname](data, self._native(value)) & present
+
+        if self.kind in NATIVE_KINDS and opname in ('in', 'nin') and isinstance(value, (list, tuple, set, frozenset)):
+            values = [self._native(item) for item in value if _compatible(self.kind, item)]
+            found = numpy.isin(data, numpy.array(values, DTYPES[self.kind])) if values else numpy.zeros(size, bool)
+            return (found if opname == 'in' else ~found) & present
+
+        if self.kind == 'str':
+            # Evaluate once for every distinct value
+            if not self.categories:
+                return numpy.zeros(size, bool)
+
+            matches = numpy.array([_evaluate(predicate, category) for category in self.categories], bool)
+            return matches[data] & present
+
+        result = numpy.zeros(size, bool)
+
+        for row in numpy.flatnonzero(present):
+            result[row] = _evaluate(predicate, self.get(row))
+
+        return result
+
+    def _native(self, value):
+        if self.kind == 'datetime':
+            return numpy.datetime64(value, 'us')
+
+        if self.kind == 'date':
+            return numpy.datetime64(value, 'D')
+
+        return value
+
+def _kind(value):
+    if isinstance(value, bool):
+        return 'bool'
+
+    if isinstance(value, int):
+        return 'int' if -2 ** 63 <= value < 2 ** 63 else 'object'
+
+    if isinstance(value, float):
+        return 'float'
+
+    if isinstance(value, datetime.datetime):
+        return 'datetime' if value.tzinfo is None else 'object'
+
+    if isinstance(value, datetime.date):
+        return 'date'
+
+    if isinstance(value, str):
+        return 'str'
+
+    return 'object'
+
+def _merge(kind, other):
+    if kind is None or kind == other:
+        return other
+
+    if set([kind, other]) == set(['int', 'float']):
+        return 'float'
+
+    return 'object'
+
+def _compatible(kind, value):
+    """Return True if value can be compared with a column of kind natively
+    """
+    if kind in ('int', 'float', 'bool'):
+        return isinstance(value, (int, float))
+
+    if kind == 'datetime':
+        return isinstance(value, datetime.datetime) and value.tzinfo is None
+
+    if kind == 'date':
+        return isinstance(value, datetime.date) and not isinstance(value, datetime.datetime)
+
+    return False
+
+def _evaluate(predicate, value):
+    # Values that can't be compared don't match, as in compiled predicates
+    try:
+        return bool(predicate.op(predicate.value, value))
+    except TypeError:
+        return False
+
+def _lookup(hfile, name):
+    value = hfile
+
+    try:
+        for key in name:
+            value = dict.__getitem__(value, key) if isinstance(value, dict) else value[key]
+    except (KeyError, IndexError, TypeError):
+        return _MISSING
+
+    return value
+
+def _resize(array, capacity):
+    resized = numpy.zeros(capacity, array.dtype)
+    resized[:len(array)] = array
+    return resized
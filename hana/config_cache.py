@@ -0,0 +1,131 @@
+import logging
+import os
+import pickle
+import time
+
+# Entries are only trusted by mtime if they were recorded this long after the
+# file was last modified, so changes within the mtime resolution are noticed
+RACY_INTERVAL = 2 * 1000 * 1000 * 1000
+
+class ConfigCache(object):
+    """
+    Cache of compiled configuration files.
+
+    Entries are keyed by absolute path and validated by mtime, size and
+    content hash: if mtime and size didn't change, the cached entry is used
+    without reading the file; otherwise the file is hashed and only compiled
+    again if its contents changed.
+
+    Entries are kept in memory, and pickled in directory if given, so they are
+    shared between processes. Only use directories nobody else can write to.
+    """
+
+    VERSION = 2
+
+    def __init__(self, directory=None):
+        self.directory = directory
+        self.logger = logging.getLogger(self.__module__)
+
+        self._entries = {}
+
+        self.hits = 0
+        self.misses = 0
+
+    def load(self, path, compile):
+        """Return compiled configuration for path.
+
+        compile is called with the contents of the file (bytes) when there is
+        no valid entry, and should return a picklable object.
+        """
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+
+        entry = self._entries.get(path) or self._read(path)
+
+        if (entry and entry['mtime'] == stat.st_mtime_ns and entry['size'] == stat.st_size
+                and entry['checked'] - stat.st_mtime_ns > RACY_INTERVAL):
+            self.hits += 1
+            self._entries[path] = entry
+            return pickle.loads(entry['compiled'])
+
+        import hashlib
+
+        with open(path, 'rb') as fin:
+            data = fin.read()
+
+        digest = hashlib.sha1(data).hexdigest()
+
+        if entry and entry['hash'] == digest:
+            # Touched, but the same
+            self.hits += 1
+            compiled = entry['compiled']
+
+        else:
+            self.logger.debug('Compiling configuration %s', path)
+            self.misses += 1
+            compiled = pickle.dumps(compile(data), pickle.HIGHEST_PROTOCOL)
+
+        entry = {
+            'version': self.VERSION,
+            'path': path,
+            'mtime': stat.st_mtime_ns,
+            'size': stat.st_size,
+            'hash': digest,
+            'checked': time.time_ns(),
+            'compiled': compiled,
+        }
+
+        self._entries[path] = entry
+        self._write(path, entry)
+
+        return pickle.loads(compiled)
+
+    def _cache_path(self, path):
+        import hashlib
+
+        name = hashlib.sha1(path.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, '{}.pickle'.format(name))
+
+    def _read(self, path):
+        if not self.directory:
+            return None
+
+        try:
+            with open(self._cache_path(path), 'rb') as fin:
+                entry = pickle.load(fin)
+        except FileNotFoundError:
+            return None
+        except Exception:
+            self.logger.warning('Ignoring unreadable configuration cache for %s', path)
+            return None
+
+        if not isinstance(entry, dict) or entry.get('version') != self.VERSION or entry.get('path') != path:
+            return None
+
+        return entry
+
+    def _write(self, path, entry):
+        if not self.directory:
+            return
+
+        os.makedirs(self.directory, exist_ok=True)
+
+        cache_path = self._cache_path(path)
+        tmp_path = '{}.{}.tmp'.format(cache_path, os.getpid())
+
+        with open(tmp_path, 'wb') as fout:
+            pickle.dump(entry, fout, pickle.HIGHEST_PROTOCOL)
+
+        os.replace(tmp_path, cache_path)
+
+_caches = {}
+
+def get_cache(directory=None):
+    """Return shared ConfigCache for directory, or the in-memory only cache
+    """
+    cache = _caches.get(directory)
+
+    if cache is None:
+        cache = _caches[directory] = ConfigCache(directory)
+
+    return cache
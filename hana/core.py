@@ -1,22 +1,127 @@
 import codecs
+import collections
 import datetime
 from functools import reduce
-import hashlib
+import heapq
+import io
 import itertools
 import logging
 import operator
 import os.path
 import sys
-import yaml
-
-import pathspec
-import pkg_resources
+import threading
 
 from hana import errors
+from hana.index import HashIndex, SortedIndex
+from hana.manifest import BuildManifest
+from hana.metadata import MD, MDAnd, MDOr, compile_predicates
+from hana.patterns import compile_patterns
+from hana.store import ContentStore
+
+# Size of chunks when streaming file contents
+CHUNK_SIZE = 1024 * 1024
+
+BuildStep = collections.namedtuple('BuildStep', ['plugin', 'patterns', 'reads', 'writes'])
+
+class IOCounters(object):
+    """Totals of file contents loaded, read and written, used for profiling
+    """
+
+    def __init__(self):
+        self.loads = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self._lock = threading.Lock()
+
+    def snapshot(self):
+        return (self.loads, self.bytes_read, self.bytes_written)
+
+    def read(self, size, load=False):
+        with self._lock:
+            self.bytes_read += size
+            if load:
+                self.loads += 1
+
+    def wrote(self, size):
+        with self._lock:
+            self.bytes_written += size
+
+io_counters = IOCounters()
+
+def plugin_target(plugin):
+    """Return (module path, name) to import for "module.path:name" or "module.path.name"
+    """
+    parts = plugin.split(':', 1)
+
+    if len(parts) < 2:
+        return parts[0], parts[0].split('.')[-1]
+
+    return parts[0], parts[1]
+
+def plugin_name(plugin):
+    """Return qualified name of plugin function or class
+    """
+    name = getattr(plugin, '__qualname__', None) or plugin.__class__.__qualname__
+    module = getattr(plugin, '__module__', None)
+
+    return '{}.{}'.format(module, name)
+
+def plugin_options(plugin):
+    """Return stable representation of the options a plugin instance was created with.
+
+    Options are the arguments of the plugin class constructor, as stored on
+    the instance under the same name or with a leading underscore. Functions
+    have no options.
+    """
+    import inspect
+
+    if inspect.isroutine(plugin) or isinstance(plugin, type) or not hasattr(plugin, '__dict__'):
+        return None
+
+    try:
+        parameters = inspect.signature(type(plugin).__init__).parameters
+    except (TypeError, ValueError):
+        return None
+
+    options = []
+
+    for name, parameter in parameters.items():
+        if name == 'self' or parameter.kind in (parameter.VAR_POSITIONAL, parameter.VAR_KEYWORD):
+            continue
+
+        value = getattr(plugin, name, getattr(plugin, '_' + name, _MISSING))
+
+        if value is not _MISSING:
+            options.append((name, _stable_repr(value)))
+
+    return repr(options)
+
+def _stable_repr(value):
+    """Return repr of value that doesn't change between processes
+    """
+    if isinstance(value, dict):
+        items = sorted((_stable_repr(key), _stable_repr(item)) for key, item in value.items())
+        return '{' + ', '.join('{}: {}'.format(key, item) for key, item in items) + '}'
+
+    if isinstance(value, (set, frozenset)):
+        return '{' + ', '.join(sorted(_stable_repr(item) for item in value)) + '}'
+
+    if isinstance(value, (list, tuple)):
+        return '[' + ', '.join(_stable_repr(item) for item in value) + ']'
+
+    if isinstance(value, type) or hasattr(value, '__code__'):
+        return plugin_name(value)
+
+    if type(value).__repr__ is object.__repr__:
+        # Default repr includes the address, use the type and options instead
+        return '{}({})'.format(plugin_name(type(value)), plugin_options(value) or '')
+
+    return repr(value)
 
 class Hana(object):
 
-    def __init__(self, configuration=None, metadata=dict()):
+    def __init__(self, configuration=None, metadata=dict(), manifest=None, memory_budget=None,
+                 profile=None, config_cache=None):
         self._setup_logging()
 
         self.logger = logging.getLogger(self.__module__)
@@ -24,12 +129,39 @@ class Hana(object):
         self.config = {}
         self.metadata = metadata
 
-        # Load configuration first, any parameters override config
+        # Resolved plugins, by name
+        self._plugin_cache = {}
+
+        # Load configuration first, any parameters override config. Compiled
+        # configurations are cached in memory, and in config_cache directory.
         if configuration:
-            self.config = self._load_configuration(configuration)
+            self.config = self._load_configuration(configuration, config_cache)
 
         self._process_config()
 
+        # Incremental builds
+        self.manifest = None
+
+        manifest = manifest or self.config.get('manifest')
+        if manifest:
+            self.manifest = BuildManifest(manifest)
+
+        # Memory budget for file contents
+        self.content_store = None
+
+        memory_budget = memory_budget or self.config.get('memory_budget')
+        if memory_budget:
+            self.content_store = ContentStore(memory_budget, self.config.get('spill_directory'))
+
+        # Build profiling, True or hana.profiling.BuildProfiler options
+        self.profiler = None
+
+        profile = profile or self.config.get('profile')
+        if profile:
+            from hana.profiling import BuildProfiler
+
+            self.profiler = BuildProfiler(**(profile if isinstance(profile, dict) else {}))
+
         self.plugins = []
 
         self.files = FileSet()
@@ -43,9 +175,17 @@ class Hana(object):
             ch.setFormatter(formatter)
             logger.addHandler(ch)
 
-    def _load_configuration(self, config_file):
+    def _load_configuration(self, config_file, cache_directory=None):
+        from hana.config_cache import get_cache
+
         self.logger.info('Loading configuration from "%s"', config_file)
-        return yaml.safe_load(open(config_file))
+
+        return get_cache(cache_directory).load(config_file, self._parse_configuration)
+
+    def _parse_configuration(self, data):
+        import yaml
+
+        return yaml.safe_load(data) or {}
 
     def _process_config(self):
         # Logging
@@ -100,50 +240,409 @@ class Hana(object):
 
 
     def load_plugin(self, plugin):
-        parts = plugin.split(':', 1)
-        module_path = None
-        import_name = None
+        """Return plugin named "module.path:name" or "module.path.name".
 
-        if len(parts) < 2:
-            module_path = parts[0]
-            import_name = parts[0].split('.')[-1]
-        else:
-            module_path, import_name = parts
+        Plugins are resolved once, and cached for the configuration.
+        """
+        cached = self._plugin_cache.get(plugin)
+
+        if cached is not None:
+            return cached
+
+        module_path, import_name = plugin_target(plugin)
 
         try:
             self.logger.info('Loading plugin %s from %s', import_name, module_path)
             mod = __import__(module_path, None, None, [import_name])
-            return getattr(mod, import_name)
+            resolved = self._plugin_cache[plugin] = getattr(mod, import_name)
+            return resolved
         except ImportError as err:
             self.logger.exception('Error loading plugin %s', plugin)
             raise RuntimeError("Couldn't load plugin {}".format(plugin))
 
 
-    def plugin(self, plugin, pattern=None):
+    def plugin(self, plugin, pattern=None, reads=None, writes=None):
+        """Register build step.
+
+        reads and writes are optional lists of patterns of files the step reads
+        and adds, modifies or removes. They are only used to run independent
+        steps concurrently (see build()); undeclared steps are assumed to read
+        and write all files. Plugins can also declare them as attributes.
+
+        Patterns by extension, like "*.md" and "*.html", are taken to be
+        disjoint, although both match files in a directory named "notes.md".
+        Don't run such steps concurrently on trees with directories named
+        like files (see hana.scheduler.patterns_overlap()).
+        """
         if isinstance(pattern, str):
             pattern = [pattern]
 
-        self.plugins.append((plugin, pattern))
+        if reads is None:
+            reads = getattr(plugin, 'reads', None)
+
+        if writes is None:
+            writes = getattr(plugin, 'writes', None)
 
-    def build(self):
+        if isinstance(reads, str):
+            reads = [reads]
+
+        if isinstance(writes, str):
+            writes = [writes]
+
+        # A step that only declares writes reads its own patterns
+        if writes is not None and reads is None:
+            reads = pattern
+
+        self.plugins.append(BuildStep(plugin, pattern, reads, writes))
+
+    def file_plugin(self, func, pattern=None, **options):
+        """Register per-file plugin, run over a process pool.
+
+        See hana.parallel.PerFilePlugin for options.
+        """
+        from hana.parallel import PerFilePlugin
+
+        # Per-file plugins only ever touch the files they are given
+        self.plugin(PerFilePlugin(func, **options), pattern, reads=pattern, writes=pattern)
+
+    def async_file_plugin(self, func, pattern=None, **options):
+        """Register per-file coroutine function, run concurrently.
+
+        See hana.aio.AsyncPerFilePlugin for options.
+        """
+        from hana.aio import AsyncPerFilePlugin
+
+        self.plugin(AsyncPerFilePlugin(func, **options), pattern, reads=pattern, writes=pattern)
+
+    def build(self, workers=None):
+        """Run all build steps.
+
+        With workers, steps that don't conflict according to their declared
+        reads and writes run concurrently. Conflicting steps always run in
+        registration order.
+        """
         self.metadata['_hana_build_time'] = datetime.datetime.utcnow()
 
-        for plugin, patterns in self.plugins:
-            filter = self.files.filter()
+        if self.manifest:
+            self.manifest.start(self._step_signature())
+
+        if self.profiler:
+            self.profiler.start()
+
+        if workers and workers > 1:
+            from hana.scheduler import StepScheduler
+
+            StepScheduler(self.plugins, workers).run(self._run_step)
+
+        else:
+            for step in self.plugins:
+                self._run_step(step)
+
+        if self.manifest:
+            self.manifest.save()
+
+        if self.profiler:
+            self.profiler.finish()
+
+    async def build_async(self, workers=None):
+        """Run all build steps from an event loop.
+
+        Coroutine function plugins, and plugins with a run_async(files, hana)
+        coroutine method, are awaited. Other plugins run in the loop's default
+        executor, so they don't block the loop. With workers, up to that many
+        steps that don't conflict run concurrently, as in build().
+        """
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+
+        self.metadata['_hana_build_time'] = datetime.datetime.utcnow()
+
+        if self.manifest:
+            self.manifest.start(self._step_signature())
+
+        if self.profiler:
+            self.profiler.start()
+
+        if workers and workers > 1:
+            from hana.scheduler import StepScheduler
+
+            await StepScheduler(self.plugins, workers).run_async(self._run_step_async)
+
+        else:
+            for step in self.plugins:
+                await self._run_step_async(step)
+
+        if self.manifest:
+            await loop.run_in_executor(None, self.manifest.save)
+
+        if self.profiler:
+            self.profiler.finish()
+
+    def _step_filter(self, step, since=None):
+        filter = self.files.filter()
+
+        if step.patterns:
+            filter.patterns(*step.patterns)
+
+        if since is not None:
+            filter.since(since)
+
+        return filter
+
+    def _run_step(self, step, since=None):
+        filter = self._step_filter(step, since)
+
+        if self.profiler:
+            with self.profiler.step(step, filter, self.files):
+                self._call_plugin(step.plugin, filter)
+        else:
+            self._call_plugin(step.plugin, filter)
+
+    def _call_plugin(self, plugin, filter):
+        result = plugin(filter, self)
+
+        # Coroutine plugins run in an event loop of their own
+        if hasattr(result, '__await__'):
+            import asyncio
+
+            asyncio.run(result)
+
+    async def _run_step_async(self, step):
+        from hana.aio import is_async_plugin
+
+        plugin = step.plugin
+        run_async = getattr(plugin, 'run_async', None)
+
+        if run_async is None and is_async_plugin(plugin):
+            run_async = plugin
+
+        if run_async is None:
+            import asyncio
+
+            await asyncio.get_running_loop().run_in_executor(None, self._run_step, step)
+            return
+
+        filter = self._step_filter(step)
+
+        if self.profiler:
+            with self.profiler.step(step, filter, self.files):
+                await run_async(filter, self)
+        else:
+            await run_async(filter, self)
 
-            if patterns:
-                filter.patterns(*patterns)
-            plugin(filter, self)
+    def watch(self, debounce=0.1, interval=0.5, stop=None):
+        """Build, then rebuild whenever loader source directories change.
+
+        Uses inotify where available and polls every interval seconds
+        otherwise. Changes are collected until nothing changed for debounce
+        seconds, then passed to rebuild(). Runs until stop (a threading.Event)
+        is set.
+        """
+        from hana.watch import create_watcher
+
+        self.build()
+
+        paths = [step.plugin.source_path for step in self.plugins if hasattr(step.plugin, 'reload')]
+        watcher = create_watcher(paths, interval)
+
+        self.logger.info('Watching %s for changes', ', '.join(paths))
+
+        try:
+            while stop is None or not stop.is_set():
+                changed = watcher.wait(debounce, interval)
+
+                if changed:
+                    self.rebuild(changed)
+        finally:
+            watcher.close()
+
+    def rebuild(self, paths):
+        """Reload changed source paths and re-run the steps affected by them.
+
+        Loaders (plugins with a reload() method) reload the paths into the
+        existing files. Other steps only get the files changed since, and are
+        skipped if none of them, or of the files removed or renamed since,
+        match their patterns. Plugins that need all of their files, like index
+        pages, can set incremental = False.
+        """
+        start = datetime.datetime.utcnow()
+        self.metadata['_hana_build_time'] = start
+
+        version = self.files.version
+
+        if self.profiler:
+            self.profiler.start()
+
+        for step in self.plugins:
+            if hasattr(step.plugin, 'reload'):
+                step.plugin.reload(self, paths)
+
+        for step in self.plugins:
+            if hasattr(step.plugin, 'reload'):
+                continue
+
+            changes = self.files.changes_since(version)
+
+            if changes is not None:
+                # Removed and renamed files count too, their outputs are stale
+                changed = changes.changed() | changes.removed | set(changes.renamed)
+
+                if not changed:
+                    continue
+
+                if step.patterns:
+                    match = compile_patterns(step.patterns)
+
+                    if not any(match(filename) for filename in changed):
+                        continue
+
+            if getattr(step.plugin, 'incremental', True):
+                self._run_step(step, version)
+            else:
+                self._run_step(step)
+
+        if self.manifest:
+            self.manifest.save()
+
+        if self.profiler:
+            self.profiler.finish()
+
+        self.logger.info('Rebuilt %d changed paths in %.3fs', len(paths),
+                         (datetime.datetime.utcnow() - start).total_seconds())
+
+    def _step_signature(self):
+        """Return signature of the build steps, their options and the metadata.
+
+        If any of them change, outputs of the previous build can't be reused.
+        """
+        import hashlib
+
+        def digest(value):
+            return hashlib.sha1(value.encode('utf-8')).hexdigest()
+
+        signature = []
+
+        for plugin, patterns, _, _ in self.plugins:
+            options = plugin_options(plugin)
+            signature.append([plugin_name(plugin), sorted(patterns or []),
+                              digest(options) if options else None])
+
+        # Set by Hana itself, changes every build
+        metadata = dict((key, value) for key, value in self.metadata.items()
+                        if not str(key).startswith('_hana'))
+        signature.append(['metadata', digest(_stable_repr(metadata))])
+
+        return signature
+
+class FileSetChanges(object):
+    """
+    Net changes to a FileSet since a version.
+
+    added, removed and modified are sets of filenames, renamed maps original
+    filenames to new ones. Files that were added and then renamed or modified
+    only show up as added.
+    """
+
+    def __init__(self, version):
+        self.version = version
+        self.added = set([])
+        self.removed = set([])
+        self.modified = set([])
+        self.renamed = {}
+
+        # Original name of files renamed since version
+        self._originals = {}
+
+    def __bool__(self):
+        return bool(self.added or self.removed or self.modified or self.renamed)
+
+    def changed(self):
+        """Return current names of all added, renamed and modified files
+        """
+        return self.added | self.modified | set(self.renamed.values())
+
+    def _apply(self, kind, filename, new_name=None):
+        originals = self._originals
+
+        if kind == 'added':
+            if filename in self.removed:
+                self.removed.discard(filename)
+                self.modified.add(filename)
+            else:
+                self.added.add(filename)
+
+        elif kind == 'removed':
+            self.modified.discard(filename)
+
+            if filename in self.added:
+                self.added.discard(filename)
+            elif filename in originals:
+                original = originals.pop(filename)
+                del self.renamed[original]
+                self.removed.add(original)
+            else:
+                self.removed.add(filename)
+
+        elif kind == 'renamed':
+            if filename in self.modified:
+                self.modified.discard(filename)
+                self.modified.add(new_name)
+
+            if filename in self.added:
+                self.added.discard(filename)
+                self.added.add(new_name)
+            elif filename in originals:
+                original = originals.pop(filename)
+                self.renamed[original] = new_name
+                originals[new_name] = original
+            else:
+                self.renamed[filename] = new_name
+                originals[new_name] = filename
+
+        elif kind == 'modified':
+            if filename not in self.added:
+                self.modified.add(filename)
 
 class FileSet(object):
+    """
+    Set of files, keyed by filename.
+
+    Every change to the set, or to the top level keys of its files, increments
+    version and is recorded in a journal, so steps can ask what changed since a
+    version with changes_since(). Iteration goes over a snapshot of the files,
+    which is shared until the set changes, so adding, removing and renaming
+    files while iterating is safe. Changes, the journal and indexes are
+    guarded by a lock, so steps running in parallel can change the set.
+    """
+
+    # Number of changes kept in the journal
+    journal_size = 1000000
 
     def __init__(self, parent=None):
         self._files = {}
         self._parent = parent
 
+        # Filename of each file, by identity, to find files that changed
+        self._names = {}
+        self._indexes = []
+        # Optional hana.columnar.ColumnarView answering metadata filters
+        self._columnar = None
+
+        self._versions = itertools.count(1)
+        self.version = 0
+        self._journal = collections.deque()
+        self._snapshot = None
+
+        # Insertion position of each file, to return lookups in set order
+        self._positions = {}
+        self._next_position = itertools.count()
+
+        # Reentrant, as removing files is part of adding and renaming them
+        self._lock = threading.RLock()
+
     def __iter__(self):
-        #TODO: is this right? changed for py3
-        return iter(self._files.items())
+        return iter(self.snapshot())
 
     def __len__(self):
         return len(self._files)
@@ -164,69 +663,480 @@ class FileSet(object):
         """
         return FileSetFilter(self)
 
+    def snapshot(self):
+        """Return tuple of (filename, file) pairs.
+
+        The snapshot is only copied when the set changed since the last one.
+        """
+        with self._lock:
+            snapshot = self._snapshot
+
+            if snapshot is None:
+                snapshot = self._snapshot = tuple(self._files.items())
+
+            return snapshot
+
+    def changes_since(self, version):
+        """Return FileSetChanges since version.
+
+        Returns None if the journal doesn't go back far enough.
+        """
+        with self._lock:
+            changes = FileSetChanges(self.version)
+
+            if self._journal and self._journal[0][0] > version + 1:
+                return None
+
+            # Recent changes are at the end of the journal
+            entries = []
+            for entry in reversed(self._journal):
+                if entry[0] <= version:
+                    break
+                entries.append(entry)
+
+        for entry in reversed(entries):
+            changes._apply(*entry[1:])
+
+        return changes
+
+    def _record(self, kind, filename, new_name=None):
+        # Callers hold the lock, so versions are journaled in order
+        self.version = next(self._versions)
+        self._journal.append((self.version, kind, filename, new_name))
+
+        if len(self._journal) > self.journal_size:
+            self._journal.popleft()
+
+        if kind != 'modified':
+            self._snapshot = None
+
     def add(self, filename, f):
-        self._files[filename] = f
+        with self._lock:
+            if filename in self._files:
+                self.remove(filename)
+
+            self._files[filename] = f
+            self._names[id(f)] = filename
+            self._positions[filename] = next(self._next_position)
+            f.add_listener(self._file_changed)
+
+            for index in self._indexes:
+                index.add(filename, f)
+
+            self._record('added', filename)
 
     def remove(self, filename):
-        self._files.pop(filename)
+        with self._lock:
+            f = self._files.pop(filename)
+            self._names.pop(id(f), None)
+            self._positions.pop(filename, None)
+            f.remove_listener(self._file_changed)
+
+            for index in self._indexes:
+                index.remove(filename)
+
+            self._record('removed', filename)
 
     def rename(self, filename, new_name):
-        self._files[new_name] = self._files.pop(filename)
+        with self._lock:
+            if new_name in self._files and new_name != filename:
+                self.remove(new_name)
+
+            f = self._files.pop(filename)
+            self._files[new_name] = f
+            self._names[id(f)] = new_name
+
+            # Renamed files move to the end, as in _files
+            del self._positions[filename]
+            self._positions[new_name] = next(self._next_position)
+
+            for index in self._indexes:
+                index.remove(filename)
+                index.add(new_name, f)
+
+            self._record('renamed', filename, new_name)
+
+    def _file_changed(self, f, key):
+        with self._lock:
+            filename = self._names.get(id(f))
+
+            for index in self._indexes:
+                if index.name[0] == key:
+                    index.update(filename, f)
+
+            self._record('modified', filename)
+
+    def add_index(self, key, kind='hash'):
+        """Index metadata key for faster metadata filters.
+
+        key can be a key name, tuple of nested key names, or MD key. Hash
+        indexes speed up == and in_() tests, sorted indexes speed up ==, <, <=,
+        >, >= and startswith() tests. Indexes are kept up to date when files
+        are added, removed, renamed or their top level keys are set. Changes to
+        nested values can't be detected; use reindex() after making them.
+        """
+        name = getattr(key, 'name', key)
+
+        if isinstance(name, str):
+            name = (name,)
+
+        if kind == 'hash':
+            index = HashIndex(tuple(name))
+        elif kind == 'sorted':
+            index = SortedIndex(tuple(name))
+        else:
+            raise ValueError('Unknown index kind {}'.format(kind))
+
+        with self._lock:
+            for filename, f in self._files.items():
+                index.add(filename, f)
+
+            self._indexes.append(index)
+
+        return index
+
+    def columnar(self, *keys):
+        """Create columnar view of metadata, used by filters from then on.
+
+        Requires numpy. See hana.columnar.ColumnarView.
+        """
+        from hana.columnar import ColumnarView
+
+        self._columnar = ColumnarView(self, keys)
+        return self._columnar
+
+    def reindex(self, filename):
+        """Update indexes for file
+        """
+        with self._lock:
+            for index in self._indexes:
+                index.update(filename, self._files[filename])
+
+    def lookup(self, predicates):
+        """Return candidate filenames for metadata predicates using indexes.
+
+        Candidates are in the order the set iterates over them. Returns None
+        if none of the predicates can be answered by an index.
+        """
+        expression = MDAnd(*predicates)
+
+        if self._columnar is not None and self._columnar.supports(expression):
+            return self._columnar.lookup(expression)
+
+        with self._lock:
+            candidates = self._lookup(expression)
+
+            if candidates is None:
+                return None
+
+            # Indexes return files in their own order
+            return self.in_order(candidates)
+
+    def in_order(self, filenames):
+        """Return filenames in the order the set iterates over them.
+
+        Filenames not in the set are left out.
+        """
+        with self._lock:
+            positions = self._positions
+            return sorted((filename for filename in filenames if filename in positions), key=positions.__getitem__)
+
+    def _lookup(self, predicate):
+        if isinstance(predicate, MDAnd):
+            # Any answerable predicate narrows down the candidates
+            results = [self._lookup(child) for child in predicate.children]
+            results = [candidates for candidates in results if candidates is not None]
+
+            if not results:
+                return None
+
+            results.sort(key=len)
+            others = [set(candidates) for candidates in results[1:]]
+
+            return [filename for filename in results[0]
+                    if all(filename in candidates for candidates in others)]
+
+        if isinstance(predicate, MDOr):
+            # Every alternative has to be answerable
+            candidates = {}
+
+            for child in predicate.children:
+                result = self._lookup(child)
+                if result is None:
+                    return None
+                candidates.update(dict.fromkeys(result))
 
+            return list(candidates)
 
-class FileSetFilter(object):
-    # TODO: define union (+) of two filter sets
-    # TODO: define difference (-) of two filter sets
-    # TODO: define intersection (&) of two filter sets
+        if isinstance(predicate, MD):
+            for index in self._indexes:
+                if index.supports(predicate):
+                    candidates = index.lookup(predicate)
+                    if candidates is not None:
+                        return candidates
+
+        return None
+
+
+class FileSetExpressionMixin(object):
+    """
+    Set algebra on file set filters.
+
+    Filters can be combined with + (or |) for union, & for intersection and -
+    for difference. Expressions are evaluated lazily when iterated, over sets
+    of filenames. Each filter is evaluated at most once per iteration; where
+    possible, files are tested against a filter one by one instead of scanning
+    the whole file set again.
+    """
+
+    def __add__(self, other):
+        return FileSetUnion(self, other)
+
+    __or__ = __add__
+
+    def __and__(self, other):
+        return FileSetIntersection(self, other)
+
+    def __sub__(self, other):
+        return FileSetDifference(self, other)
+
+    def __iter__(self):
+        files = self.file_set
+
+        for filename in self._keys({}):
+            if filename in files:
+                yield filename, files[filename]
+
+    def _keys(self, cache):
+        """Return list of matching filenames, cached for one evaluation
+        """
+        if self not in cache:
+            cache[self] = self._evaluate(cache)
+
+        return cache[self]
+
+    def _contains(self, filename, hfile, cache):
+        """Test whether file is included, without evaluating the whole set if possible
+        """
+        key = (self, 'set')
+
+        if key not in cache:
+            cache[key] = set(self._keys(cache))
+
+        return filename in cache[key]
+
+    def _cost(self):
+        """Estimate of number of files that need to be looked at
+        """
+        return len(self.file_set)
+
+class FileSetExpression(FileSetExpressionMixin):
+
+    def __init__(self, left, right):
+        if left.file_set is not right.file_set:
+            raise ValueError('Can only combine filters of the same file set')
+
+        self.file_set = left.file_set
+        self.left = left
+        self.right = right
+
+class FileSetUnion(FileSetExpression):
+
+    def _evaluate(self, cache):
+        keys = list(self.left._keys(cache))
+        seen = set(keys)
+
+        keys.extend(filename for filename in self.right._keys(cache) if filename not in seen)
+        return keys
+
+    def _contains(self, filename, hfile, cache):
+        return (self.left._contains(filename, hfile, cache)
+                or self.right._contains(filename, hfile, cache))
+
+    def _cost(self):
+        return self.left._cost() + self.right._cost()
+
+class FileSetIntersection(FileSetExpression):
+
+    def _evaluate(self, cache):
+        # Evaluate the cheaper side, then test its files against the other
+        first, second = sorted((self.left, self.right), key=lambda operand: operand._cost())
+        files = self.file_set
+
+        return [filename for filename in first._keys(cache)
+                if filename in files and second._contains(filename, files[filename], cache)]
+
+    def _contains(self, filename, hfile, cache):
+        return (self.left._contains(filename, hfile, cache)
+                and self.right._contains(filename, hfile, cache))
+
+    def _cost(self):
+        return min(self.left._cost(), self.right._cost())
+
+class FileSetDifference(FileSetExpression):
+
+    def _evaluate(self, cache):
+        files = self.file_set
+
+        return [filename for filename in self.left._keys(cache)
+                if filename in files and not self.right._contains(filename, files[filename], cache)]
+
+    def _contains(self, filename, hfile, cache):
+        return (self.left._contains(filename, hfile, cache)
+                and not self.right._contains(filename, hfile, cache))
+
+    def _cost(self):
+        return self.left._cost()
+
+
+class FileSetFilter(FileSetExpressionMixin):
 
     def __init__(self, file_set):
         self.file_set = file_set
 
         self._patterns = set([])
-        self._metadata = set([])
+        self._metadata = []
         self._limit = None
-        self._order = set([])
+        self._order = []
+        self._changed = False
+        self._since = None
+
+        # Called with each filename iterated over, then None, for profiling
+        self._observer = None
 
     def __iter__(self):
-        counter = 0
-        files = self.file_set
-        matcher = pathspec.PathSpec.from_lines('gitwildmatch', self._patterns)
+        matches = self._matches()
 
-        #TODO: how to implement order? Doing it first may sort way too many items, doing it last doesn't work as generator?
         if self._order:
-            #TODO: implement
-            pass
-            # files = sorted(files, ...)
+            # Only the top files need to be kept when limited
+            if self._limit:
+                matches = heapq.nsmallest(self._limit, matches, key=self._sort_key)
+            else:
+                matches = sorted(matches, key=self._sort_key)
+
+        elif self._limit:
+            matches = itertools.islice(matches, self._limit)
+
+        observer = self._observer
+
+        if observer is None:
+            for filename, hfile in matches:
+                yield filename, hfile
+            return
+
+        try:
+            for filename, hfile in matches:
+                observer(filename)
+                yield filename, hfile
+        finally:
+            observer(None)
+
+    def _matches(self):
+        files = self.file_set
+        matcher = self._matcher()
+
+        candidates = self._candidates()
+
+        # Operate on a snapshot, steps may add or remove files while iterating
+        if candidates is not None:
+            items = [(filename, files[filename]) for filename in candidates if filename in files]
+        else:
+            items = files.snapshot()
+
+        for filename, hfile in items:
+            if matcher(filename, hfile):
+                yield filename, hfile
+
+    def _candidates(self):
+        candidates = self.file_set.lookup(self._metadata) if self._metadata else None
+
+        if self._since is not None:
+            changes = self.file_set.changes_since(self._since)
+
+            if changes is not None:
+                changed = changes.changed()
+
+                if candidates is None:
+                    candidates = [filename for filename, _ in self.file_set.snapshot()
+                                  if filename in changed]
+                else:
+                    candidates = [filename for filename in candidates if filename in changed]
+
+        return candidates
+
+    def _evaluate(self, cache):
+        return [filename for filename, _ in self]
+
+    def _contains(self, filename, hfile, cache):
+        # Order and limit depend on the other files
+        if self._limit:
+            return super(FileSetFilter, self)._contains(filename, hfile, cache)
+
+        key = (self, 'matcher')
 
-        #TODO: should this operate on a copy, in case of deletes or adds?
-        for filename, hfile in files:
-            if self._limit and counter >= self._limit:
-                # Limit reached, end iteration
-                return
+        if key not in cache:
+            cache[key] = self._matcher()
 
-            if self._patterns and not matcher.match_file(filename):
+        return cache[key](filename, hfile)
+
+    def _cost(self):
+        candidates = self._candidates()
+
+        if candidates is not None:
+            return len(candidates)
+
+        return len(self.file_set)
+
+    def _matcher(self):
+        """Return function testing whether a single file matches the filter.
+
+        Doesn't take order and limit into account.
+        """
+        match = compile_patterns(self._patterns) if self._patterns else None
+        changed = self._changed
+        metadata = compile_predicates(self._metadata) if self._metadata else None
+        since = None
+
+        if self._since is not None:
+            changes = self.file_set.changes_since(self._since)
+
+            # All files, if the journal doesn't go back far enough
+            if changes is not None:
+                since = changes.changed()
+
+        def matcher(filename, hfile):
+            if changed and getattr(hfile, 'unchanged', False):
+                # File is the same as in the previous build
+                return False
+
+            if since is not None and filename not in since:
+                return False
+
+            if match and not match(filename):
                 # If patterns defined and file doesn't match skip
-                continue
+                return False
 
-            if self._metadata:
-                skip = False
-                for mdk in self._metadata:
-                    # Handle nested keys. If key doesn't exist, skip this file
-                    try:
-                        value = reduce(operator.getitem, mdk.name, hfile)
-                    except KeyError:
-                        skip = True
-                        continue
+            if metadata and not metadata(hfile):
+                return False
 
-                    if not mdk.eval(value):
-                        skip = True
-                        continue
+            return True
 
-                if skip:
-                    continue
+        return matcher
+
+    def _sort_key(self, item):
+        key = []
+
+        for mdk in self._order:
+            try:
+                value = reduce(operator.getitem, mdk.name, item[1])
+            except KeyError:
+                # Files missing the key go last, regardless of order
+                key.append((1, None))
+                continue
+
+            key.append((0, value if mdk.order == 'asc' else _Descending(value)))
 
-            counter += 1
-            yield filename, hfile
+        return key
 
     def patterns(self, *patterns):
         if patterns:
@@ -236,23 +1146,70 @@ class FileSetFilter(object):
         return self
 
     def metadata(self, *metadata):
+        """Only include files matching all metadata predicates.
+
+        Predicates can be combined with &, | and ~, see hana.metadata.MD.
+        """
         if metadata:
             for metad in metadata:
-                self._metadata.add(metad)
+                self._metadata.append(metad)
+
+        return self
+
+    def changed(self, changed=True):
+        """Only include files that changed since the previous build.
+
+        Without a build manifest, all files are considered changed.
+        """
+        self._changed = changed
+        return self
 
+    def since(self, version):
+        """Only include files added, renamed or modified since FileSet version
+        """
+        self._since = version
         return self
 
+    @property
+    def since_version(self):
+        """Version given to since(), or None if all files are included
+        """
+        return self._since
+
     def limit(self, limit=None):
         self._limit = limit
         return self
 
     def order(self, *metakey):
-        if args:
+        """Order files by metadata keys.
+
+        Keys are MD keys (MD.date.desc()), or key names for ascending order.
+        Files missing a key are ordered after the ones that have it. Combined
+        with limit(), only the top files are kept while going through the set.
+        """
+        if metakey:
             for key in metakey:
-                self._order.add(key)
+                if not isinstance(key, MD):
+                    key = MD(key)
+
+                self._order.append(key)
 
         return self
 
+class _Descending(object):
+    """Sort key wrapper reversing the order of values
+    """
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
 class File(dict):
     """
     Generic File object.
@@ -262,23 +1219,86 @@ class File(dict):
 
     def __init__(self, *args, **kwargs):
         super(File, self).__init__()
+        self._listeners = []
+        self._is_binary = None
         super(File, self).update(*args, **kwargs)
 
     def __repr__(self):
         return '<{} {}>'.format(self.__class__.__name__, dict(self))
 
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state.pop('_listeners', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._listeners = []
+
+    def __setitem__(self, key, value):
+        super(File, self).__setitem__(key, value)
+        self._notify(key)
+
+    def __delitem__(self, key):
+        super(File, self).__delitem__(key)
+        self._notify(key)
+
+    def pop(self, key, *default):
+        changed = key in self
+        value = super(File, self).pop(key, *default)
+        if changed:
+            self._notify(key)
+        return value
+
+    def clear(self):
+        keys = list(self)
+        super(File, self).clear()
+        for key in keys:
+            self._notify(key)
+
+    def add_listener(self, listener):
+        """Register callable invoked with (file, key) when a top level key changes
+        """
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        if listener in self._listeners:
+            self._listeners.remove(listener)
+
+    def _notify(self, key):
+        if key == 'contents':
+            self._is_binary = None
+
+        # Listeners aren't set up yet while unpickling
+        for listener in getattr(self, '_listeners', ()):
+            listener(self, key)
+
+    async def contents_async(self):
+        """Return contents from a coroutine, without blocking the event loop
+        """
+        return self['contents']
+
     @property
     def is_binary(self):
+        # Cached until contents are set
+        if self._is_binary is None:
+            self._is_binary = self._detect_binary()
+
+        return self._is_binary
+
+    def _detect_binary(self):
+        contents = self['contents']
+
         # If we don't have any content, treat it as binary and try to do detection later
-        if not self['contents']:
+        if not contents:
             return True
 
         test = '\0'
 
-        if isinstance(self['contents'], bytes):
+        if isinstance(contents, bytes):
             test = b'\0'
 
-        return test in self['contents']
+        return test in contents
 
     def update(self, *args, **kwargs):
         if args:
@@ -300,94 +1320,333 @@ class File(dict):
         return self[key]
 
     def sha1sum(self):
+        import hashlib
+
         return self.hashsum(hashlib.sha1).hexdigest()
 
     def hashsum(self, hash_algo):
-        if self.is_binary:
-            return hash_algo(self['contents'] or b'')
-        else:
-            return hash_algo(codecs.encode(self['contents'], 'utf-8'))
+        digest = hash_algo()
 
+        for chunk in self.iter_chunks():
+            digest.update(chunk)
+
+        return digest
+
+    def iter_chunks(self, chunk_size=None):
+        """Iterate over contents as chunks of bytes. Text is encoded as UTF-8.
+        """
+        chunk_size = chunk_size or CHUNK_SIZE
+        contents = self['contents']
+
+        if isinstance(contents, str):
+            contents = codecs.encode(contents, 'utf-8')
+
+        contents = memoryview(contents or b'')
+
+        for offset in range(0, len(contents), chunk_size):
+            yield contents[offset:offset + chunk_size].tobytes()
+
+    def open(self):
+        """Return readable binary file object with the contents
+        """
+        return io.BufferedReader(ChunkReader(self.iter_chunks()))
+
+class ChunkReader(io.RawIOBase):
+    """Raw file object reading from an iterator of bytes chunks
+    """
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._chunk = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self._chunk:
+            self._chunk = next(self._chunks, None)
+
+            if self._chunk is None:
+                self._chunk = b''
+                return 0
+
+        size = min(len(buffer), len(self._chunk))
+        buffer[:size] = self._chunk[:size]
+        self._chunk = self._chunk[size:]
+
+        return size
+
+
+_MISSING = object()
 
 class FSFile(File):
     """
     File system backed File object.
 
-    The contents will be loaded lazily.
+    The contents will be loaded lazily. The file is read once, and the same
+    read is used to detect whether the file is binary and to decode it.
+
+    Contents can also be streamed from disk without loading them, with
+    iter_chunks() or open(), and transformed lazily with pipe(). Transforms are
+    only applied when the contents are streamed or accessed.
+
+    sniff_size: number of bytes looked at for NUL bytes to detect binary
+                files. None looks at the whole file. Files that aren't valid
+                UTF-8 are always treated as binary.
+    binary_extensions, text_extensions: extensions (with dot, lowercase)
+                classified without reading the file.
     """
 
+    sniff_size = 8192
+    binary_extensions = frozenset()
+    text_extensions = frozenset()
+
     def __init__(self, filename, *args, **kwargs):
         super(FSFile, self).__init__(*args, **kwargs)
 
         if not filename:
             raise
 
-        self._is_binary = None
         self.loaded = False
         self.filename = filename
 
+        # os.stat() result of the file, if known by the loader
+        self.stat = None
+
+        # Contents were set by a plugin, and differ from the file on disk
+        self.modified = False
+
+        # Set by loaders when the source is the same as in the previous build
+        self.unchanged = False
+
+        # Optional hana.store.ContentStore limiting memory used by contents
+        self.content_store = None
+        self._spill_path = None
+
+        # Pending transforms of the contents on disk, see pipe()
+        self._transforms = []
+
     def __getitem__(self, key):
-        if key == 'contents' and not self.loaded:
-            self._get_contents()
+        if key == 'contents':
+            return self._contents()
 
         return super(FSFile, self).__getitem__(key)
 
+    def __setitem__(self, key, value):
+        if key == 'contents':
+            # Contents set by a plugin replace the ones on disk
+            self.loaded = True
+            self.modified = True
+            self._transforms = []
+            self._discard_spill()
+
+            if self.content_store:
+                self.content_store.loaded(self, value, loaded_from_disk=False)
+
+        super(FSFile, self).__setitem__(key, value)
+
+    def __delitem__(self, key):
+        super(FSFile, self).__delitem__(key)
+
+        if key == 'contents':
+            self.loaded = False
+            self.modified = False
+            self._transforms = []
+
+            if self.content_store:
+                self.content_store.discard(self)
+
+    def _contents(self):
+        while True:
+            if not self.loaded:
+                if self._spill_path:
+                    self._unspill()
+                elif self._transforms:
+                    self._materialize()
+                else:
+                    self._get_contents()
+
+            # Contents may have been evicted by another thread in the meantime
+            contents = dict.get(self, 'contents', _MISSING)
+
+            if contents is not _MISSING:
+                if self.content_store:
+                    self.content_store.touch(self)
+
+                return contents
+
+    async def contents_async(self):
+        if self.loaded:
+            return self._contents()
+
+        import asyncio
+
+        # Reading the file blocks, do it in the executor
+        return await asyncio.get_running_loop().run_in_executor(None, self._contents)
+
+    @property
+    def streamable(self):
+        """True if contents can be streamed from disk, without loading them
+        """
+        return not self.loaded and not self._spill_path
+
+    def pipe(self, transform):
+        """Add lazy transform of the contents.
+
+        transform is called with an iterator of bytes chunks and returns an
+        iterator of transformed chunks. Returns the file, so calls can be
+        chained.
+        """
+        if not self.streamable:
+            # Contents are in memory already, transform them right away
+            contents = b''.join(transform(self.iter_chunks()))
+            # Transformed contents may not be text anymore
+            self['contents'] = self._decode(contents, False)[0]
+            return self
+
+        self._transforms.append(transform)
+        self.modified = True
+
+        # Contents changed, even though they aren't set
+        self._notify('contents')
+
+        return self
+
+    def iter_chunks(self, chunk_size=None):
+        if not self.streamable:
+            return super(FSFile, self).iter_chunks(chunk_size)
+
+        chunks = self._read_chunks(chunk_size or CHUNK_SIZE)
+
+        for transform in self._transforms:
+            chunks = transform(chunks)
+
+        return chunks
+
+    def _read_chunks(self, chunk_size):
+        with open(self.filename, 'rb') as fin:
+            while True:
+                chunk = fin.read(chunk_size)
+                if not chunk:
+                    return
+                io_counters.read(len(chunk))
+                yield chunk
+
+    def _materialize(self):
+        """Load contents with pending transforms applied
+        """
+        contents, is_binary = self._decode(b''.join(self.iter_chunks()), False)
+
+        self._transforms = []
+
+        dict.__setitem__(self, 'contents', contents)
+        self._is_binary = is_binary
+        self.loaded = True
+
+        if self.content_store:
+            self.content_store.loaded(self, contents, loaded_from_disk=False)
+
+    def _decode(self, data, classify=True):
+        """Return contents for data read from disk, and whether they are binary
+        """
+        is_binary = self._is_binary if classify else None
+
+        if is_binary is None:
+            sniff = data if self.sniff_size is None else data[:self.sniff_size]
+            is_binary = b'\0' in sniff
+
+        contents = data
+
+        if not is_binary:
+            try:
+                contents = data.decode('utf-8')
+            except UnicodeDecodeError:
+                is_binary = True
+
+        return contents, is_binary
+
+    def _unload(self):
+        """Drop contents, they will be loaded from disk again when needed
+        """
+        self.loaded = False
+        dict.pop(self, 'contents', None)
+
+    def _spill(self, path):
+        """Move modified contents to a file, to be read back when needed
+        """
+        contents = dict.get(self, 'contents')
+
+        with open(path, 'wb') as fout:
+            if isinstance(contents, str):
+                fout.write(b't')
+                fout.write(contents.encode('utf-8'))
+            else:
+                fout.write(b'b')
+                fout.write(contents or b'')
+
+        self._spill_path = path
+        self._unload()
+
+    def _unspill(self):
+        with open(self._spill_path, 'rb') as fin:
+            data = fin.read()
+
+        contents = data[1:].decode('utf-8') if data[:1] == b't' else data[1:]
+
+        self._discard_spill()
+        dict.__setitem__(self, 'contents', contents)
+        self.loaded = True
+
+        if self.content_store:
+            self.content_store.loaded(self, contents, loaded_from_disk=False)
+            self.content_store.unspilled()
+
+    def _discard_spill(self):
+        if self._spill_path:
+            os.remove(self._spill_path)
+            self._spill_path = None
+
     # Override is_binary to avoid loading files unnecesarily
     @property
     def is_binary(self):
-        # If the file is already loaded, it may have been processed
-        # TODO: the logic here is flawed...? If the file wasn't loaded yet, we
-        #       read the file and determine if it's binary, but don't actually
-        #       load the data. The result gets cached. BUT determining if it's
-        #       binary involved actually reading the data, but not storing it, so
-        #       the file is esentially read twice.
-        #       On the other hand, if the file is loaded already, we evaluate the
-        #       contents to determine if it's binary, each time the function is
-        #       called, cache be damned. The reason here is that a plugin could
-        #       have changed the contents, so the cache may be out of date.
-        #       What really should happen:
-        #       * if is_binary() is called, load the file contents and determine
-        #         if it's binary.
-        #           * depending on the result, either encode the contents to utf8
-        #             or leave it be
-        #           * cache binary status
-        #       * if _get_contents is called, read as binary, determine if it's
-        #         binary
-        #           * encode file if necessary
-        #           * cache binary status
-        #       * monitor __setitem__, and if 'contents' gets set, clear is_binary
-        #         cache.
-        #       The only disadvantage with this is that binary files get pre-loaded... How much of a file usually gets read before \0 occurs?
-        if self.loaded:
-            self._is_binary = None
-            return super(FSFile, self).is_binary
+        if self._is_binary is None and not self.loaded:
+            self._is_binary = self._classify_extension()
 
-        if self._is_binary is None:
-            with open(self.filename, 'rb') as fin:
-                CHUNKSIZE = 1024
+            if self._is_binary is None:
+                self._contents()
 
-                while True:
-                    chunk = fin.read(CHUNKSIZE)
-                    if b'\0' in chunk:
-                        self._is_binary = True
-                        break
+        return super(FSFile, self).is_binary
 
-                    if len(chunk) < CHUNKSIZE:
-                        break
+    def _classify_extension(self):
+        if not (self.binary_extensions or self.text_extensions):
+            return None
 
-                    self._is_binary = False
+        extension = os.path.splitext(self.filename)[1].lower()
 
-        return self._is_binary
+        if extension in self.binary_extensions:
+            return True
+
+        if extension in self.text_extensions:
+            return False
+
+        return None
 
     def _get_contents(self):
-        if self.is_binary:
-            self['contents'] = open(self.filename, 'rb').read()
+        with open(self.filename, 'rb') as fin:
+            data = fin.read()
 
-        else:
-            self['contents'] = codecs.open(self.filename, 'r', 'utf-8').read()
+        io_counters.read(len(data), load=True)
+
+        contents, is_binary = self._decode(data)
 
+        # Loading isn't a change, so listeners aren't notified
+        dict.__setitem__(self, 'contents', contents)
+
+        self._is_binary = is_binary
         self.loaded = True
 
+        if self.content_store:
+            self.content_store.loaded(self, contents)
+
     def __repr__(self):
         return '<{} {} {}>'.format(self.__class__.__name__, self.filename, dict(self))
-
@@ -0,0 +1,169 @@
+from bisect import bisect_left, bisect_right
+from functools import reduce
+import operator
+
+class MetadataIndex(object):
+    """
+    Base class for FileSet metadata indexes.
+
+    Indexes map metadata values of a (possibly nested) key to filenames. A
+    lookup returns a list of candidate filenames that is guaranteed to include
+    every file matching the predicate, or None if the index can't answer it.
+    Predicates are still evaluated on the candidates, so an index may return
+    more files than match.
+    """
+
+    operations = ()
+
+    def __init__(self, name):
+        self.name = name
+        # Indexed value of each file, needed to find it again once it changes
+        self._entries = {}
+
+    def value(self, hfile):
+        return reduce(operator.getitem, self.name, hfile)
+
+    def supports(self, predicate):
+        return predicate.name == self.name and predicate.opname in self.operations
+
+    def add(self, filename, hfile):
+        try:
+            value = self.value(hfile)
+        except (KeyError, TypeError):
+            # Files without the key never match
+            return
+
+        self._entries[filename] = value
+        self._add(filename, value)
+
+    def remove(self, filename):
+        if filename in self._entries:
+            self._remove(filename, self._entries.pop(filename))
+
+    def update(self, filename, hfile):
+        self.remove(filename)
+        self.add(filename, hfile)
+
+    def lookup(self, predicate):
+        raise NotImplementedError()
+
+
+class HashIndex(MetadataIndex):
+    """Index for equality and membership tests
+    """
+
+    operations = ('eq', 'in')
+
+    def __init__(self, name):
+        super(HashIndex, self).__init__(name)
+
+        self._buckets = {}
+        # Filenames with unhashable values, always returned as candidates
+        self._unhashable = {}
+
+    def _add(self, filename, value):
+        try:
+            self._buckets.setdefault(value, {})[filename] = None
+        except TypeError:
+            self._unhashable[filename] = None
+
+    def _remove(self, filename, value):
+        try:
+            bucket = self._buckets.get(value, {})
+        except TypeError:
+            self._unhashable.pop(filename, None)
+            return
+
+        bucket.pop(filename, None)
+        if not bucket:
+            self._buckets.pop(value, None)
+
+    def lookup(self, predicate):
+        if predicate.opname == 'eq':
+            values = [predicate.value]
+
+        else:
+            # "in" on a string is a substring test, can't use the index
+            if isinstance(predicate.value, str):
+                return None
+            values = predicate.value
+
+        candidates = dict(self._unhashable)
+
+        try:
+            for value in values:
+                candidates.update(self._buckets.get(value, {}))
+        except TypeError:
+            return None
+
+        return list(candidates)
+
+
+class SortedIndex(MetadataIndex):
+    """Index for comparisons, ranges and prefix tests
+    """
+
+    operations = ('eq', 'lt', 'le', 'gt', 'ge', 'startswith')
+
+    def __init__(self, name):
+        super(SortedIndex, self).__init__(name)
+
+        self._values = []
+        self._filenames = []
+        # Filenames with values that can't be ordered with the rest
+        self._unsortable = {}
+
+    def _add(self, filename, value):
+        try:
+            idx = bisect_right(self._values, value)
+        except TypeError:
+            self._unsortable[filename] = None
+            return
+
+        self._values.insert(idx, value)
+        self._filenames.insert(idx, filename)
+
+    def _remove(self, filename, value):
+        if filename in self._unsortable:
+            del self._unsortable[filename]
+            return
+
+        try:
+            low = bisect_left(self._values, value)
+            high = bisect_right(self._values, value)
+        except TypeError:
+            return
+
+        for idx in range(low, high):
+            if self._filenames[idx] == filename:
+                del self._values[idx]
+                del self._filenames[idx]
+                return
+
+    def lookup(self, predicate):
+        opname = predicate.opname
+        value = predicate.value
+
+        try:
+            if opname == 'eq':
+                low, high = bisect_left(self._values, value), bisect_right(self._values, value)
+            elif opname == 'lt':
+                low, high = 0, bisect_left(self._values, value)
+            elif opname == 'le':
+                low, high = 0, bisect_right(self._values, value)
+            elif opname == 'gt':
+                low, high = bisect_right(self._values, value), len(self._values)
+            elif opname == 'ge':
+                low, high = bisect_left(self._values, value), len(self._values)
+            elif opname == 'startswith' and isinstance(value, str):
+                low = bisect_left(self._values, value)
+                high = len(self._values)
+                if value and value[-1] != '\U0010ffff':
+                    # All strings with the prefix sort before the next prefix
+                    high = bisect_left(self._values, value[:-1] + chr(ord(value[-1]) + 1))
+            else:
+                return None
+        except TypeError:
+            return None
+
+        return self._filenames[low:high] + list(self._unsortable)
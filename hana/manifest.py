@@ -0,0 +1,175 @@
+import copy
+import json
+import logging
+import os
+
+HASH_CHUNKSIZE = 1024 * 1024
+
+def hash_file(path, hash_algo=None):
+    """Return hex digest of file contents, read in chunks. Defaults to SHA-1.
+    """
+    if hash_algo is None:
+        import hashlib
+        hash_algo = hashlib.sha1
+
+    digest = hash_algo()
+
+    with open(path, 'rb') as fin:
+        while True:
+            chunk = fin.read(HASH_CHUNKSIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+class BuildManifest(object):
+    """
+    Persistent record of a build, used for incremental builds.
+
+    The manifest keeps track of every source file seen by the loaders (size,
+    mtime and content hash), the build steps that ran and the outputs that
+    were produced from each source. On the next build, unchanged sources are
+    recognized and the steps that support it can skip them.
+
+    The build steps are recorded as a signature. If the list of steps changes
+    between builds, the previous manifest is ignored and everything is rebuilt.
+    """
+
+    VERSION = 1
+
+    def __init__(self, path):
+        self.path = path
+        self.logger = logging.getLogger(self.__module__)
+
+        self.steps = []
+        self.sources = {}
+        self.outputs = {}
+
+        self._previous = {'steps': None, 'sources': {}, 'outputs': {}}
+        self._valid = False
+
+        self.load()
+
+    def load(self):
+        """Load previous build information from disk, if there is any
+        """
+        if not os.path.isfile(self.path):
+            return
+
+        try:
+            with open(self.path, 'r') as fin:
+                data = json.load(fin)
+        except ValueError:
+            self.logger.warning('Ignoring corrupt build manifest %s', self.path)
+            return
+
+        if data.get('version') != self.VERSION:
+            self.logger.info('Ignoring build manifest %s from a different version', self.path)
+            return
+
+        self._previous = data
+
+    def save(self):
+        """Write manifest for the current build to disk
+        """
+        data = {
+            'version': self.VERSION,
+            'steps': self.steps,
+            'sources': self.sources,
+            'outputs': self.outputs,
+        }
+
+        tmp_path = '{}.tmp'.format(self.path)
+
+        with open(tmp_path, 'w') as fout:
+            json.dump(data, fout, sort_keys=True)
+
+        os.replace(tmp_path, self.path)
+
+        # Later builds by the same process compare against this one
+        self._previous = copy.deepcopy(data)
+
+    def start(self, steps):
+        """Start recording a new build with the given step signature.
+
+        The previous build is only used if it ran the same steps.
+        """
+        self.steps = list(steps)
+        self.sources = {}
+        self.outputs = {}
+
+        self._valid = self._previous.get('steps') == self.steps
+
+        if not self._valid and self._previous.get('steps') is not None:
+            self.logger.info('Build steps changed, ignoring previous build manifest')
+
+    def check_source(self, source, stat=None):
+        """Record source file and return True if it is unchanged since the last build.
+        """
+        if stat is None:
+            stat = os.stat(source)
+
+        entry = {
+            'size': stat.st_size,
+            'mtime': stat.st_mtime_ns,
+            'hash': None,
+            'outputs': [],
+        }
+        self.sources[source] = entry
+
+        previous = self._previous['sources'].get(source) if self._valid else None
+
+        if not previous or previous['size'] != entry['size']:
+            entry['hash'] = hash_file(source)
+            return False
+
+        if previous['mtime'] == entry['mtime']:
+            entry['hash'] = previous['hash']
+            return True
+
+        # Touched, but contents may be the same
+        entry['hash'] = hash_file(source)
+        return entry['hash'] == previous['hash']
+
+    def is_output_current(self, output, source):
+        """Return True if output was produced from source in the previous build.
+        """
+        if not self._valid or source is None:
+            return False
+
+        previous = self._previous['outputs'].get(output)
+
+        return previous is not None and previous.get('source') == source
+
+    def previous_output(self, output):
+        """Return information recorded for output in the previous build, if any.
+        """
+        return self._previous['outputs'].get(output)
+
+    def previous_source_outputs(self, source):
+        """Return outputs produced from source by the previous build, if it
+        ran the same steps.
+        """
+        if not self._valid:
+            return []
+
+        return list(self._previous['sources'].get(source, {}).get('outputs', ()))
+
+    def previous_outputs(self):
+        """Return names of outputs produced by the previous build.
+
+        Unlike previous_output(), these are returned even if the build steps
+        changed since, as they are still on disk.
+        """
+        return list(self._previous['outputs'])
+
+    def record_output(self, output, source=None, **info):
+        """Record output produced by the current build.
+        """
+        entry = {'source': source}
+        entry.update(info)
+        self.outputs[output] = entry
+
+        if source in self.sources:
+            self.sources[source]['outputs'].append(output)
@@ -1,6 +1,24 @@
+import collections
 import operator
 import re
 
+# Lookup result for files missing a key
+_MISSING = object()
+# Shared key lookup that wasn't done yet for the current file
+_UNSET = object()
+
+# Relative cost of evaluating each operation, and estimated fraction of files
+# passing it. Used to order predicates so cheap and selective ones run first.
+OP_COST = {
+    None: 1, 'eq': 1, 'ne': 1, 'lt': 1.5, 'le': 1.5, 'gt': 1.5, 'ge': 1.5,
+    'in': 2, 'nin': 2, 'startswith': 3, 'endswith': 3, 'match': 6,
+}
+
+OP_PASS = {
+    None: 0.9, 'eq': 0.1, 'ne': 0.9, 'lt': 0.5, 'le': 0.5, 'gt': 0.5, 'ge': 0.5,
+    'in': 0.2, 'nin': 0.8, 'startswith': 0.3, 'endswith': 0.3, 'match': 0.3,
+}
+
 class MDMeta(type):
     def __getattr__(self, *args, **kwargs):
         return MD(*args, **kwargs)
@@ -10,115 +28,408 @@ class MDMeta(type):
 
     # TODO: dates: between (times, dates) - is this simply > x, < x ?
     # TODO: dates: in the last x days
-    # TODO: key name is defined/undefined
 
-    # TODO: logic "key == x or key == y" etc.
-    # TODO: more complex logic: [ [ 'title' == 'x' | title == 'y' ] & published_on < 1234 ]
-        #                          [ [ KEY('title) == 'x' | KEY(title) == 'y' ] &
+class MDExpression(object):
+    """
+    Base class of metadata predicates.
+
+    Predicates are immutable and combined with & (and), | (or) and ~ (not).
+    Comparisons bind weaker than these operators, so they need parentheses:
+    (MD.title == 'x') | (MD.title == 'y').
+
+    compile() turns the whole expression into a single function testing a
+    file. Keys used by several predicates are only looked up once per file,
+    and cheap and selective predicates are evaluated first.
+    """
+
+    def __and__(self, other):
+        if not isinstance(other, MDExpression):
+            return NotImplemented
+
+        return MDAnd(self, other)
+
+    def __or__(self, other):
+        if not isinstance(other, MDExpression):
+            return NotImplemented
+
+        return MDOr(self, other)
+
+    def __invert__(self):
+        return MDNot(self)
+
+    def __bool__(self):
+        # Catches "a < MD.key < b" and "and"/"or", which can't be overloaded
+        raise TypeError('Metadata predicates have no truth value, combine them with &, | and ~')
+
+    def compile(self):
+        """Return function testing whether a file matches the expression
+        """
+        counts = collections.Counter()
+        self._count_names(counts)
+
+        # Keys used more than once get a slot to keep their value in
+        shared = sorted((name for name, count in counts.items() if count > 1), key=repr)
+        slots = dict((name, idx) for idx, name in enumerate(shared))
+
+        test = self._compile(slots)
+
+        if not slots:
+            return lambda hfile: test(hfile, None)
+
+        size = len(slots)
+
+        def evaluate(hfile):
+            return test(hfile, [_UNSET] * size)
+
+        return evaluate
+
+    def _count_names(self, counts):
+        raise NotImplementedError()
+
+    def _compile(self, slots):
+        """Return function(file, shared values) testing the expression
+        """
+        raise NotImplementedError()
+
+    def _estimate(self):
+        """Return (cost, fraction of files passing)
+        """
+        raise NotImplementedError()
+
+class MD(MDExpression, metaclass=MDMeta):
+    """
+    Metadata key, or predicate on a key.
 
-class MD(object, metaclass=MDMeta):
+    MD.title, MD['title'] and MD('title') refer to the title key, nested keys
+    are MD['a']['b'] or MD(('a', 'b')). Comparing a key returns a predicate, a
+    key on its own tests that the key is defined. Files missing a key never
+    match a predicate on it.
+    """
 
-    def __init__(self, name, op=None, value=None, order='asc'):
+    def __init__(self, name, op=None, value=None, order='asc', opname=None):
         self.name = name
 
         if isinstance(name, str):
             self.name = (name,)
 
         self.op = op
-        #TODO: this should be special None, so we can recognize it
+        # Name of the operation, used to find a matching FileSet index
+        self.opname = opname
         self.value = value
         self.order = order
 
+    def _predicate(self, op, opname, value):
+        return MD(self.name, op, value, self.order, opname)
+
     def __getitem__(self, item):
-        #FIXME: this doesn't work in python2
-        #self.name = (*self.name, item)
-        name = list(self.name)
-        name.append(item)
-        self.name = tuple(name)
-        return self
+        return MD(self.name + (item,), self.op, self.value, self.order, self.opname)
 
     def __hash__(self):
-        return hash((self.name, self.value))
+        try:
+            return hash((self.name, self.opname, self.value))
+        except TypeError:
+            # Unhashable value, such as a list for in_()
+            return hash((self.name, self.opname, id(self.value)))
+
+    def __bool__(self):
+        if self.opname is None:
+            return True
+
+        return super(MD, self).__bool__()
+
+    def __repr__(self):
+        if self.opname is None:
+            return 'MD({!r})'.format(self.name)
+
+        return 'MD({!r}).{}({!r})'.format(self.name, self.opname, self.value)
 
     # Predicates
 
     def __eq__(self, other):
-        self.value = other
-        self.op = operator.__eq__
-        return self
+        return self._predicate(operator.__eq__, 'eq', other)
 
     def __ne__(self, other):
-        self.value = other
-        self.op = operator.__ne__
-        return self
+        return self._predicate(operator.__ne__, 'ne', other)
+
+    # Evaluated as op(value, file value), so comparisons use the reflected operator
 
     def __lt__(self, other):
-        self.value = other
-        self.op = operator.__lt__
-        return self
+        return self._predicate(operator.__gt__, 'lt', other)
 
     def __le__(self, other):
-        self.value = other
-        self.op = operator.__le__
-        return self
+        return self._predicate(operator.__ge__, 'le', other)
 
     def __gt__(self, other):
-        self.value = other
-        self.op = operator.__gt__
-        return self
+        return self._predicate(operator.__lt__, 'gt', other)
 
     def __ge__(self, other):
-        self.value = other
-        self.op = operator.__ge__
-        return self
+        return self._predicate(operator.__le__, 'ge', other)
 
     def in_(self, value):
         """Test membership
         """
         # NOTE: not defining __contains__, as the return value is forced to bool
-        self.value = value
-        self.op = operator.__contains__
-        return self
+        return self._predicate(operator.__contains__, 'in', value)
 
     def nin(self, value):
-        self.value = value
-        self.op = lambda x, y: not operator.__contains__(x, y)
-        return self
+        return self._predicate(lambda x, y: not operator.__contains__(x, y), 'nin', value)
 
     def startswith(self, value):
         """String specific comparison
         """
-        self.value = value
-        self.op = lambda x, y: str(y).startswith(str(x))
-        return self
+        return self._predicate(lambda x, y: str(y).startswith(str(x)), 'startswith', value)
 
     def endswith(self, value):
         """String specific comparison
         """
-        self.value = value
-        self.op = lambda x, y: str(y).endswith(str(x))
-        return self
+        return self._predicate(lambda x, y: str(y).endswith(str(x)), 'endswith', value)
 
     def match(self, pattern, flags=0):
         """Matches regular expression.
 
         Takes same parameters as re.match()
         """
-        self.value = re.compile(pattern, flags)
-        self.op = lambda x, y: bool(x.match(str(y)))
-        return self
+        return self._predicate(lambda x, y: bool(x.match(str(y))), 'match', re.compile(pattern, flags))
 
     # Order
 
     def asc(self):
-        self.order = 'asc'
+        return MD(self.name, self.op, self.value, 'asc', self.opname)
 
     def desc(self):
-        self.order = 'desc'
+        return MD(self.name, self.op, self.value, 'desc', self.opname)
 
     # Evaluation
 
     def eval(self, value):
+        if self.op is None:
+            return True
+
         return self.op(self.value, value)
 
+    def _count_names(self, counts):
+        counts[self.name] += 1
+
+    def _compile(self, slots):
+        get = _getter(self.name, slots)
+        op = self.op
+        value = self.value
+
+        if op is None:
+            def test(hfile, values):
+                return get(hfile, values) is not _MISSING
+
+        elif self.opname == 'eq':
+            def test(hfile, values):
+                current = get(hfile, values)
+                return current is not _MISSING and current == value
+
+        else:
+            def test(hfile, values):
+                current = get(hfile, values)
+
+                if current is _MISSING:
+                    return False
+
+                # Values that can't be compared don't match
+                try:
+                    return op(value, current)
+                except TypeError:
+                    return False
+
+        return test
+
+    def _estimate(self):
+        cost = OP_COST.get(self.opname, 3) + 0.5 * (len(self.name) - 1)
+
+        if self.opname in ('in', 'nin') and isinstance(self.value, (list, tuple)):
+            # Linear search
+            cost += len(self.value) / 4.0
+
+        return cost, OP_PASS.get(self.opname, 0.5)
+
+class MDAnd(MDExpression):
+    """All predicates match
+    """
+
+    def __init__(self, *children):
+        self.children = []
+
+        for child in children:
+            if isinstance(child, MDAnd):
+                self.children.extend(child.children)
+            else:
+                self.children.append(child)
+
+        self.children = tuple(self.children)
+
+    def __repr__(self):
+        return '({})'.format(' & '.join(repr(child) for child in self.children))
+
+    def _count_names(self, counts):
+        for child in self.children:
+            child._count_names(counts)
+
+    def _ordered(self):
+        # Cheap predicates that filter out the most files go first
+        def rank(child):
+            cost, passing = child._estimate()
+            return cost / (1 - passing) if passing < 1 else float('inf')
+
+        return sorted(self.children, key=rank)
+
+    def _compile(self, slots):
+        tests = [child._compile(slots) for child in self._ordered()]
+
+        if len(tests) == 1:
+            return tests[0]
+
+        if len(tests) == 2:
+            first, second = tests
+            return lambda hfile, values: first(hfile, values) and second(hfile, values)
+
+        def test(hfile, values):
+            for child in tests:
+                if not child(hfile, values):
+                    return False
+            return True
+
+        return test
+
+    def _estimate(self):
+        cost = 0
+        passing = 1
+
+        for child in self._ordered():
+            child_cost, child_passing = child._estimate()
+            cost += passing * child_cost
+            passing *= child_passing
+
+        return cost, passing
+
+class MDOr(MDExpression):
+    """Any of the predicates matches
+    """
+
+    def __init__(self, *children):
+        self.children = []
+
+        for child in children:
+            if isinstance(child, MDOr):
+                self.children.extend(child.children)
+            else:
+                self.children.append(child)
+
+        self.children = tuple(self.children)
+
+    def __repr__(self):
+        return '({})'.format(' | '.join(repr(child) for child in self.children))
+
+    def _count_names(self, counts):
+        for child in self.children:
+            child._count_names(counts)
+
+    def _ordered(self):
+        # Cheap predicates that match the most files go first
+        def rank(child):
+            cost, passing = child._estimate()
+            return cost / passing if passing > 0 else float('inf')
+
+        return sorted(self.children, key=rank)
+
+    def _compile(self, slots):
+        tests = [child._compile(slots) for child in self._ordered()]
+
+        if len(tests) == 1:
+            return tests[0]
+
+        if len(tests) == 2:
+            first, second = tests
+            return lambda hfile, values: first(hfile, values) or second(hfile, values)
+
+        def test(hfile, values):
+            for child in tests:
+                if child(hfile, values):
+                    return True
+            return False
+
+        return test
+
+    def _estimate(self):
+        cost = 0
+        failing = 1
+
+        for child in self._ordered():
+            child_cost, child_passing = child._estimate()
+            cost += failing * child_cost
+            failing *= 1 - child_passing
+
+        return cost, 1 - failing
+
+class MDNot(MDExpression):
+    """Predicate doesn't match
+    """
+
+    def __init__(self, child):
+        self.child = child
+
+    def __repr__(self):
+        return '~{!r}'.format(self.child)
+
+    def __invert__(self):
+        return self.child
+
+    def _count_names(self, counts):
+        self.child._count_names(counts)
+
+    def _compile(self, slots):
+        child = self.child._compile(slots)
+        return lambda hfile, values: not child(hfile, values)
+
+    def _estimate(self):
+        cost, passing = self.child._estimate()
+        return cost, 1 - passing
+
+def _getter(name, slots):
+    """Return function(file, shared values) looking up key, or _MISSING
+    """
+    slot = slots.get(name)
+
+    if len(name) == 1:
+        key = name[0]
+
+        def lookup(hfile, values=None):
+            try:
+                return hfile[key]
+            except KeyError:
+                return _MISSING
+
+    else:
+        def lookup(hfile, values=None):
+            value = hfile
+
+            try:
+                for key in name:
+                    value = value[key]
+            except (KeyError, IndexError, TypeError):
+                return _MISSING
+
+            return value
+
+    if slot is None:
+        return lookup
+
+    def get(hfile, values):
+        value = values[slot]
+
+        if value is _UNSET:
+            value = values[slot] = lookup(hfile)
+
+        return value
+
+    return get
 
+def compile_predicates(predicates):
+    """Return function testing whether a file matches all predicates
+    """
+    return MDAnd(*predicates).compile()
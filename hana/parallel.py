@@ -0,0 +1,97 @@
+from concurrent.futures import ProcessPoolExecutor
+import functools
+import logging
+import os
+
+from hana.core import File
+
+class PerFilePlugin(object):
+    """
+    Plugin that processes each file independently, fanned out over a process pool.
+
+    func is called with (filename, file) for every file and should modify the
+    file in place or return a new File. Only the contents and metadata of each
+    file are sent to the workers, and only the keys func changed or removed
+    are merged back into the original files. func has to be picklable, i.e. defined at module level.
+
+    workers: number of worker processes, defaults to number of CPUs
+    chunksize: number of files sent to a worker at once. By default, files are
+               split into about four chunks per worker.
+    min_files: below this number of files, func is run in the main process, as
+               starting the workers would cost more than it saves.
+    """
+    def __init__(self, func, workers=None, chunksize=None, min_files=16):
+        self.func = func
+        self.workers = workers or os.cpu_count() or 1
+        self.chunksize = chunksize
+        self.min_files = min_files
+        self.logger = logging.getLogger(self.__module__)
+
+    def __call__(self, files, hana):
+        hfiles = []
+        payloads = []
+
+        for filename, hfile in files:
+            hfiles.append(hfile)
+            payloads.append((filename, _file_payload(hfile)))
+
+        if not payloads:
+            return
+
+        process = functools.partial(_process_file, self.func)
+
+        if self.workers < 2 or len(payloads) < self.min_files:
+            results = [process(payload) for payload in payloads]
+
+        else:
+            chunksize = self.chunksize or max(1, len(payloads) // (self.workers * 4))
+
+            self.logger.debug('Processing %d files with %d workers, %d files per chunk',
+                              len(payloads), self.workers, chunksize)
+
+            with ProcessPoolExecutor(max_workers=self.workers) as executor:
+                results = list(executor.map(process, payloads, chunksize=chunksize))
+
+        for hfile, result in zip(hfiles, results):
+            _merge_file(hfile, result)
+
+def _file_payload(hfile):
+    payload = dict(hfile)
+
+    # Make sure lazily loaded contents are included
+    try:
+        payload['contents'] = hfile['contents']
+    except KeyError:
+        pass
+
+    return payload
+
+def _process_file(func, payload):
+    """Run func on file and return (changed values, removed keys).
+
+    Results are compared with the payload here, as contents of the original
+    file may have been evicted from memory since it was sent.
+    """
+    filename, data = payload
+    hfile = File(data)
+
+    result = func(filename, hfile)
+
+    if result is None:
+        result = hfile
+
+    changed = dict((key, value) for key, value in dict.items(result)
+                   if key not in data or data[key] != value)
+    removed = [key for key in data if key not in result]
+
+    return changed, removed
+
+def _merge_file(hfile, result):
+    changed, removed = result
+
+    for key in removed:
+        del hfile[key]
+
+    # Only set values that changed, so unmodified contents stay unmodified
+    for key, value in changed.items():
+        hfile[key] = value
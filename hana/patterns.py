@@ -0,0 +1,86 @@
+import functools
+import os
+import re
+
+GLOB_CHARS = '*?[\\'
+
+# pathspec uses named groups, which can't be repeated in a combined regex
+NAMED_GROUP_RE = re.compile(r'\(\?P<\w+>')
+
+def compile_patterns(patterns):
+    """Return matcher function for a collection of gitwildmatch patterns.
+
+    Matchers are cached by the set of patterns, so they are compiled only once
+    and reused across filters, steps and builds.
+    """
+    return _compile(frozenset(patterns))
+
+def _is_literal(text):
+    return text and not any(char in GLOB_CHARS for char in text)
+
+@functools.lru_cache(maxsize=256)
+def _compile(patterns):
+    # pathspec is slow to import, and only needed for complex patterns
+    import pathspec
+
+    if any(pattern.startswith('!') for pattern in patterns):
+        # Negations depend on order and other patterns, let pathspec handle
+        # them. Patterns are unordered, so negations are always applied last.
+        ordered = sorted(patterns, key=lambda pattern: (pattern.startswith('!'), pattern))
+        spec = pathspec.PathSpec.from_lines('gitwildmatch', ordered)
+        return _normalized(spec.match_file)
+
+    match_all = False
+    extensions = []
+    prefixes = []
+    regexes = []
+
+    for pattern in patterns:
+        if pattern in ('*', '**'):
+            match_all = True
+
+        elif pattern.startswith('*.') and '/' not in pattern and _is_literal(pattern[1:]):
+            # "*.ext" matches any path component ending with .ext
+            extensions.append(pattern[1:])
+
+        elif pattern.endswith('/**') and _is_literal(pattern[:-3].lstrip('/')):
+            # "dir/**" matches everything under dir
+            prefixes.append(pattern[:-2].lstrip('/'))
+
+        else:
+            regex, include = pathspec.patterns.GitWildMatchPattern.pattern_to_regex(pattern)
+            if regex is not None and include:
+                regexes.append('(?:{})'.format(NAMED_GROUP_RE.sub('(?:', regex)))
+
+    if match_all:
+        return _normalized(lambda filename: bool(filename))
+
+    extensions = tuple(extensions)
+    prefixes = tuple(prefixes)
+    regex = re.compile('|'.join(regexes)) if regexes else None
+
+    def match(filename):
+        if extensions:
+            if filename.endswith(extensions):
+                return True
+
+            if '/' in filename:
+                for part in filename.split('/')[:-1]:
+                    if part.endswith(extensions):
+                        return True
+
+        if prefixes and filename.startswith(prefixes):
+            return True
+
+        return regex is not None and regex.match(filename) is not None
+
+    return _normalized(match)
+
+def _normalized(match):
+    if os.sep == '/' and not os.altsep:
+        return match
+
+    def normalized_match(filename):
+        return match(filename.replace(os.sep, '/'))
+
+    return normalized_match
@@ -0,0 +1,75 @@
+import logging
+import sys
+
+from hana.core import FSFile
+
+_MISSING = object()
+
+class Deduplicate(object):
+    """
+    Interns identical file contents, so they are only held in memory once.
+
+    Files are grouped by type and length of their contents first, so only
+    contents that may be identical are hashed with File.hashsum(). Identical
+    contents are replaced by the same object, without marking files as
+    modified. Contents of FSFiles that aren't loaded don't take memory and
+    are left alone.
+
+    After a run, interned is the number of files whose contents were
+    replaced and saved the number of bytes of memory freed.
+
+    hash_algo: hashlib constructor used to hash contents, defaults to SHA-1
+    """
+    # Only replaces contents with equal values
+    writes = ()
+
+    def __init__(self, hash_algo=None):
+        self.hash_algo = hash_algo
+        self.logger = logging.getLogger(self.__module__)
+
+        self.interned = 0
+        self.saved = 0
+
+    def __call__(self, files, hana):
+        hash_algo = self.hash_algo
+
+        if hash_algo is None:
+            import hashlib
+            hash_algo = hashlib.sha1
+
+        self.interned = 0
+        self.saved = 0
+
+        groups = {}
+
+        for filename, f in files:
+            if isinstance(f, FSFile) and not f.loaded:
+                continue
+
+            contents = dict.get(f, 'contents', _MISSING)
+
+            if contents is _MISSING or not contents:
+                continue
+
+            groups.setdefault((type(contents), len(contents)), []).append(f)
+
+        for group in groups.values():
+            if len(group) < 2:
+                continue
+
+            interned = {}
+
+            for f in group:
+                contents = dict.__getitem__(f, 'contents')
+                digest = f.hashsum(hash_algo).digest()
+                original = interned.setdefault(digest, contents)
+
+                # Hashes are checked against the contents, collisions are left alone
+                if original is contents or original != contents:
+                    continue
+
+                dict.__setitem__(f, 'contents', original)
+                self.interned += 1
+                self.saved += sys.getsizeof(contents)
+
+        self.logger.info('Interned contents of %d files, saving %d bytes', self.interned, self.saved)
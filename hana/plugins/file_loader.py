@@ -1,45 +1,214 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import logging
 import os
 
-import pathspec
-
 from hana.errors import HanaPluginError
 from hana.core import FSFile
+from hana.patterns import compile_patterns
 
 class FileLoader(object):
     """
     source_file_keyword: name of front matter key that will be injected with path to the source file
+    ignore_patterns: patterns of files and directories to skip, relative to source_path
+    workers: number of threads scanning directories in parallel
+    sniff_size: number of bytes checked to detect binary files, see FSFile
+    binary_extensions: extensions of files treated as binary without reading them, e.g. ('.jpg', '.png')
+    text_extensions: extensions of files treated as text without reading them, e.g. ('.md', '.html')
     """
-    def __init__(self, source_path, ignore_patterns=(), source_file_keyword=None):
+    def __init__(self, source_path, ignore_patterns=(), source_file_keyword=None,
+                 sniff_size=FSFile.sniff_size, binary_extensions=(), text_extensions=(), workers=None):
         self._source_path = source_path
         self.ignore_patterns = ignore_patterns
         self.source_file_keyword = source_file_keyword
+        self.sniff_size = sniff_size
+        self.binary_extensions = frozenset(ext.lower() for ext in binary_extensions)
+        self.text_extensions = frozenset(ext.lower() for ext in text_extensions)
+        self.workers = workers
         self.logger = logging.getLogger(self.__module__)
 
         if not os.path.isdir(self._source_path):
             raise SourceDirectoryError()
 
+    @property
+    def source_path(self):
+        return self._source_path
+
     def __call__(self, files, hana):
-        ignore_spec = pathspec.PathSpec.from_lines('gitwildmatch', self.ignore_patterns)
+        for source, filepath, stat in self.scan():
+            if filepath in hana.files:
+                raise FileExistsError("File {} already exists".format(filepath))
+
+            self._add_file(hana, source, filepath, stat)
+
+    def reload(self, hana, paths):
+        """Reload changed source paths into hana.files, used by Hana.watch().
+
+        Files loaded from the paths, or from under them if they are
+        directories, are removed. Paths that still exist are loaded again.
+        Returns number of files loaded.
+        """
+        ignore = compile_patterns(self.ignore_patterns) if self.ignore_patterns else None
+        root = os.path.abspath(self._source_path)
+
+        # Loaded files by source, steps may have renamed them since
+        loaded = {}
+        for filename, f in hana.files:
+            source = getattr(f, 'filename', None)
+            if source is not None:
+                loaded.setdefault(source, []).append(filename)
+
+        count = 0
+
+        for path in sorted(set(paths)):
+            relpath = os.path.relpath(os.path.abspath(path), root)
+
+            if relpath == os.curdir or relpath.split(os.sep)[0] == os.pardir:
+                continue
+
+            if ignore and self._is_ignored(relpath, ignore):
+                continue
+
+            source = os.path.join(self._source_path, relpath)
+            prefix = source + os.sep
+
+            for loaded_source in list(loaded):
+                if loaded_source == source or loaded_source.startswith(prefix):
+                    for filename in loaded.pop(loaded_source):
+                        self._remove_file(hana, filename)
+
+            if os.path.isdir(source) and not os.path.islink(source):
+                directories = [(source, relpath)]
+                found = []
+
+                while directories:
+                    files, subdirectories = self._scan_directory(*directories.pop(), ignore=ignore)
+                    found.extend(files)
+                    directories.extend(subdirectories)
+
+            elif os.path.isfile(source):
+                found = [(source, relpath, os.stat(source))]
+
+            else:
+                continue
+
+            for found_source, filepath, stat in found:
+                self.logger.debug('Reloading %s', filepath)
+                self._add_file(hana, found_source, filepath, stat)
+                count += 1
+
+        return count
+
+    def _is_ignored(self, relpath, ignore):
+        if ignore(relpath):
+            return True
+
+        directory = os.path.dirname(relpath)
+
+        while directory:
+            if ignore(directory + '/'):
+                return True
+            directory = os.path.dirname(directory)
+
+        return False
+
+    def _remove_file(self, hana, filename):
+        if filename not in hana.files:
+            return
+
+        f = hana.files[filename]
+
+        if getattr(f, 'content_store', None):
+            f.content_store.discard(f)
+
+        hana.files.remove(filename)
+
+    def _add_file(self, hana, source, filepath, stat):
+        manifest = getattr(hana, 'manifest', None)
+
+        metadata = {}
+
+        if self.source_file_keyword:
+            metadata[self.source_file_keyword] = source
+
+        hfile = FSFile(source, **metadata)
+        hfile.stat = stat
+        hfile.content_store = getattr(hana, 'content_store', None)
+
+        if self.sniff_size != FSFile.sniff_size:
+            hfile.sniff_size = self.sniff_size
+
+        if self.binary_extensions or self.text_extensions:
+            hfile.binary_extensions = self.binary_extensions
+            hfile.text_extensions = self.text_extensions
+
+        if manifest:
+            hfile.unchanged = manifest.check_source(source, stat)
+
+        hana.files.add(filepath, hfile)
+
+    def scan(self):
+        """Return sorted list of (source, relative path, stat) of files to load.
+
+        Ignore patterns are matched against paths relative to the source
+        directory. Ignored directories are not descended into.
+        """
+        ignore = compile_patterns(self.ignore_patterns) if self.ignore_patterns else None
+        results = []
+
+        if self.workers and self.workers > 1:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                pending = set([executor.submit(self._scan_directory, self._source_path, '', ignore)])
+
+                while pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+
+                    for future in done:
+                        found, directories = future.result()
+                        results.extend(found)
+
+                        for path, relpath in directories:
+                            pending.add(executor.submit(self._scan_directory, path, relpath, ignore))
+
+        else:
+            directories = [(self._source_path, '')]
+
+            while directories:
+                found, subdirectories = self._scan_directory(*directories.pop(), ignore=ignore)
+                results.extend(found)
+                directories.extend(subdirectories)
+
+        results.sort(key=lambda result: result[1])
+        return results
+
+    def _scan_directory(self, path, relpath, ignore):
+        found = []
+        directories = []
 
-        for path, _, sfiles in os.walk(self._source_path):
-            for f in sfiles:
-                source = os.path.join(path, f)
+        with os.scandir(path) as entries:
+            for entry in entries:
+                filepath = os.path.join(relpath, entry.name)
 
-                if ignore_spec.match_file(f):
-                    continue
+                if entry.is_dir():
+                    # Like os.walk, don't follow symlinks to directories
+                    if entry.is_symlink():
+                        continue
 
-                filepath = os.path.relpath(source, self._source_path)
+                    if ignore and ignore(filepath + '/'):
+                        continue
 
-                if filepath in files:
-                    raise FileExistsError("File {} already exists".format(filepath))
+                    directories.append((entry.path, filepath))
 
-                metadata = {}
+                elif not ignore or not ignore(filepath):
+                    try:
+                        stat = entry.stat()
+                    except OSError as err:
+                        # Dangling symlinks, or files removed while scanning
+                        self.logger.warning('Skipping %s: %s', entry.path, err)
+                        continue
 
-                if self.source_file_keyword:
-                    metadata[self.source_file_keyword] = source
+                    found.append((entry.path, filepath, stat))
 
-                hana.files.add(filepath, FSFile(source, **metadata))
+        return found, directories
 
 class FileLoaderError(HanaPluginError):
     pass
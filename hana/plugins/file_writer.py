@@ -1,16 +1,84 @@
+from concurrent.futures import ThreadPoolExecutor
 import codecs
+import errno
 import logging
 import os
 import shutil
+import threading
 
+from hana.core import FSFile, io_counters
 from hana.errors import HanaPluginError
+from hana.manifest import hash_file
+
+# Linux ioctl to share data blocks between files (reflink)
+FICLONE = 0x40049409
+
+PASSTHROUGH_MODES = ('copy', 'hardlink', 'reflink')
+
+PRUNE_MODES = (False, None, True, 'manifest', 'disk')
 
 class FileWriter(object):
-    def __init__(self, deploy_path, clean=False):
+    """
+    skip_unchanged: compare contents with the existing output (or the output
+                    recorded in the build manifest) and only write files that
+                    changed. With a build manifest, outputs recorded by
+                    the previous build are always compared by their hash.
+
+    With a build manifest, unmodified FSFiles whose source didn't change
+    keep the outputs the previous build produced from that source, as long
+    as none of them were changed or removed since. Steps using
+    FileSetFilter.changed() skip these files, so they can't be written as
+    they are. Use clean to write everything again.
+    workers: number of threads used to write files concurrently, or number of
+             concurrent writes in Hana.build_async(). Output directories are
+             created up front, before any file is written.
+    passthrough: how to output FSFiles whose contents were never modified,
+                 without reading them into memory. 'copy' copies them in the
+                 kernel (copy_file_range/sendfile), 'hardlink' links the
+                 output to the source, 'reflink' clones it on filesystems that
+                 support it. Hardlinks and reflinks fall back to copying. None
+                 writes them like any other file.
+    prune: remove outputs that aren't produced anymore, and directories left
+           empty, after the current outputs were written. Unlike clean, the
+           output directory is never emptied. 'manifest' only removes outputs
+           recorded in the build manifest, 'disk' everything in the output
+           directory that wasn't written, and True uses the manifest if the
+           build has one. In incremental rebuilds, only outputs of files
+           removed or renamed since are removed.
+    link_duplicates: hardlink outputs with the same contents as an output
+                     written earlier in the build, instead of writing them
+                     again. The files and bytes saved are reported in
+                     deduplicated. Hardlinked outputs are unlinked before
+                     they are written again, so they never change together.
+    """
+    # Writes to disk only, doesn't modify files
+    writes = ()
+
+    def __init__(self, deploy_path, clean=False, skip_unchanged=False, workers=None, passthrough='copy',
+                 prune=False, link_duplicates=False):
         self._deploy_path = deploy_path
         self.clean = clean
+        self.skip_unchanged = skip_unchanged
+        self.workers = workers
+        self.passthrough = passthrough
         self.logger = logging.getLogger(self.__module__)
 
+        if passthrough and passthrough not in PASSTHROUGH_MODES:
+            raise ValueError('Unknown passthrough mode {}'.format(passthrough))
+
+        if prune not in PRUNE_MODES:
+            raise ValueError('Unknown prune mode {}'.format(prune))
+
+        self.prune = prune
+        self.link_duplicates = link_duplicates
+        self._duplicates = None
+        self._kept = set([])
+
+        self.written = 0
+        self.skipped = 0
+        self.pruned = 0
+        self.deduplicated = {'files': 0, 'bytes': 0}
+
     def _clean_output_dir(self):
         #TODO: see if we can avoid removing the dir itself
         shutil.rmtree(self._deploy_path)
@@ -20,40 +88,606 @@ class FileWriter(object):
         os.mkdir(self._deploy_path)
 
     def __call__(self, files, hana):
+        jobs, manifest = self._prepare(files, hana)
+
+        if self.workers and len(jobs) > 1:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                futures = [executor.submit(self._write_job, job) for job in jobs]
+
+            # All writes have finished at this point. Results are collected in
+            # submission order, so the error raised is always the one for the
+            # earliest failing file.
+            results = [future.result() for future in futures]
+        else:
+            results = [self._write_job(job) for job in jobs]
+
+        self._finish(jobs, results, manifest)
+
+        if self.prune and not self.clean:
+            self._prune(files, hana, manifest)
+
+    async def run_async(self, files, hana):
+        """Write files from an event loop, see Hana.build_async().
+
+        Files are written in the loop's default executor, up to workers
+        (default 16) at once.
+        """
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        jobs, manifest = await loop.run_in_executor(None, self._prepare, files, hana)
+
+        results = [None] * len(jobs)
+        errors = {}
+        pending = iter(enumerate(jobs))
+
+        async def worker():
+            for idx, job in pending:
+                try:
+                    results[idx] = await loop.run_in_executor(None, self._write_job, job)
+                except Exception as err:
+                    errors[idx] = err
+
+        await asyncio.gather(*[worker() for _ in range(min(self.workers or 16, len(jobs)))])
+
+        # As with threads, report the error of the earliest failing file
+        if errors:
+            raise errors[min(errors)]
+
+        self._finish(jobs, results, manifest)
+
+        if self.prune and not self.clean:
+            await loop.run_in_executor(None, self._prune, files, hana, manifest)
+
+    def _prepare(self, files, hana):
+        """Return write jobs for files, and the build manifest
+        """
+        manifest = getattr(hana, 'manifest', None)
+
+        self.written = 0
+        self.skipped = 0
+        self.pruned = 0
+        self._duplicates = DuplicateOutputs() if self.link_duplicates else None
+        # Outputs of the previous build that are still current
+        self._kept = set([])
+
+        if self.prune == 'manifest' and not manifest:
+            raise FileWriterError('Pruning by manifest needs a build manifest')
+
         if self.clean and os.path.isdir(self._deploy_path):
             self._clean_output_dir()
 
         if not os.path.isdir(self._deploy_path):
             self._create_output_dir()
 
+        jobs = []
+        directories = set([])
+
         for filename, f in files:
             output_path = os.path.join(self._deploy_path, filename)
 
-            def makedirs(path, directory):
-                if not directory:
-                    return
+            # Steps using changed() skip unchanged sources, so their files
+            # can't be written as they are. Outputs of the previous build are kept.
+            kept = manifest and not self.clean and self._kept_outputs(f, manifest)
 
-                if os.path.isdir(os.path.join(self._deploy_path, path, directory)):
-                    return
+            if kept:
+                self.logger.debug('Keeping outputs of unchanged %s: %s', filename, ', '.join(kept))
+                for output in kept:
+                    manifest.record_output(output, **manifest.previous_output(output))
+                self._kept.update(kept)
+                self.skipped += 1
+                continue
 
-                makedirs(*os.path.split(path))
+            directories.add(os.path.dirname(filename))
+            jobs.append((filename, f, output_path, manifest))
 
-                if os.path.isdir(os.path.join(self._deploy_path, path)) or path == '':
-                    dirpath = os.path.join(self._deploy_path, path, directory)
-                    os.mkdir(dirpath)
-                    return
-            makedirs(*os.path.split(os.path.dirname(filename)))
+        if self.prune and not self.clean:
+            self._remove_conflicts(jobs, directories)
 
-            self.logger.debug('Writing %s (%s)', output_path, 'binary' if f.is_binary else 'text')
-            if not f.is_binary:
-                codecs.open(output_path, 'w', 'utf-8').write(f['contents'])
+        self._create_directories(directories)
+
+        return jobs, manifest
+
+    def _finish(self, jobs, results, manifest):
+        for (filename, f, _, _), (written, info) in zip(jobs, results):
+            if written:
+                self.written += 1
+            else:
+                self.skipped += 1
+
+            if manifest:
+                manifest.record_output(filename, getattr(f, 'filename', None), **info)
+
+        self.logger.info('Wrote %d files, skipped %d unchanged', self.written, self.skipped)
+
+        if self._duplicates:
+            self.deduplicated = self._duplicates.stats()
+            self.logger.info('Linked %d duplicate outputs, saving %d bytes',
+                             self.deduplicated['files'], self.deduplicated['bytes'])
+
+    def _remove_conflicts(self, jobs, directories):
+        """Remove old outputs in the way of the current ones: directories where
+        files are written, and files where directories are created
+        """
+        for _, _, output_path, _ in jobs:
+            if os.path.isdir(output_path) and not os.path.islink(output_path):
+                self.logger.debug('Pruning directory %s', output_path)
+                shutil.rmtree(output_path)
+                self.pruned += 1
+
+        for directory in directories:
+            while directory:
+                path = os.path.join(self._deploy_path, directory)
+
+                if os.path.lexists(path) and not os.path.isdir(path):
+                    self.logger.debug('Pruning %s', path)
+                    os.remove(path)
+                    self.pruned += 1
+
+                directory = os.path.dirname(directory)
+
+    def _prune(self, files, hana, manifest):
+        """Remove outputs that weren't produced by this build
+        """
+        since = getattr(files, 'since_version', None)
+
+        if since is not None:
+            # Only the changed files were written
+            changes = hana.files.changes_since(since)
+
+            if changes is None:
+                self.logger.warning('Not pruning, changes since the last build are unknown')
+                return
+
+            orphans = [filename for filename in changes.removed | set(changes.renamed)
+                       if filename not in hana.files]
+
+        else:
+            produced = set(filename for filename, _ in files) | self._kept
+
+            if self.prune == 'disk' or not manifest:
+                orphans = [filename for filename in self._walk_outputs() if filename not in produced]
             else:
-                open(output_path, 'wb').write(f['contents'] or b'')
+                orphans = [filename for filename in manifest.previous_outputs() if filename not in produced]
+
+        directories = set([])
+
+        for filename in orphans:
+            path = os.path.join(self._deploy_path, filename)
+
+            # Rebuilds keep recording into the same manifest
+            if manifest:
+                manifest.outputs.pop(filename, None)
+
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            except IsADirectoryError:
+                shutil.rmtree(path)
+
+            self.logger.debug('Pruned %s', path)
+            self.pruned += 1
+            directories.add(os.path.dirname(filename))
+
+        if self.prune == 'disk' or not manifest:
+            directories.update(self._walk_outputs(directories=True))
+
+        self._remove_empty_directories(directories)
+
+        if self.pruned:
+            self.logger.info('Pruned %d outputs', self.pruned)
+
+    def _walk_outputs(self, directories=False):
+        """Return names of files in the output directory, relative to it, or
+        of directories if directories is True
+        """
+        names = []
+
+        for root, dirnames, filenames in os.walk(self._deploy_path):
+            relative = os.path.relpath(root, self._deploy_path)
+            relative = '' if relative == os.curdir else relative
+
+            if directories:
+                names.extend(os.path.join(relative, name) for name in dirnames
+                             if not os.path.islink(os.path.join(root, name)))
+                continue
+
+            # Links to directories aren't followed, they're outputs themselves
+            filenames = filenames + [name for name in dirnames if os.path.islink(os.path.join(root, name))]
+            names.extend(os.path.join(relative, name) for name in filenames)
+
+        return names
+
+    def _remove_empty_directories(self, directories):
+        """Remove directories and their parents if they're empty, deepest first
+        """
+        candidates = set([])
+
+        for directory in directories:
+            while directory:
+                candidates.add(directory)
+                directory = os.path.dirname(directory)
+
+        for directory in sorted(candidates, key=lambda name: name.count(os.sep), reverse=True):
+            try:
+                os.rmdir(os.path.join(self._deploy_path, directory))
+            except OSError:
+                # Not empty, or already gone
+                continue
+
+            self.logger.debug('Pruned directory %s', directory)
+
+    def _create_directories(self, directories):
+        """Create output directory tree once, before any files are written
+        """
+        created = set([''])
+
+        for directory in sorted(directories):
+            if directory in created:
+                continue
+
+            os.makedirs(os.path.join(self._deploy_path, directory), exist_ok=True)
+
+            # Parents were created as well
+            while directory not in created:
+                created.add(directory)
+                directory = os.path.dirname(directory)
+
+    def _write_job(self, job):
+        filename, f, output_path, manifest = job
+
+        if self.passthrough and isinstance(f, FSFile) and not f.modified:
+            return self._passthrough_job(job)
+
+        if isinstance(f, FSFile) and f.streamable:
+            return self._stream_job(job)
+
+        data = self._get_data(f)
+        digest = None
+        written = False
+
+        if self.skip_unchanged or manifest or self.link_duplicates:
+            import hashlib
+            digest = hashlib.sha1(data).hexdigest()
+
+        def write():
+            if self._output_matches(output_path, filename, len(data), digest, manifest):
+                self.logger.debug('Skipping identical %s', output_path)
+                return False
+
+            self.logger.debug('Writing %s (%s)', output_path, 'binary' if f.is_binary else 'text')
+            unlink_shared(output_path)
+            with open(output_path, 'wb') as fout:
+                fout.write(data)
+            io_counters.wrote(len(data))
+            return True
+
+        written = self._output(output_path, digest, len(data), write)
+
+        info = {}
+
+        if manifest:
+            stat = os.stat(output_path)
+            info = {'hash': digest, 'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+
+        return written, info
+
+    def _passthrough_job(self, job):
+        filename, f, output_path, manifest = job
+
+        source = f.filename
+        digest = None
+
+        if self.skip_unchanged or manifest or self.link_duplicates:
+            # Loaders using the manifest already hashed the source
+            digest = (manifest and manifest.sources.get(source, {}).get('hash')) or hash_file(source)
+
+        size = (f.stat or os.stat(source)).st_size
+
+        def write():
+            if self._output_matches(output_path, filename, size, digest, manifest):
+                self.logger.debug('Skipping identical %s', output_path)
+                return False
+
+            self.logger.debug('Passing through %s (%s)', output_path, self.passthrough)
+            self._passthrough(source, output_path)
+            io_counters.wrote(size)
+            return True
+
+        written = self._output(output_path, digest, size, write)
+
+        info = {}
+
+        if manifest:
+            stat = os.stat(output_path)
+            info = {'hash': digest, 'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+
+        return written, info
+
+    def _stream_job(self, job):
+        """Write contents streamed from disk, without loading them into memory
+        """
+        filename, f, output_path, manifest = job
+
+        import hashlib
+
+        tmp_path = '{}.hana-tmp'.format(output_path)
+
+        # Duplicates are found by hashing first, so they aren't streamed to disk at all
+        digest = f.hashsum(hashlib.sha1).hexdigest() if self._duplicates else None
+        streamed = {}
+
+        def write():
+            # The temporary file is removed when skipped, and when the
+            # contents or a transform raise while streaming
+            try:
+                hasher = hashlib.sha1()
+                size = 0
+
+                with open(tmp_path, 'wb') as fout:
+                    for chunk in f.iter_chunks():
+                        hasher.update(chunk)
+                        fout.write(chunk)
+                        size += len(chunk)
+
+                io_counters.wrote(size)
+                streamed['digest'] = hasher.hexdigest()
+
+                if self._output_matches(output_path, filename, size, streamed['digest'], manifest):
+                    self.logger.debug('Skipping identical %s', output_path)
+                    return False
+
+                self.logger.debug('Writing %s (streamed)', output_path)
+                os.replace(tmp_path, output_path)
+                return True
+
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+
+        written = self._output(output_path, digest, None, write)
+        digest = streamed.get('digest', digest)
+
+        info = {}
+
+        if manifest:
+            stat = os.stat(output_path)
+            info = {'hash': digest, 'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+
+        return written, info
+
+    def _output(self, output_path, digest, size, write):
+        """Produce output with write(), or by linking it to an output with the
+        same contents written earlier in this build. Returns True if the
+        output changed. size is taken from the output if None.
+        """
+        duplicates = self._duplicates
+
+        if duplicates is None or digest is None:
+            return write()
+
+        original = duplicates.claim(digest, output_path)
+
+        if original is None:
+            done = False
+
+            try:
+                written = write()
+                done = True
+            finally:
+                duplicates.release(digest, done)
+
+            return written
+
+        try:
+            if os.path.exists(output_path) and os.path.samefile(original, output_path):
+                self.logger.debug('Skipping %s, already linked to %s', output_path, original)
+                duplicates.saved(size if size is not None else os.stat(output_path).st_size)
+                return False
+
+            tmp_path = '{}.hana-link'.format(output_path)
+            os.link(original, tmp_path)
+            os.replace(tmp_path, output_path)
+
+        except OSError:
+            self.logger.debug('Linking %s to %s failed, writing it', output_path, original)
+            return write()
+
+        self.logger.debug('Linked %s to %s', output_path, original)
+        duplicates.saved(size if size is not None else os.stat(output_path).st_size)
+        return True
+
+    def _passthrough(self, source, output_path):
+        if self.passthrough == 'hardlink':
+            if os.path.exists(output_path):
+                if os.path.samefile(source, output_path):
+                    return
+                os.remove(output_path)
+
+            try:
+                os.link(source, output_path)
+                return
+            except OSError:
+                self.logger.debug('Hardlink of %s failed, copying', source)
+
+        unlink_shared(output_path)
+
+        if self.passthrough == 'reflink' and reflink_file(source, output_path):
+            return
+
+        copy_file(source, output_path)
+
+    def _get_data(self, f):
+        contents = f['contents']
+
+        if isinstance(contents, str):
+            return codecs.encode(contents, 'utf-8')
+
+        return contents or b''
+
+    def _output_matches(self, output_path, filename, size, digest, manifest):
+        """Return True if the output already has contents with digest.
+
+        Outputs recorded in the build manifest are compared by their recorded
+        hash. Other outputs are only read with skip_unchanged.
+        """
+        if not (self.skip_unchanged or manifest) or digest is None:
+            return False
+
+        try:
+            stat = os.stat(output_path)
+        except OSError:
+            return False
+
+        if stat.st_size != size:
+            return False
+
+        # Trust the recorded hash if the output wasn't touched since last build
+        previous = manifest.previous_output(filename) if manifest else None
+        if (previous and previous.get('hash') and previous.get('size') == stat.st_size
+                and previous.get('mtime') == stat.st_mtime_ns):
+            return previous['hash'] == digest
+
+        return self.skip_unchanged and hash_file(output_path) == digest
+
+    def _kept_outputs(self, f, manifest):
+        """Return outputs the previous build produced from the source of an
+        unmodified file, if the source didn't change and none of them were
+        touched since. Returns None if the file has to be written.
+
+        The step signature in the manifest covers steps, their options and
+        the metadata, so the same source gives the same outputs.
+        """
+        if not isinstance(f, FSFile) or f.modified or not f.unchanged:
+            return None
+
+        outputs = manifest.previous_source_outputs(f.filename)
+
+        if not outputs:
+            return None
+
+        for output in outputs:
+            previous = manifest.previous_output(output)
+
+            try:
+                stat = os.stat(os.path.join(self._deploy_path, output))
+            except OSError:
+                return None
+
+            if not previous or stat.st_size != previous.get('size') or stat.st_mtime_ns != previous.get('mtime'):
+                return None
+
+        return outputs
+
+
+class DuplicateOutputs(object):
+    """
+    Outputs written by a build, by content hash, so later outputs with the
+    same contents can be linked to them. Outputs with the same contents
+    written concurrently wait for the first one to be written.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Hash: [path, written event, path is usable]
+        self._outputs = {}
+
+        self.files = 0
+        self.bytes = 0
+
+    def claim(self, digest, output_path):
+        """Return path of an output with the same contents, or None if
+        output_path is the first. The first output has to be released.
+        """
+        with self._lock:
+            entry = self._outputs.get(digest)
+
+            if entry is None:
+                self._outputs[digest] = [output_path, threading.Event(), False]
+                return None
+
+        entry[1].wait()
+
+        # Written by someone else if the first output failed
+        return entry[0] if entry[2] else None
+
+    def release(self, digest, done):
+        """Mark first output with the hash as written, if done
+        """
+        entry = self._outputs[digest]
+        entry[2] = done
+        entry[1].set()
+
+    def saved(self, size):
+        with self._lock:
+            self.files += 1
+            self.bytes += size
+
+    def stats(self):
+        return {'files': self.files, 'bytes': self.bytes}
+
+
+def unlink_shared(path):
+    """Remove file if it's hardlinked, so writing to it doesn't change other files
+    """
+    try:
+        if os.lstat(path).st_nlink > 1:
+            os.remove(path)
+    except OSError:
+        pass
+
+def copy_file(source, destination):
+    """Copy file contents in the kernel where possible, without reading it into memory
+    """
+    with open(source, 'rb') as fin, open(destination, 'wb') as fout:
+        remaining = os.fstat(fin.fileno()).st_size
+
+        try:
+            if hasattr(os, 'copy_file_range'):
+                while remaining > 0:
+                    copied = os.copy_file_range(fin.fileno(), fout.fileno(), remaining)
+                    if not copied:
+                        break
+                    remaining -= copied
+                return
+
+            if hasattr(os, 'sendfile'):
+                offset = 0
+                while remaining > 0:
+                    sent = os.sendfile(fout.fileno(), fin.fileno(), offset, remaining)
+                    if not sent:
+                        break
+                    offset += sent
+                    remaining -= sent
+                return
+
+        except OSError as err:
+            if err.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP,
+                                 errno.ENOTSUP, errno.EBADF):
+                raise
+
+        # Copy in userspace, from the start
+        fin.seek(0)
+        fout.seek(0)
+        fout.truncate()
+        shutil.copyfileobj(fin, fout)
+
+def reflink_file(source, destination):
+    """Clone file on filesystems that support it. Returns False if not supported.
+    """
+    try:
+        import fcntl
+    except ImportError:
+        return False
 
+    with open(source, 'rb') as fin, open(destination, 'wb') as fout:
+        try:
+            fcntl.ioctl(fout.fileno(), FICLONE, fin.fileno())
+            return True
+        except OSError:
+            return False
 
-#class FileLoaderError(HanaPluginError):
-#    pass
-#
-#class DeployDirectoryError(FileLoaderError):
-#    pass
 
+class FileWriterError(HanaPluginError):
+    pass
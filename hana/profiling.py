@@ -0,0 +1,195 @@
+import contextlib
+import heapq
+import json
+import logging
+import os
+import threading
+import time
+
+from hana.core import io_counters, plugin_name
+
+class BuildProfiler(object):
+    """
+    Records timings and I/O of build steps.
+
+    For each step: wall and CPU time, number of files the step iterated over
+    (files_in), files it added, renamed or modified (files_out), files it
+    removed, bytes of file contents read and written and number of contents
+    loaded from disk. When steps run concurrently, CPU time and I/O of the
+    steps running at the same time are mixed.
+
+    top_files: keep per-file timings of the N slowest files. The time of a file
+               is the time the step spent between getting the file and asking
+               for the next one.
+    json_path: write report as JSON after every build
+    trace_path: write Chrome trace event file after every build, can be
+                loaded in chrome://tracing or Perfetto
+    hooks: callables called with the report after every build, e.g. to send
+           it to a metrics system
+    """
+
+    def __init__(self, top_files=0, json_path=None, trace_path=None, hooks=()):
+        self.top_files = top_files
+        self.json_path = json_path
+        self.trace_path = trace_path
+        self.hooks = list(hooks)
+        self.logger = logging.getLogger(self.__module__)
+
+        self.report = None
+
+        self._lock = threading.Lock()
+        self._start = None
+        self._cpu_start = None
+        self._steps = []
+        self._files = []
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    def start(self):
+        self._start = time.perf_counter()
+        self._cpu_start = time.process_time()
+        self._steps = []
+        self._files = []
+        self.report = None
+
+    @contextlib.contextmanager
+    def step(self, step, filter, files):
+        """Profile step running over filter of files
+        """
+        name = plugin_name(step.plugin)
+        counters = io_counters.snapshot()
+        version = files.version
+        files_in = [0]
+
+        if self.top_files:
+            filter._observer = self._file_observer(name, files_in)
+        else:
+            def count(filename):
+                if filename is not None:
+                    files_in[0] += 1
+
+            filter._observer = count
+
+        start = time.perf_counter()
+        cpu_start = time.process_time()
+
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - start
+            cpu = time.process_time() - cpu_start
+
+            changes = files.changes_since(version)
+            loads, bytes_read, bytes_written = (
+                after - before for after, before in zip(io_counters.snapshot(), counters))
+
+            profile = {
+                'name': name,
+                'patterns': sorted(step.patterns or []),
+                'start': start - self._start,
+                'wall': wall,
+                'cpu': cpu,
+                'files_in': files_in[0],
+                'files_out': len(changes.changed()) if changes is not None else None,
+                'files_removed': len(changes.removed) if changes is not None else None,
+                'bytes_read': bytes_read,
+                'bytes_written': bytes_written,
+                'loads': loads,
+                'thread': threading.get_ident(),
+            }
+
+            with self._lock:
+                self._steps.append(profile)
+
+            self.logger.debug('%s: %.3fs wall, %.3fs cpu, %d files in', name, wall, cpu, files_in[0])
+
+    def _file_observer(self, step_name, files_in):
+        current = [None, None]
+
+        def observer(filename):
+            now = time.perf_counter()
+
+            if current[0] is not None:
+                self._add_file_time(step_name, current[0], current[1], now - current[1])
+
+            if filename is not None:
+                files_in[0] += 1
+
+            current[0], current[1] = filename, now
+
+        return observer
+
+    def _add_file_time(self, step_name, filename, start, duration):
+        entry = (duration, start - self._start, step_name, filename, threading.get_ident())
+
+        with self._lock:
+            if len(self._files) < self.top_files:
+                heapq.heappush(self._files, entry)
+            elif duration > self._files[0][0]:
+                heapq.heapreplace(self._files, entry)
+
+    def finish(self):
+        """Build report, export it and call hooks
+        """
+        self.report = {
+            'wall': time.perf_counter() - self._start,
+            'cpu': time.process_time() - self._cpu_start,
+            'steps': sorted(self._steps, key=lambda profile: profile['start']),
+            'files': [{'step': step, 'filename': filename, 'start': start, 'time': duration,
+                       'thread': thread}
+                      for duration, start, step, filename, thread in sorted(self._files, reverse=True)],
+        }
+
+        if self.json_path:
+            self.write_json(self.json_path)
+
+        if self.trace_path:
+            self.write_trace(self.trace_path)
+
+        for hook in self.hooks:
+            hook(self.report)
+
+        return self.report
+
+    def write_json(self, path):
+        with open(path, 'w') as fout:
+            json.dump(self.report, fout, indent=2, sort_keys=True)
+
+    def trace_events(self):
+        """Return report as Chrome trace events
+        """
+        pid = os.getpid()
+        events = []
+
+        for profile in self.report['steps']:
+            args = dict((key, value) for key, value in profile.items()
+                        if key not in ('name', 'start', 'wall', 'thread'))
+            events.append({
+                'name': profile['name'],
+                'cat': 'step',
+                'ph': 'X',
+                'ts': profile['start'] * 1e6,
+                'dur': profile['wall'] * 1e6,
+                'pid': pid,
+                'tid': profile['thread'],
+                'args': args,
+            })
+
+        for timing in self.report['files']:
+            events.append({
+                'name': timing['filename'],
+                'cat': 'file',
+                'ph': 'X',
+                'ts': timing['start'] * 1e6,
+                'dur': timing['time'] * 1e6,
+                'pid': pid,
+                'tid': timing['thread'],
+                'args': {'step': timing['step']},
+            })
+
+        return events
+
+    def write_trace(self, path):
+        with open(path, 'w') as fout:
+            json.dump({'traceEvents': self.trace_events(), 'displayTimeUnit': 'ms'}, fout)
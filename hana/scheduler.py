@@ -0,0 +1,160 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import logging
+
+GLOB_CHARS = '*?[!'
+
+def _anchored_prefix(pattern):
+    """Return directory prefix of an anchored pattern, or None.
+    """
+    pattern = pattern.lstrip('/')
+    directory = pattern.rstrip('/').rpartition('/')[0]
+
+    if not directory:
+        # Unanchored pattern, matches at any level
+        return None
+
+    for idx, char in enumerate(directory):
+        if char in GLOB_CHARS:
+            directory = directory[:idx].rpartition('/')[0]
+            break
+
+    return directory + '/' if directory else None
+
+def _extension(pattern):
+    """Return extension for patterns like "*.ext", or None
+
+    Patterns ending with a slash only match directories, and everything in
+    them, so they have no extension.
+    """
+    if pattern.endswith('/'):
+        return None
+
+    name = pattern.rpartition('/')[2]
+
+    if name.startswith('*.') and not any(char in GLOB_CHARS for char in name[1:]):
+        return name[1:]
+
+    return None
+
+def _pattern_overlap(a, b):
+    if a.startswith('!') or b.startswith('!'):
+        return True
+
+    prefix_a, prefix_b = _anchored_prefix(a), _anchored_prefix(b)
+    if prefix_a and prefix_b and not (prefix_a.startswith(prefix_b) or prefix_b.startswith(prefix_a)):
+        return False
+
+    ext_a, ext_b = _extension(a), _extension(b)
+    if ext_a and ext_b and not (ext_a.endswith(ext_b) or ext_b.endswith(ext_a)):
+        return False
+
+    return True
+
+def patterns_overlap(a, b):
+    """Check whether two pattern lists may match the same file.
+
+    None stands for all files. Only simple patterns (directory prefixes and
+    extensions) are ever proven disjoint, otherwise patterns are assumed to
+    overlap.
+
+    Extensions are assumed to name files, not directories: like any pattern
+    without a slash, "*.md" also matches everything in a directory named
+    "notes.md", including "notes.md/index.html", which "*.html" matches too.
+    Steps declaring reads and writes by extension must not be used on trees
+    with such directories.
+    """
+    if a is None or b is None:
+        return True
+
+    return any(_pattern_overlap(pa, pb) for pa in a for pb in b)
+
+def steps_conflict(first, second):
+    """Check whether two build steps have to run in registration order.
+    """
+    return (patterns_overlap(first.writes, second.reads)
+            or patterns_overlap(first.writes, second.writes)
+            or patterns_overlap(first.reads, second.writes))
+
+class StepScheduler(object):
+    """
+    Runs build steps concurrently, respecting their declared reads and writes.
+
+    Each step depends on all earlier steps it conflicts with. Steps without
+    declarations read and write everything, so they act as barriers.
+    """
+
+    def __init__(self, steps, workers):
+        self.steps = list(steps)
+        self.workers = workers
+        self.logger = logging.getLogger(self.__module__)
+
+        self.dependencies = []
+
+        for idx, step in enumerate(self.steps):
+            self.dependencies.append(set(
+                dep for dep in range(idx) if steps_conflict(self.steps[dep], step)))
+
+    def run(self, run_step):
+        pending = list(range(len(self.steps)))
+        done = set([])
+        running = {}
+        errors = {}
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while pending or running:
+                if not errors:
+                    for idx in list(pending):
+                        if self.dependencies[idx] <= done:
+                            pending.remove(idx)
+                            self.logger.debug('Starting step %d', idx)
+                            running[executor.submit(run_step, self.steps[idx])] = idx
+
+                if not running:
+                    break
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+
+                for future in finished:
+                    idx = running.pop(future)
+                    error = future.exception()
+
+                    if error:
+                        errors[idx] = error
+                    else:
+                        done.add(idx)
+
+        if errors:
+            # Report the error of the earliest step
+            raise errors[min(errors)]
+
+    async def run_async(self, run_step):
+        """Run steps from an event loop, run_step is a coroutine function
+        """
+        import asyncio
+
+        semaphore = asyncio.Semaphore(self.workers)
+        tasks = []
+        errors = {}
+
+        async def run(idx):
+            await asyncio.gather(*[tasks[dep] for dep in self.dependencies[idx]], return_exceptions=True)
+
+            if errors:
+                return
+
+            async with semaphore:
+                self.logger.debug('Starting step %d', idx)
+
+                try:
+                    await run_step(self.steps[idx])
+                except Exception as err:
+                    errors[idx] = err
+
+        for idx in range(len(self.steps)):
+            tasks.append(asyncio.ensure_future(run(idx)))
+
+        await asyncio.gather(*tasks)
+
+        if errors:
+            # Report the error of the earliest step
+            raise errors[min(errors)]
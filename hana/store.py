@@ -0,0 +1,109 @@
+import collections
+import logging
+import os
+import shutil
+import sys
+import threading
+import weakref
+
+class ContentStore(object):
+    """
+    Memory budget for FSFile contents.
+
+    Loaded contents are tracked in least recently used order. When the total
+    size goes over budget, the least recently used contents are evicted:
+    contents that weren't modified are simply dropped, as they can be loaded
+    from the source file again; modified contents are spilled to a temporary
+    directory and read back when accessed.
+
+    budget: memory budget in bytes
+    spill_dir: directory to create the spill directory in, defaults to the
+               system temporary directory
+    """
+
+    def __init__(self, budget, spill_dir=None):
+        self.budget = budget
+        self.logger = logging.getLogger(self.__module__)
+
+        self._spill_parent = spill_dir
+        self._spill_dir = None
+
+        self._files = collections.OrderedDict()
+        self._lock = threading.RLock()
+        self.size = 0
+
+        self.hits = 0
+        self.loads = 0
+        self.evictions = 0
+        self.spills = 0
+        self.unspills = 0
+
+    def stats(self):
+        return {
+            'size': self.size,
+            'hits': self.hits,
+            'loads': self.loads,
+            'evictions': self.evictions,
+            'spills': self.spills,
+            'unspills': self.unspills,
+        }
+
+    def touch(self, f):
+        """Mark contents of file as used
+        """
+        with self._lock:
+            if id(f) in self._files:
+                self._files.move_to_end(id(f))
+                self.hits += 1
+
+    def loaded(self, f, contents, loaded_from_disk=True):
+        """Track contents loaded or set on file, evicting others if over budget
+        """
+        with self._lock:
+            self._discard(f)
+
+            size = sys.getsizeof(contents)
+            self._files[id(f)] = (f, size)
+            self.size += size
+
+            if loaded_from_disk:
+                self.loads += 1
+
+            self._evict()
+
+    def discard(self, f):
+        with self._lock:
+            self._discard(f)
+
+    def _discard(self, f):
+        entry = self._files.pop(id(f), None)
+
+        if entry:
+            self.size -= entry[1]
+
+    def _evict(self):
+        # The most recently used file always stays
+        while self.size > self.budget and len(self._files) > 1:
+            _, (f, size) = self._files.popitem(last=False)
+            self.size -= size
+
+            if f.modified:
+                f._spill(self._spill_path(f))
+                self.spills += 1
+            else:
+                f._unload()
+
+            self.evictions += 1
+
+    def _spill_path(self, f):
+        if self._spill_dir is None:
+            import tempfile
+
+            self._spill_dir = tempfile.mkdtemp(prefix='hana-spill-', dir=self._spill_parent)
+            weakref.finalize(self, shutil.rmtree, self._spill_dir, True)
+
+        return os.path.join(self._spill_dir, str(id(f)))
+
+    def unspilled(self):
+        with self._lock:
+            self.unspills += 1
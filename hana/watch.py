@@ -0,0 +1,171 @@
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import sys
+import time
+
+# inotify event masks, from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+
+INOTIFY_EVENT = struct.Struct('iIII')
+
+class Watcher(object):
+    """
+    Base class for file system watchers.
+
+    poll() returns paths of files and directories that changed, wait()
+    debounces them: once something changes, it keeps collecting changes until
+    nothing changed for the debounce period.
+    """
+
+    def __init__(self, paths):
+        self.paths = list(paths)
+        self.logger = logging.getLogger(self.__module__)
+
+    def poll(self, timeout):
+        raise NotImplementedError()
+
+    def wait(self, debounce=0.1, timeout=None):
+        changed = self.poll(timeout)
+
+        while changed:
+            more = self.poll(debounce)
+            if not more:
+                break
+            changed |= more
+
+        return changed
+
+    def close(self):
+        pass
+
+class PollingWatcher(Watcher):
+    """Watcher comparing stat() results of all files, for any platform
+    """
+
+    def __init__(self, paths, interval=0.5):
+        super(PollingWatcher, self).__init__(paths)
+        self.interval = interval
+        self._snapshot = self._scan()
+
+    def _scan(self):
+        snapshot = {}
+
+        for path in self.paths:
+            for dirpath, _, filenames in os.walk(path):
+                for filename in filenames:
+                    source = os.path.join(dirpath, filename)
+                    try:
+                        stat = os.stat(source)
+                    except OSError:
+                        continue
+                    snapshot[source] = (stat.st_mtime_ns, stat.st_size)
+
+        return snapshot
+
+    def poll(self, timeout):
+        time.sleep(self.interval if timeout is None else min(timeout, self.interval))
+
+        snapshot = self._scan()
+        previous, self._snapshot = self._snapshot, snapshot
+
+        changed = set(path for path in snapshot if previous.get(path) != snapshot[path])
+        changed.update(path for path in previous if path not in snapshot)
+
+        return changed
+
+class InotifyWatcher(Watcher):
+    """Watcher using Linux inotify
+    """
+
+    MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+            | IN_CREATE | IN_DELETE)
+
+    def __init__(self, paths):
+        super(InotifyWatcher, self).__init__(paths)
+
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self._fd = self._libc.inotify_init1(os.O_CLOEXEC)
+
+        if self._fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+
+        self._watches = {}
+
+        for path in self.paths:
+            self._add_tree(path)
+
+    def _add_tree(self, path):
+        """Watch directory and its subdirectories, return files in them
+        """
+        files = set([])
+
+        for dirpath, _, filenames in os.walk(path):
+            wd = self._libc.inotify_add_watch(self._fd, os.fsencode(dirpath), self.MASK)
+            if wd >= 0:
+                self._watches[wd] = dirpath
+
+            files.update(os.path.join(dirpath, filename) for filename in filenames)
+
+        return files
+
+    def poll(self, timeout):
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+
+        if not readable:
+            return set([])
+
+        data = os.read(self._fd, 64 * 1024)
+        changed = set([])
+        offset = 0
+
+        while offset < len(data):
+            wd, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+
+            if mask & IN_IGNORED:
+                self._watches.pop(wd, None)
+                continue
+
+            directory = self._watches.get(wd)
+            if directory is None:
+                continue
+
+            path = os.path.join(directory, os.fsdecode(name)) if name else directory
+            changed.add(path)
+
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                # Files may have been created before the directory was watched
+                changed.update(self._add_tree(path))
+
+        return changed
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+def create_watcher(paths, interval=0.5):
+    """Return inotify watcher where available, polling watcher otherwise
+    """
+    if sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(paths)
+        except (OSError, AttributeError):
+            logging.getLogger(__name__).info('inotify not available, polling for changes')
+
+    return PollingWatcher(paths, interval)
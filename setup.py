@@ -20,6 +20,10 @@ setup(name='hana',
         'pyyaml>=3.12',
     ],
 
+    extras_require={
+        'columnar': ['numpy'],
+    },
+
     author='Mayo Jordanov',
     author_email='mayo@oyam.ca',
 
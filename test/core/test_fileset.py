@@ -1,5 +1,6 @@
 import pytest
 from hana.core import FileSet, File
+from hana.metadata import MD
 
 def test_add():
     fm = FileSet()
@@ -56,3 +57,153 @@ def test_filter():
     assert fm['file_a']['count'] == 2
     assert fm['file_b']['count'] == 1
 
+
+def index_file_set():
+    fm = FileSet()
+
+    fm.add('file_a', File(tag='x', published=3))
+    fm.add('file_b', File(tag='y', published=1))
+    fm.add('file_c', File(tag='x', published=2))
+    fm.add('file_d', File(title='no tag'))
+
+    return fm
+
+@pytest.mark.parametrize('kind, predicate, expected', [
+    ('hash', MD.tag == 'x', ['file_a', 'file_c']),
+    ('hash', MD.tag.in_(['y', 'z']), ['file_b']),
+    ('sorted', MD.published == 2, ['file_c']),
+    ('sorted', MD.published < 3, ['file_b', 'file_c']),
+    ('sorted', MD.published >= 2, ['file_a', 'file_c']),
+    ('sorted', MD.tag.startswith('x'), ['file_a', 'file_c']),
+])
+def test_index(kind, predicate, expected):
+    fm = index_file_set()
+    index = fm.add_index(predicate.name, kind)
+
+    assert index.supports(predicate)
+    assert sorted(fm.lookup([predicate])) == expected
+    assert sorted(dict(fm.filter().metadata(predicate))) == expected
+
+def test_index_updates():
+    fm = index_file_set()
+    fm.add_index('tag')
+    fm.add_index(MD.published, 'sorted')
+
+    fm['file_b']['tag'] = 'x'
+    fm.remove('file_a')
+    fm.rename('file_c', 'file_e')
+    fm.add('file_f', File(tag='x', published=10))
+
+    assert sorted(fm.lookup([MD.tag == 'x'])) == ['file_b', 'file_e', 'file_f']
+    assert sorted(fm.lookup([MD.tag == 'x', MD.published > 1])) == ['file_e', 'file_f']
+
+    del fm['file_f']['published']
+
+    assert sorted(fm.lookup([MD.published > 1])) == ['file_e']
+
+def test_index_boolean():
+    fm = index_file_set()
+    fm.add_index('tag')
+
+    either = (MD.tag == 'y') | (MD.tag == 'x')
+
+    assert sorted(fm.lookup([either])) == ['file_a', 'file_b', 'file_c']
+    assert sorted(fm.lookup([either & (MD.published > 2)])) == ['file_a', 'file_b', 'file_c']
+    assert fm.lookup([(MD.tag == 'x') | (MD.published > 2)]) is None
+    assert fm.lookup([~(MD.tag == 'x')]) is None
+
+    assert sorted(dict(fm.filter().metadata(either & (MD.published > 2)))) == ['file_a']
+    assert sorted(dict(fm.filter().metadata(~(MD.tag == 'x')))) == ['file_b', 'file_d']
+
+@pytest.mark.parametrize('kind', ['hash', 'sorted'])
+def test_index_keeps_order(kind):
+    def file_set(indexed):
+        fm = FileSet()
+        for name, weight in [('a', 3), ('b', 2), ('c', 9), ('d', 1), ('e', 2)]:
+            fm.add(name, File(weight=weight))
+        fm.rename('a', 'z')
+
+        if indexed:
+            fm.add_index('weight', kind)
+
+        return fm
+
+    def limited(fm, predicate, limit):
+        return [filename for filename, _ in fm.filter().metadata(predicate).limit(limit)]
+
+    for predicate in [MD.weight.in_([1, 2, 3]) if kind == 'hash' else MD.weight < 4, MD.weight == 2]:
+        for limit in [None, 1, 2]:
+            assert limited(file_set(True), predicate, limit) == limited(file_set(False), predicate, limit)
+
+    assert limited(file_set(True), MD.weight == 2, 2) == ['b', 'e']
+
+def test_index_mixed_types():
+    fm = FileSet()
+    fm.add('file_a', File(published=1))
+    fm.add('file_b', File(published='x'))
+    fm.add_index('published', 'sorted')
+
+    res = dict(fm.filter().metadata(MD.published < 2))
+
+    assert list(res) == ['file_a']
+
+def test_changes_since():
+    fm = FileSet()
+    fm.add('file_a', File(contents='a'))
+    fm.add('file_b', File(contents='b'))
+    fm.add('file_c', File(contents='c'))
+
+    version = fm.version
+
+    fm.add('file_d', File(contents='d'))
+    fm.rename('file_d', 'file_e')
+    fm.rename('file_a', 'file_f')
+    fm.rename('file_f', 'file_g')
+    fm['file_b']['contents'] = 'bb'
+    fm.remove('file_c')
+
+    changes = fm.changes_since(version)
+
+    assert changes.added == {'file_e'}
+    assert changes.renamed == {'file_a': 'file_g'}
+    assert changes.modified == {'file_b'}
+    assert changes.removed == {'file_c'}
+    assert changes.changed() == {'file_e', 'file_g', 'file_b'}
+
+    assert not fm.changes_since(fm.version)
+
+def test_changes_since_truncated():
+    fm = FileSet()
+    fm.journal_size = 2
+
+    for name in 'abc':
+        fm.add(name, File())
+
+    assert fm.changes_since(0) is None
+    assert fm.changes_since(1).added == {'b', 'c'}
+
+def test_snapshot():
+    fm = FileSet()
+    fm.add('file_a', File())
+
+    snapshot = fm.snapshot()
+    fm['file_a']['title'] = 'x'
+
+    assert fm.snapshot() is snapshot
+
+    for filename, _ in fm:
+        fm.add(filename + '_copy', File())
+
+    assert snapshot == (('file_a', fm['file_a']),)
+    assert len(fm) == 2
+
+def test_filter_since():
+    fm = FileSet()
+    fm.add('file_a', File())
+    fm.add('file_b', File())
+
+    version = fm.version
+    fm['file_b']['title'] = 'x'
+    fm.add('file_c', File())
+
+    assert sorted(dict(fm.filter().since(version))) == ['file_b', 'file_c']
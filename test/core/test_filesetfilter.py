@@ -111,19 +111,118 @@ def test_metadata_limit():
 
     assert len(res) == 1
 
-#def test_order():
-#    assert 0
-#
-#
-#def test_order_limit():
-#    assert 0
-#
-#
-#def test_metadata_order():
-#    assert 0
-#
-#
-#def test_metadata_order_limit():
-#    assert 0
+def order_file_set():
+    fs = FileSet()
+    fs.add('file_a', File(date=2, title='a'))
+    fs.add('file_b', File(date=3, title='b'))
+    fs.add('file_c', File(title='c'))
+    fs.add('file_d', File(date=1, title='d'))
+    fs.add('file_e', File(date=3, title='e'))
+
+    return fs
+
+def test_order():
+    fsf = FileSetFilter(order_file_set())
+
+    res = [filename for filename, _ in fsf.order(MD.date)]
+
+    assert res == ['file_d', 'file_a', 'file_b', 'file_e', 'file_c']
+
+def test_order_desc():
+    fsf = FileSetFilter(order_file_set())
+
+    res = [filename for filename, _ in fsf.order(MD.date.desc())]
+
+    assert res == ['file_b', 'file_e', 'file_a', 'file_d', 'file_c']
+
+def test_order_multiple():
+    fsf = FileSetFilter(order_file_set())
+
+    res = [filename for filename, _ in fsf.order(MD.date.desc(), MD.title.desc())]
+
+    assert res == ['file_e', 'file_b', 'file_a', 'file_d', 'file_c']
+
+@pytest.mark.parametrize('limit', [1, 2, 4, 5, 6])
+def test_order_limit(limit):
+    fsf = FileSetFilter(order_file_set())
+
+    res = [filename for filename, _ in fsf.order(MD.date.desc()).limit(limit)]
+
+    assert res == ['file_b', 'file_e', 'file_a', 'file_d', 'file_c'][:limit]
+
+def test_metadata_order():
+    fsf = FileSetFilter(order_file_set())
+
+    res = [filename for filename, _ in fsf.metadata(MD.date > 1).order('date')]
+
+    assert res == ['file_a', 'file_b', 'file_e']
+
+def test_metadata_order_limit():
+    fsf = FileSetFilter(order_file_set())
+
+    res = [filename for filename, _ in fsf.metadata(MD.date > 1).order(MD.date.desc()).limit(2)]
+
+    assert res == ['file_b', 'file_e']
+
+def algebra_file_set():
+    fs = FileSet()
+    fs.add('blog/a.md', File(tag='x'))
+    fs.add('blog/b.md', File(tag='y'))
+    fs.add('blog/c.html', File(tag='x'))
+    fs.add('d.md', File(tag='x'))
+
+    return fs
+
+def test_union():
+    fs = algebra_file_set()
+
+    res = fs.filter().patterns('blog/**') + fs.filter().patterns('*.md')
+
+    assert [filename for filename, _ in res] == ['blog/a.md', 'blog/b.md', 'blog/c.html', 'd.md']
+
+def test_intersection():
+    fs = algebra_file_set()
+
+    res = fs.filter().patterns('*.md') & fs.filter().metadata(MD.tag == 'x')
+
+    assert sorted(dict(res)) == ['blog/a.md', 'd.md']
+
+def test_difference():
+    fs = algebra_file_set()
+
+    res = fs.filter().patterns('blog/**') - fs.filter().metadata(MD.tag == 'x')
+
+    assert sorted(dict(res)) == ['blog/b.md']
+
+def test_expression_limit():
+    fs = algebra_file_set()
+
+    latest = fs.filter().patterns('*.md').limit(2)
+    res = fs.filter().metadata(MD.tag == 'x') & latest
+
+    assert sorted(dict(res)) == ['blog/a.md']
+
+def test_expression_nested():
+    fs = algebra_file_set()
+    md = fs.filter().patterns('*.md')
+
+    res = (md - fs.filter().patterns('blog/**')) + (md & fs.filter().metadata(MD.tag == 'y'))
+
+    assert sorted(dict(res)) == ['blog/b.md', 'd.md']
+
+def test_expression_since():
+    fs = algebra_file_set()
+    version = fs.version
+
+    fs['blog/b.md']['tag'] = 'z'
+    fs.add('e.md', File(tag='x'))
+
+    changed = fs.filter().since(version)
 
+    assert sorted(dict(fs.filter().patterns('*.md') - changed)) == ['blog/a.md', 'd.md']
+    assert sorted(dict(fs.filter().metadata(MD.tag == 'x') & changed)) == ['e.md']
+    assert sorted(dict(fs.filter().patterns('*.html') + changed)) == ['blog/b.md', 'blog/c.html', 'e.md']
 
+def test_expression_different_sets():
+    with pytest.raises(ValueError):
+        FileSet().filter() + FileSet().filter()
@@ -0,0 +1,150 @@
+import pytest
+from hana.core import File, FileSet, FSFile
+
+
+def test_text(tmp_path):
+    path = tmp_path / 'a.txt'
+    path.write_text('text')
+
+    f = FSFile(str(path))
+
+    assert f.is_binary == False
+    assert f.loaded
+    assert f['contents'] == 'text'
+
+def test_binary(tmp_path):
+    path = tmp_path / 'a.bin'
+    path.write_bytes(b'bin\0ary')
+
+    f = FSFile(str(path))
+
+    assert f['contents'] == b'bin\0ary'
+    assert f.is_binary == True
+
+def test_sniff_size(tmp_path):
+    path = tmp_path / 'a.txt'
+    path.write_bytes(b'a' * 10 + b'\0')
+
+    f = FSFile(str(path))
+    f.sniff_size = 5
+
+    # NUL is outside the window, but the file is still valid UTF-8
+    assert f.is_binary == False
+
+    f = FSFile(str(path))
+    f.sniff_size = None
+
+    assert f.is_binary == True
+
+def test_invalid_utf8(tmp_path):
+    path = tmp_path / 'a.txt'
+    path.write_bytes(b'\xff\xfe')
+
+    f = FSFile(str(path))
+
+    assert f.is_binary == True
+    assert f['contents'] == b'\xff\xfe'
+
+def test_extension(tmp_path):
+    path = tmp_path / 'a.JPG'
+    path.write_bytes(b'jpg')
+
+    f = FSFile(str(path))
+    f.binary_extensions = frozenset(['.jpg'])
+
+    assert f.is_binary == True
+    assert not f.loaded
+    assert f['contents'] == b'jpg'
+
+def test_contents_set(tmp_path):
+    path = tmp_path / 'a.txt'
+    path.write_text('text')
+
+    f = FSFile(str(path))
+    f['contents'] = b'\0'
+
+    assert f.is_binary == True
+    assert f['contents'] == b'\0'
+
+    f['contents'] = 'text'
+
+    assert f.is_binary == False
+
+    del f['contents']
+
+    assert f['contents'] == 'text'
+
+def upper(chunks):
+    for chunk in chunks:
+        yield chunk.upper()
+
+def test_iter_chunks(tmp_path):
+    path = tmp_path / 'a.txt'
+    path.write_text('abcdefg')
+
+    f = FSFile(str(path))
+
+    assert list(f.iter_chunks(3)) == [b'abc', b'def', b'g']
+    assert not f.loaded
+    assert f.sha1sum() == File(contents='abcdefg').sha1sum()
+    assert not f.loaded
+
+def test_pipe(tmp_path):
+    path = tmp_path / 'a.txt'
+    path.write_text('abc')
+
+    f = FSFile(str(path)).pipe(upper)
+
+    assert f.open().read() == b'ABC'
+    assert not f.loaded
+    assert f.modified
+    assert f['contents'] == 'ABC'
+    assert f.is_binary == False
+
+def test_pipe_loaded(tmp_path):
+    path = tmp_path / 'a.txt'
+    path.write_text('abc')
+
+    f = FSFile(str(path))
+    f['contents']
+    f.pipe(upper)
+
+    assert f['contents'] == 'ABC'
+
+def append_null(chunks):
+    for chunk in chunks:
+        yield chunk
+    yield b'\0'
+
+def test_pipe_loaded_binary(tmp_path):
+    path = tmp_path / 'a.txt'
+    path.write_text('hello')
+
+    loaded = FSFile(str(path))
+    loaded['contents']
+    loaded.pipe(append_null)
+
+    unloaded = FSFile(str(path)).pipe(append_null)
+
+    # Both are classified again after the transform
+    assert loaded['contents'] == b'hello\x00'
+    assert unloaded['contents'] == b'hello\x00'
+
+def test_pipe_journal(tmp_path):
+    path = tmp_path / 'a.txt'
+    path.write_text('abc')
+
+    fs = FileSet()
+    fs.add('a.txt', FSFile(str(path)))
+    version = fs.version
+
+    fs['a.txt'].pipe(upper)
+
+    assert fs.changes_since(version).modified == {'a.txt'}
+    assert not fs['a.txt'].loaded
+
+def test_file_open():
+    f = File(contents='text')
+
+    assert f.open().read() == b'text'
+    assert list(File(contents=b'').iter_chunks()) == []
@@ -0,0 +1,172 @@
+import asyncio
+import threading
+import pytest
+import hana
+from hana.aio import is_async_plugin
+from hana.plugins.file_loader import FileLoader
+from hana.plugins.file_writer import FileWriter
+from hana.scheduler import StepScheduler
+
+
+@pytest.fixture
+def source(tmp_path):
+    source = tmp_path / 'src'
+    source.mkdir()
+
+    for idx in range(10):
+        (source / 'f{}.md'.format(idx)).write_text('file {}'.format(idx))
+
+    return source
+
+class InFlight(object):
+    """Coroutine per-file function recording how many files run at once
+    """
+
+    def __init__(self):
+        self.current = 0
+        self.maximum = 0
+
+    async def __call__(self, filename, hfile):
+        self.current += 1
+        self.maximum = max(self.maximum, self.current)
+
+        await asyncio.sleep(0.01)
+        hfile['contents'] = hfile['contents'].upper()
+
+        self.current -= 1
+
+def test_is_async_plugin():
+    async def plugin(files, hana):
+        pass
+
+    assert is_async_plugin(plugin)
+    assert is_async_plugin(InFlight())
+    assert not is_async_plugin(lambda files, hana: None)
+
+def test_build_async(source, tmp_path):
+    threads = {}
+
+    async def coroutine_plugin(files, hana):
+        threads['async'] = threading.get_ident()
+        for filename, f in files:
+            f['title'] = filename
+
+    def sync_plugin(files, hana):
+        threads['sync'] = threading.get_ident()
+        for filename, f in files:
+            f['contents'] = f['contents'] + '!'
+
+    b = hana.Hana()
+    b.plugin(FileLoader(source_path=str(source)))
+    b.plugin(coroutine_plugin)
+    b.plugin(sync_plugin, '*.md')
+    b.plugin(FileWriter(deploy_path=str(tmp_path / 'out')))
+
+    async def run():
+        threads['loop'] = threading.get_ident()
+        await b.build_async()
+
+    asyncio.run(run())
+
+    assert b.files['f1.md']['title'] == 'f1.md'
+    assert (tmp_path / 'out' / 'f1.md').read_text() == 'file 1!'
+
+    # Coroutines run in the loop, other plugins in the executor
+    assert threads['async'] == threads['loop']
+    assert threads['sync'] != threads['loop']
+
+def test_coroutine_plugin_in_build():
+    async def plugin(files, hana):
+        await asyncio.sleep(0.05)
+        hana.metadata['ran'] = True
+
+    b = hana.Hana(metadata={}, profile=True)
+    b.plugin(plugin)
+    b.build()
+
+    assert b.metadata['ran']
+
+    # The coroutine runs within the profiled step
+    step, = b.profiler.report['steps']
+    assert step['wall'] >= 0.05
+
+@pytest.mark.parametrize('use_async', [False, True])
+def test_async_file_plugin_concurrency(source, use_async):
+    func = InFlight()
+
+    b = hana.Hana()
+    b.plugin(FileLoader(source_path=str(source)))
+    b.async_file_plugin(func, '*.md', concurrency=3)
+
+    if use_async:
+        asyncio.run(b.build_async())
+    else:
+        b.build()
+
+    assert func.maximum == 3
+    assert b.files['f4.md']['contents'] == 'FILE 4'
+
+def test_async_file_plugin_errors(source):
+    async def fail(filename, hfile):
+        if filename in ('f3.md', 'f7.md'):
+            raise ValueError(filename)
+
+    b = hana.Hana()
+    b.plugin(FileLoader(source_path=str(source)))
+    b.async_file_plugin(fail)
+
+    with pytest.raises(ValueError, match='f3.md'):
+        b.build()
+
+def test_file_writer_run_async(source, tmp_path):
+    b = hana.Hana()
+    FileLoader(source_path=str(source))(b.files, b)
+
+    writer = FileWriter(deploy_path=str(tmp_path / 'out'), workers=4)
+    asyncio.run(writer.run_async(b.files, b))
+
+    assert sorted(path.name for path in (tmp_path / 'out').iterdir()) == ['f{}.md'.format(idx) for idx in range(10)]
+    assert (tmp_path / 'out' / 'f9.md').read_text() == 'file 9'
+
+class Step(object):
+    def __init__(self, name, reads=None, writes=None):
+        self.name = name
+        self.reads = reads
+        self.writes = writes
+
+def test_scheduler_run_async():
+    steps = [
+        Step('a', reads=['a/*'], writes=['a/*']),
+        Step('b', reads=['b/*'], writes=['b/*']),
+        Step('c', reads=['a/*'], writes=['a/*']),
+    ]
+
+    order = []
+    running = set([])
+    overlapped = []
+
+    async def run_step(step):
+        running.add(step.name)
+        overlapped.append(set(running))
+        await asyncio.sleep(0.01)
+        running.discard(step.name)
+        order.append(step.name)
+
+    asyncio.run(StepScheduler(steps, 2).run_async(run_step))
+
+    # c waits for a, b runs alongside
+    assert order.index('a') < order.index('c')
+    assert set(['a', 'b']) in overlapped
+
+def test_scheduler_run_async_error():
+    steps = [Step('a', writes=['a/*']), Step('b', reads=['a/*'])]
+    ran = []
+
+    async def run_step(step):
+        ran.append(step.name)
+        raise ValueError(step.name)
+
+    with pytest.raises(ValueError, match='a'):
+        asyncio.run(StepScheduler(steps, 2).run_async(run_step))
+
+    assert ran == ['a']
@@ -0,0 +1,53 @@
+import json
+import os
+import subprocess
+import sys
+
+BENCH_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'bench')
+
+
+def run_bench(tmp_path, *args):
+    return subprocess.run(
+        [sys.executable, os.path.join(BENCH_DIR, 'run.py'), '--files', '50', '--repeat', '1',
+         '--sites', str(tmp_path / 'sites'), '--baseline', str(tmp_path / 'baseline.json')] + list(args),
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+
+def test_site_generator(tmp_path):
+    sys.path.insert(0, BENCH_DIR)
+    try:
+        from sitegen import generate_site, site_metadata
+    finally:
+        sys.path.remove(BENCH_DIR)
+
+    first = generate_site(str(tmp_path / 'a'), files=100, seed=1)
+    second = generate_site(str(tmp_path / 'b'), files=100, seed=1)
+
+    assert first == second
+    assert len(first) == 100
+    assert any(path.endswith('.jpg') for path in first)
+    assert any(os.sep in path for path in first)
+
+    with open(str(tmp_path / 'a' / first[0]), 'rb') as fa, open(str(tmp_path / 'b' / first[0]), 'rb') as fb:
+        assert fa.read() == fb.read()
+
+    assert site_metadata(first[0], 1) == site_metadata(first[0], 1)
+
+def test_baseline(tmp_path):
+    result = run_bench(tmp_path, '--save')
+    assert result.returncode == 0, result.stderr
+
+    with open(str(tmp_path / 'baseline.json')) as fin:
+        baseline = json.load(fin)
+
+    key, = baseline
+    assert 'filter_metadata' in baseline[key]
+
+    # Make every benchmark look like a regression
+    baseline[key] = dict((name, 1e-9) for name in baseline[key])
+
+    with open(str(tmp_path / 'baseline.json'), 'w') as fout:
+        json.dump(baseline, fout)
+
+    result = run_bench(tmp_path, '--only', 'scan')
+    assert result.returncode == 1
+    assert 'REGRESSION scan' in result.stdout
@@ -0,0 +1,119 @@
+import datetime
+import pytest
+from hana.core import File, FileSet
+from hana.metadata import MD
+
+numpy = pytest.importorskip('numpy')
+
+
+def file_set():
+    fs = FileSet()
+
+    fs.add('a', File(weight=3, tag='x', draft=False, date=datetime.datetime(2020, 1, 1),
+                     day=datetime.date(2020, 1, 1), extra={'n': 1}))
+    fs.add('b', File(weight=1.5, tag='y', draft=True, date=datetime.datetime(2021, 1, 1),
+                     day=datetime.date(2021, 1, 1), extra={'n': 2}))
+    fs.add('c', File(weight=10, tag='x', draft=False, date=datetime.datetime(2022, 1, 1),
+                     day=datetime.date(2022, 1, 1)))
+    fs.add('d', File(title='no metadata'))
+
+    return fs
+
+PREDICATES = [
+    MD.weight > 2,
+    MD.weight <= 3,
+    MD.weight == 1.5,
+    MD.weight != 3,
+    MD.weight.in_([1.5, 10]),
+    MD.weight.nin([3]),
+    MD.weight > 'x',
+    MD.tag == 'x',
+    MD.tag != 'x',
+    MD.tag < 'y',
+    MD.tag.in_(['y', 'z']),
+    MD.tag.in_('xyz'),
+    MD.tag.startswith('x'),
+    MD.tag.match('[y]'),
+    MD.draft == False,
+    MD.date >= datetime.datetime(2021, 1, 1),
+    MD.day < datetime.date(2021, 6, 1),
+    MD.extra['n'] == 2,
+    MD.title,
+    ~MD.title,
+    ~(MD.tag == 'x'),
+    (MD.tag == 'y') | (MD.weight > 5),
+    (MD.tag == 'x') & ~(MD.weight > 5),
+    MD.missing == 1,
+]
+
+@pytest.mark.parametrize('predicate', PREDICATES, ids=repr)
+def test_matches_compiled(predicate):
+    fs = file_set()
+    expected = sorted(dict(fs.filter().metadata(predicate)))
+
+    view = fs.columnar()
+
+    assert view.supports(predicate)
+    assert sorted(view.lookup(predicate)) == expected
+    assert sorted(dict(view.filter(predicate))) == expected
+
+def test_keys():
+    fs = file_set()
+    view = fs.columnar('tag', MD.extra['n'])
+
+    assert view.supports(MD.extra['n'] == 1)
+    assert not view.supports(MD.weight == 1)
+    assert fs.lookup([MD.weight == 1]) is None
+    assert view.lookup(MD.extra['n'] == 1) == ['a']
+
+def test_incremental():
+    fs = file_set()
+    view = fs.columnar()
+
+    fs['a']['tag'] = 'y'
+    fs.remove('b')
+    fs.rename('c', 'e')
+    fs.add('f', File(tag='x', weight=7, new=True))
+
+    assert sorted(view.lookup(MD.tag == 'x')) == ['e', 'f']
+    assert sorted(view.lookup(MD.tag == 'y')) == ['a']
+    assert view.lookup(MD.new == True) == ['f']
+    assert len(view) == 4
+
+    # Changing kind of a column keeps the other values
+    fs['e']['weight'] = 'heavy'
+    assert sorted(view.lookup(MD.weight == 'heavy')) == ['e']
+    assert sorted(view.lookup(MD.weight > 5)) == ['f']
+
+def test_order():
+    def build(columnar):
+        fs = FileSet()
+        for name in 'abcd':
+            fs.add(name, File(n=1))
+        if columnar:
+            fs.columnar()
+        fs.rename('a', 'z')
+        fs.add('b', File(n=1))
+        return fs
+
+    def limited(fs, limit):
+        return [filename for filename, _ in fs.filter().metadata(MD.n == 1).limit(limit)]
+
+    assert limited(build(False), None) == ['c', 'd', 'z', 'b']
+
+    for limit in [None, 1, 2]:
+        assert limited(build(True), limit) == limited(build(False), limit)
+
+def test_growth():
+    fs = FileSet()
+    view = fs.columnar('n')
+
+    for n in range(100):
+        fs.add('file{}'.format(n), File(n=n))
+        if n % 10 == 0:
+            assert len(view.lookup(MD.n >= 0)) == n + 1
+
+    for n in range(0, 100, 2):
+        fs.remove('file{}'.format(n))
+
+    assert view.lookup(MD.n < 5) == ['file1', 'file3']
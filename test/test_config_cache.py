@@ -0,0 +1,92 @@
+import os
+import pytest
+import yaml
+import hana
+from hana import config_cache
+from hana.config_cache import ConfigCache
+
+CONFIG = '''
+metadata:
+  site: test
+build:
+  - hana.plugins.file_loader:FileLoader
+  - hana.plugins.file_writer:FileWriter: {}
+'''
+
+
+@pytest.fixture
+def config(tmp_path, monkeypatch):
+    # Start with empty caches
+    monkeypatch.setattr(config_cache, '_caches', {})
+
+    path = tmp_path / 'hana.yaml'
+    path.write_text(CONFIG)
+
+    # Old enough to be trusted by mtime
+    os.utime(str(path), ns=(0, 10 ** 9))
+
+    return path
+
+def no_parsing(monkeypatch):
+    def fail(*args, **kwargs):
+        raise AssertionError('Configuration parsed again')
+
+    monkeypatch.setattr(yaml, 'safe_load', fail)
+
+def test_cached(config, monkeypatch):
+    b = hana.Hana(configuration=str(config), metadata={})
+
+    assert b.config['metadata'] == {'site': 'test'}
+
+    no_parsing(monkeypatch)
+
+    b = hana.Hana(configuration=str(config), metadata={})
+    assert b.metadata == {'site': 'test'}
+    assert b.load_plugin('hana.plugins.file_writer:FileWriter').__name__ == 'FileWriter'
+
+def test_cached_on_disk(config, tmp_path, monkeypatch):
+    cache_dir = str(tmp_path / 'cache')
+
+    hana.Hana(configuration=str(config), config_cache=cache_dir)
+    assert os.listdir(cache_dir)
+
+    # New process, only the disk cache is left
+    monkeypatch.setattr(config_cache, '_caches', {})
+    no_parsing(monkeypatch)
+
+    b = hana.Hana(configuration=str(config), config_cache=cache_dir)
+    assert b.config['metadata'] == {'site': 'test'}
+
+def test_invalidated(config):
+    b = hana.Hana(configuration=str(config), metadata={})
+
+    config.write_text(CONFIG.replace('site: test', 'site: changed'))
+    os.utime(str(config), ns=(0, 10 ** 9))
+
+    b = hana.Hana(configuration=str(config), metadata={})
+    assert b.config['metadata'] == {'site': 'changed'}
+
+def test_touched(tmp_path):
+    path = tmp_path / 'config.yaml'
+    path.write_text('a: 1')
+
+    cache = ConfigCache()
+    calls = []
+
+    def compile(data):
+        calls.append(data)
+        return yaml.safe_load(data)
+
+    assert cache.load(str(path), compile) == {'a': 1}
+
+    # Same contents, new mtime
+    os.utime(str(path), ns=(0, 10 ** 9))
+    assert cache.load(str(path), compile) == {'a': 1}
+    assert cache.load(str(path), compile) == {'a': 1}
+
+    assert len(calls) == 1
+    assert cache.hits == 2
+
+    # Every load returns a fresh copy
+    cache.load(str(path), compile)['a'] = 2
+    assert cache.load(str(path), compile) == {'a': 1}
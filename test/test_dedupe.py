@@ -0,0 +1,49 @@
+import hana
+from hana.core import File
+from hana.plugins.dedupe import Deduplicate
+from hana.plugins.file_loader import FileLoader
+
+
+def test_interns_contents():
+    b = hana.Hana()
+    payload = b'\0' * 1000
+
+    # Equal, but separate objects
+    b.files.add('a.bin', File(contents=bytes(bytearray(payload))))
+    b.files.add('b.bin', File(contents=bytes(bytearray(payload))))
+    b.files.add('c.bin', File(contents=b'\1' * 1000))
+    b.files.add('a.txt', File(contents='redirect'))
+    b.files.add('b.txt', File(contents=''.join(['re', 'direct'])))
+    b.files.add('c.txt', File(title='no contents'))
+
+    dedupe = Deduplicate()
+    b.plugin(dedupe)
+    b.build()
+
+    assert b.files['a.bin']['contents'] is b.files['b.bin']['contents']
+    assert b.files['a.txt']['contents'] is b.files['b.txt']['contents']
+    assert b.files['c.bin']['contents'] == b'\1' * 1000
+
+    assert dedupe.interned == 2
+    assert dedupe.saved > 1000
+
+def test_fsfiles(tmp_path):
+    source = tmp_path / 'src'
+    source.mkdir()
+
+    for name in ['a.txt', 'b.txt', 'c.txt']:
+        (source / name).write_text('same')
+
+    b = hana.Hana()
+    FileLoader(source_path=str(source))(b.files, b)
+
+    b.files['a.txt']['contents']
+    b.files['b.txt']['contents']
+
+    dedupe = Deduplicate()
+    dedupe(b.files.filter(), b)
+
+    assert dedupe.interned == 1
+    assert not b.files['c.txt'].loaded
+    assert not b.files['a.txt'].modified and not b.files['b.txt'].modified
+    assert b.files['a.txt']['contents'] is b.files['b.txt']['contents']
@@ -0,0 +1,64 @@
+import os
+import pytest
+import hana
+from hana.plugins.file_loader import FileLoader
+
+
+@pytest.fixture
+def source(tmp_path):
+    for path in ['index.html', 'blog/post.md', 'blog/drafts/draft.md', 'node_modules/lib/x.js',
+                 'images/a.jpg', 'images/nested/b.jpg', 'notes.tmp']:
+        full_path = tmp_path.joinpath(*path.split('/'))
+        full_path.parent.mkdir(parents=True, exist_ok=True)
+        full_path.write_text(path)
+
+    return tmp_path
+
+def load(source, **kwargs):
+    b = hana.Hana()
+    b.plugin(FileLoader(source_path=str(source), **kwargs))
+    b.build()
+
+    return b.files
+
+@pytest.mark.parametrize('workers', [None, 4])
+def test_scan(source, workers):
+    files = load(source, workers=workers)
+
+    assert sorted(files.filenames()) == sorted(os.path.join(*path.split('/')) for path in [
+        'index.html', 'blog/post.md', 'blog/drafts/draft.md', 'node_modules/lib/x.js',
+        'images/a.jpg', 'images/nested/b.jpg', 'notes.tmp'])
+
+    assert files['index.html'].stat.st_size == len('index.html')
+
+@pytest.mark.parametrize('workers', [None, 4])
+def test_ignore(source, workers):
+    files = load(source, ignore_patterns=['node_modules', 'blog/drafts/', '*.tmp', 'images/nested/**'],
+                 workers=workers)
+
+    assert sorted(files.filenames()) == sorted(os.path.join(*path.split('/')) for path in [
+        'index.html', 'blog/post.md', 'images/a.jpg'])
+
+def test_ignore_prunes(source, monkeypatch):
+    scanned = []
+    scandir = os.scandir
+
+    def tracking_scandir(path):
+        scanned.append(os.path.relpath(path, str(source)))
+        return scandir(path)
+
+    monkeypatch.setattr(os, 'scandir', tracking_scandir)
+
+    load(source, ignore_patterns=['node_modules'])
+
+    assert 'node_modules' not in scanned
+    assert os.path.join('blog', 'drafts') in scanned
+
+@pytest.mark.parametrize('workers', [None, 4])
+def test_broken_symlink(source, workers):
+    os.symlink(str(source / 'missing.md'), str(source / 'blog' / 'broken.md'))
+
+    files = load(source, workers=workers)
+
+    assert 'index.html' in files
+    assert os.path.join('blog', 'broken.md') not in files
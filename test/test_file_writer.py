@@ -0,0 +1,347 @@
+import os
+import pytest
+import hana
+from hana.core import File
+from hana.plugins.file_writer import FileWriter
+
+
+def write(output, files, **kwargs):
+    b = hana.Hana()
+
+    for filename, contents in files.items():
+        b.files.add(filename, File(contents=contents))
+
+    writer = FileWriter(deploy_path=str(output), **kwargs)
+    b.plugin(writer)
+    b.build()
+
+    return writer
+
+def test_write(tmp_path):
+    output = tmp_path / 'out'
+
+    writer = write(output, {'a.txt': 'a', 'dir/sub/b.bin': b'b\0'})
+
+    assert writer.written == 2
+    assert (output / 'a.txt').read_text() == 'a'
+    assert (output / 'dir' / 'sub' / 'b.bin').read_bytes() == b'b\0'
+
+def test_skip_unchanged(tmp_path):
+    output = tmp_path / 'out'
+
+    write(output, {'a.txt': 'a', 'b.txt': 'b'}, skip_unchanged=True)
+    mtime = os.stat(str(output / 'a.txt')).st_mtime_ns
+
+    writer = write(output, {'a.txt': 'a', 'b.txt': 'bb'}, skip_unchanged=True)
+
+    assert writer.written == 1
+    assert writer.skipped == 1
+    assert os.stat(str(output / 'a.txt')).st_mtime_ns == mtime
+    assert (output / 'b.txt').read_text() == 'bb'
+
+def test_skip_unchanged_manifest(tmp_path):
+    output = tmp_path / 'out'
+    manifest = str(tmp_path / 'manifest.json')
+
+    def write_manifest(files):
+        b = hana.Hana(manifest=manifest)
+        for filename, contents in files.items():
+            b.files.add(filename, File(contents=contents))
+        writer = FileWriter(deploy_path=str(output), skip_unchanged=True)
+        b.plugin(writer)
+        b.build()
+        return writer
+
+    write_manifest({'a.txt': 'a'})
+    writer = write_manifest({'a.txt': 'a'})
+
+    assert writer.skipped == 1
+
+    # Output modified outside of Hana is rewritten
+    (output / 'a.txt').write_text('x')
+    writer = write_manifest({'a.txt': 'a'})
+
+    assert writer.written == 1
+    assert (output / 'a.txt').read_text() == 'a'
+
+def test_workers(tmp_path):
+    serial = tmp_path / 'serial'
+    threaded = tmp_path / 'threaded'
+
+    files = dict(('dir{}/sub{}/file{}.txt'.format(i % 3, i % 5, i), 'file {}'.format(i)) for i in range(50))
+
+    write(serial, files)
+    writer = write(threaded, files, workers=4)
+
+    assert writer.written == len(files)
+
+    for filename, contents in files.items():
+        assert (threaded / filename).read_text() == (serial / filename).read_text() == contents
+
+def test_workers_error(tmp_path):
+    output = tmp_path / 'out'
+    output.mkdir()
+
+    # A directory in place of a file makes the write fail
+    (output / 'b.txt').mkdir()
+    (output / 'c.txt').mkdir()
+
+    with pytest.raises(IsADirectoryError) as excinfo:
+        write(output, {'a.txt': 'a', 'b.txt': 'b', 'c.txt': 'c', 'd.txt': 'd'}, workers=4)
+
+    assert excinfo.value.filename.endswith('b.txt')
+    assert (output / 'd.txt').read_text() == 'd'
+
+@pytest.mark.parametrize('passthrough', ['copy', 'hardlink', 'reflink'])
+def test_passthrough(tmp_path, passthrough):
+    from hana.plugins.file_loader import FileLoader
+
+    source = tmp_path / 'src'
+    output = tmp_path / 'out'
+    source.mkdir()
+    (source / 'image.bin').write_bytes(b'\0' * 100000)
+    (source / 'page.txt').write_text('page')
+
+    def modify(files, hana):
+        files.file_set['page.txt']['contents'] += ' modified'
+
+    b = hana.Hana()
+    b.plugin(FileLoader(source_path=str(source)))
+    b.plugin(modify)
+    writer = FileWriter(deploy_path=str(output), passthrough=passthrough)
+    b.plugin(writer)
+    b.build()
+
+    assert writer.written == 2
+    assert not b.files['image.bin'].loaded
+    assert (output / 'image.bin').read_bytes() == b'\0' * 100000
+    assert (output / 'page.txt').read_text() == 'page modified'
+
+    if passthrough == 'hardlink':
+        assert os.path.samefile(str(source / 'image.bin'), str(output / 'image.bin'))
+
+    # Writing over a hardlinked output doesn't touch the source
+    b.files['image.bin']['contents'] = b'new'
+    FileWriter(deploy_path=str(output))(b.files.filter(), b)
+
+    assert (source / 'image.bin').read_bytes() == b'\0' * 100000
+    assert (output / 'image.bin').read_bytes() == b'new'
+
+def test_streamed(tmp_path):
+    from hana.plugins.file_loader import FileLoader
+
+    source = tmp_path / 'src'
+    output = tmp_path / 'out'
+    source.mkdir()
+    (source / 'big.txt').write_text('abc' * 1000)
+
+    def upper(files, hana):
+        def transform(chunks):
+            for chunk in chunks:
+                yield chunk.upper()
+
+        for _, f in files:
+            f.pipe(transform)
+
+    b = hana.Hana()
+    b.plugin(FileLoader(source_path=str(source)))
+    b.plugin(upper)
+    b.plugin(FileWriter(deploy_path=str(output), skip_unchanged=True))
+    b.build()
+
+    assert not b.files['big.txt'].loaded
+    assert (output / 'big.txt').read_text() == 'ABC' * 1000
+    assert os.listdir(str(output)) == ['big.txt']
+
+def test_streamed_error(tmp_path):
+    from hana.plugins.file_loader import FileLoader
+
+    source = tmp_path / 'src'
+    output = tmp_path / 'out'
+    source.mkdir()
+    (source / 'big.txt').write_text('abc' * 1000)
+
+    def fail(chunks):
+        for chunk in chunks:
+            yield chunk
+        raise ValueError('transform failed')
+
+    b = hana.Hana()
+    FileLoader(source_path=str(source))(b.files, b)
+    b.files['big.txt'].pipe(fail)
+
+    with pytest.raises(ValueError):
+        FileWriter(deploy_path=str(output))(b.files.filter(), b)
+
+    # No partial temporary file is left behind
+    assert os.listdir(str(output)) == []
+
+@pytest.mark.parametrize('prune', ['disk', 'manifest', True])
+def test_prune(tmp_path, prune):
+    output = tmp_path / 'out'
+    manifest = str(tmp_path / 'manifest.json')
+
+    def write_pruned(files):
+        b = hana.Hana(manifest=manifest if prune != 'disk' else None)
+        for filename, contents in files.items():
+            b.files.add(filename, File(contents=contents))
+        writer = FileWriter(deploy_path=str(output), skip_unchanged=True, prune=prune)
+        b.plugin(writer)
+        b.build()
+        return writer
+
+    write_pruned({'a.txt': 'a', 'old/deep/b.txt': 'b', 'keep/c.txt': 'c', 'keep/d.txt': 'd'})
+    mtime = os.stat(str(output / 'a.txt')).st_mtime_ns
+
+    writer = write_pruned({'a.txt': 'a', 'keep/c.txt': 'c'})
+
+    assert writer.pruned == 2
+    assert sorted(os.listdir(str(output))) == ['a.txt', 'keep']
+    assert os.listdir(str(output / 'keep')) == ['c.txt']
+    # Current outputs are left alone
+    assert os.stat(str(output / 'a.txt')).st_mtime_ns == mtime
+
+def test_prune_disk_and_manifest(tmp_path):
+    output = tmp_path / 'out'
+    manifest = str(tmp_path / 'manifest.json')
+    output.mkdir()
+    (output / 'stray.txt').write_text('x')
+    (output / 'empty').mkdir()
+
+    b = hana.Hana(manifest=manifest)
+    b.files.add('a.txt', File(contents='a'))
+    b.plugin(FileWriter(deploy_path=str(output), prune='manifest'))
+    b.build()
+
+    # Files that weren't produced by an earlier build are kept
+    assert sorted(os.listdir(str(output))) == ['a.txt', 'empty', 'stray.txt']
+
+    b = hana.Hana(manifest=manifest)
+    b.files.add('a.txt', File(contents='a'))
+    b.plugin(FileWriter(deploy_path=str(output), prune='disk'))
+    b.build()
+
+    assert os.listdir(str(output)) == ['a.txt']
+
+    with pytest.raises(hana.plugins.file_writer.FileWriterError):
+        write(output, {'a.txt': 'a'}, prune='manifest')
+
+def test_prune_conflicts(tmp_path):
+    output = tmp_path / 'out'
+
+    write(output, {'a': 'file', 'b/c.txt': 'c'}, prune='disk')
+    writer = write(output, {'a/x.txt': 'x', 'b': 'file'}, prune='disk')
+
+    assert (output / 'a' / 'x.txt').read_text() == 'x'
+    assert (output / 'b').read_text() == 'file'
+    assert writer.pruned == 2
+
+def test_prune_rebuild(tmp_path):
+    from hana.plugins.file_loader import FileLoader
+
+    source = tmp_path / 'src'
+    output = tmp_path / 'out'
+    source.mkdir()
+    (source / 'a.txt').write_text('a')
+    (source / 'b.txt').write_text('b')
+
+    b = hana.Hana()
+    b.plugin(FileLoader(source_path=str(source)))
+    writer = FileWriter(deploy_path=str(output), prune=True)
+    b.plugin(writer)
+    b.build()
+
+    (source / 'b.txt').unlink()
+    (source / 'a.txt').write_text('aa')
+    b.rebuild([str(source / 'a.txt'), str(source / 'b.txt')])
+
+    # Only the removed file's output is pruned
+    assert os.listdir(str(output)) == ['a.txt']
+    assert (output / 'a.txt').read_text() == 'aa'
+    assert writer.pruned == 1
+
+@pytest.mark.parametrize('workers', [None, 4])
+def test_link_duplicates(tmp_path, workers):
+    output = tmp_path / 'out'
+
+    files = dict(('dir{}/copy{}.bin'.format(i % 3, i), b'same' * 100) for i in range(10))
+    files['other.bin'] = b'other'
+
+    writer = write(output, files, link_duplicates=True, workers=workers)
+
+    assert writer.written == 11
+    assert writer.deduplicated == {'files': 9, 'bytes': 9 * 400}
+
+    for filename, contents in files.items():
+        assert (output / filename).read_bytes() == contents
+
+    assert os.stat(str(output / 'dir0' / 'copy0.bin')).st_nlink == 10
+    assert os.stat(str(output / 'other.bin')).st_nlink == 1
+
+    # Already linked outputs are left alone, changed ones don't affect the others
+    files['dir1/copy1.bin'] = b'changed'
+    writer = write(output, files, link_duplicates=True, skip_unchanged=True)
+
+    assert writer.written == 1
+    assert (output / 'dir1' / 'copy1.bin').read_bytes() == b'changed'
+    assert (output / 'dir0' / 'copy0.bin').read_bytes() == b'same' * 100
+    assert writer.deduplicated == {'files': 8, 'bytes': 8 * 400}
+
+def test_prune_rebuild_deletion_only(tmp_path):
+    from hana.plugins.file_loader import FileLoader
+
+    source = tmp_path / 'src'
+    output = tmp_path / 'out'
+    manifest = str(tmp_path / 'manifest.json')
+    (source / 'dir').mkdir(parents=True)
+    (source / 'a.txt').write_text('a')
+    (source / 'dir' / 'b.txt').write_text('b')
+
+    b = hana.Hana(manifest=manifest)
+    b.plugin(FileLoader(source_path=str(source)))
+    writer = FileWriter(deploy_path=str(output), prune=True)
+    b.plugin(writer)
+    b.build()
+
+    (source / 'dir' / 'b.txt').unlink()
+    b.rebuild([str(source / 'dir' / 'b.txt')])
+
+    assert writer.written == 0
+    assert writer.pruned == 1
+    assert os.listdir(str(output)) == ['a.txt']
+    assert list(b.manifest.outputs) == ['a.txt']
+
+def test_link_duplicates_streamed(tmp_path):
+    from hana.core import io_counters
+    from hana.plugins.file_loader import FileLoader
+
+    source = tmp_path / 'src'
+    output = tmp_path / 'out'
+    source.mkdir()
+
+    for name in ['a.txt', 'b.txt', 'c.txt']:
+        (source / name).write_text('abc' * 1000)
+
+    def upper(files, hana):
+        def transform(chunks):
+            for chunk in chunks:
+                yield chunk.upper()
+
+        for _, f in files:
+            f.pipe(transform)
+
+    b = hana.Hana()
+    b.plugin(FileLoader(source_path=str(source)))
+    b.plugin(upper)
+    writer = FileWriter(deploy_path=str(output), link_duplicates=True)
+    b.plugin(writer)
+
+    _, _, written = io_counters.snapshot()
+    b.build()
+
+    # Only the first one is streamed to disk
+    assert io_counters.snapshot()[2] - written == 3000
+    assert writer.deduplicated == {'files': 2, 'bytes': 6000}
+    assert sorted(os.listdir(str(output))) == ['a.txt', 'b.txt', 'c.txt']
+    assert os.stat(str(output / 'c.txt')).st_nlink == 3
+    assert (output / 'b.txt').read_text() == 'ABC' * 1000
@@ -0,0 +1,23 @@
+import subprocess
+import sys
+import hana
+
+
+def test_lazy_imports():
+    script = ('import sys, hana, hana.plugins.file_loader, hana.plugins.file_writer; '
+              'print(" ".join(m for m in ("yaml", "pathspec", "pkg_resources", "hashlib") if m in sys.modules))')
+
+    output = subprocess.check_output([sys.executable, '-c', script], universal_newlines=True)
+
+    assert output.split() == []
+
+def test_load_plugin_cached(monkeypatch):
+    b = hana.Hana()
+    plugin = b.load_plugin('hana.plugins.file_loader:FileLoader')
+
+    def fail(*args, **kwargs):
+        raise AssertionError('Plugin imported again')
+
+    monkeypatch.setattr('builtins.__import__', fail)
+
+    assert b.load_plugin('hana.plugins.file_loader:FileLoader') is plugin
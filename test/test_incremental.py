@@ -0,0 +1,172 @@
+import os
+import pytest
+import hana
+import hana.plugins.file_loader
+import hana.plugins.file_writer
+
+
+def build(source, output, manifest):
+    seen = {}
+
+    def plugin(files, hana):
+        for filename, _ in files.changed():
+            seen[filename] = True
+
+    b = hana.Hana(manifest=manifest)
+    b.plugin(hana.plugins.file_loader.FileLoader(source_path=source))
+    b.plugin(plugin)
+    b.plugin(hana.plugins.file_writer.FileWriter(deploy_path=output))
+    b.build()
+
+    return seen
+
+def test_incremental(tmp_path):
+    source = tmp_path / 'src'
+    output = tmp_path / 'out'
+    manifest = str(tmp_path / 'manifest.json')
+
+    source.mkdir()
+    (source / 'a.txt').write_text('a')
+    (source / 'b.txt').write_text('b')
+
+    assert set(build(str(source), str(output), manifest)) == {'a.txt', 'b.txt'}
+    assert os.path.isfile(manifest)
+
+    # Nothing changed
+    assert build(str(source), str(output), manifest) == {}
+
+    (source / 'b.txt').write_text('bb')
+
+    assert set(build(str(source), str(output), manifest)) == {'b.txt'}
+    assert (output / 'b.txt').read_text() == 'bb'
+    assert (output / 'a.txt').read_text() == 'a'
+
+def test_incremental_touch(tmp_path):
+    source = tmp_path / 'src'
+    output = tmp_path / 'out'
+    manifest = str(tmp_path / 'manifest.json')
+
+    source.mkdir()
+    (source / 'a.txt').write_text('a')
+
+    build(str(source), str(output), manifest)
+
+    stat = os.stat(str(source / 'a.txt'))
+    os.utime(str(source / 'a.txt'), ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+    assert build(str(source), str(output), manifest) == {}
+
+def test_incremental_missing_output(tmp_path):
+    source = tmp_path / 'src'
+    output = tmp_path / 'out'
+    manifest = str(tmp_path / 'manifest.json')
+
+    source.mkdir()
+    (source / 'a.txt').write_text('a')
+
+    build(str(source), str(output), manifest)
+    os.remove(str(output / 'a.txt'))
+    build(str(source), str(output), manifest)
+
+    assert (output / 'a.txt').read_text() == 'a'
+
+def test_signature_options_and_metadata(tmp_path):
+    source = tmp_path / 'src'
+    manifest = str(tmp_path / 'manifest.json')
+
+    source.mkdir()
+    (source / 'a.txt').write_text('a')
+
+    def signature(output, metadata):
+        b = hana.Hana(manifest=manifest, metadata=dict(metadata))
+        b.plugin(hana.plugins.file_loader.FileLoader(source_path=str(source)))
+        b.plugin(hana.plugins.file_writer.FileWriter(deploy_path=str(output)))
+        b.build()
+        return b._step_signature()
+
+    first = signature(tmp_path / 'out', {'site': 'a'})
+
+    assert signature(tmp_path / 'out', {'site': 'a'}) == first
+    assert signature(tmp_path / 'other', {'site': 'a'}) != first
+    assert signature(tmp_path / 'out', {'site': 'b'}) != first
+
+    # Outputs of the new deploy path are written
+    assert (tmp_path / 'other' / 'a.txt').read_text() == 'a'
+
+def test_skip_by_output_hash(tmp_path):
+    source = tmp_path / 'src'
+    output = tmp_path / 'out'
+    manifest = str(tmp_path / 'manifest.json')
+
+    source.mkdir()
+    (source / 'a.txt').write_text('a')
+    (source / 'b.txt').write_text('b')
+
+    def build_with(suffix):
+        def append(files, hana):
+            # Contents depend on more than the source
+            files.file_set['a.txt']['contents'] += suffix
+
+        b = hana.Hana(manifest=manifest)
+        b.plugin(hana.plugins.file_loader.FileLoader(source_path=str(source)))
+        b.plugin(append)
+        writer = hana.plugins.file_writer.FileWriter(deploy_path=str(output))
+        b.plugin(writer)
+        b.build()
+        return writer
+
+    build_with('!')
+    writer = build_with('?')
+
+    assert (output / 'a.txt').read_text() == 'a?'
+    assert writer.written == 1
+    assert writer.skipped == 1
+
+    writer = build_with('?')
+
+    assert writer.written == 0
+    assert writer.skipped == 2
+
+def test_changed_step_transforms(tmp_path):
+    source = tmp_path / 'src'
+    output = tmp_path / 'out'
+    manifest = str(tmp_path / 'manifest.json')
+
+    source.mkdir()
+    (source / 'a.md').write_text('a')
+    (source / 'b.md').write_text('b')
+    (source / 'c.txt').write_text('c')
+
+    def render(files, hana):
+        for filename, f in files.changed():
+            f['contents'] = f['contents'].upper()
+            if filename.endswith('.md'):
+                files.file_set.rename(filename, filename[:-3] + '.html')
+
+    def build_render():
+        b = hana.Hana(manifest=manifest)
+        b.plugin(hana.plugins.file_loader.FileLoader(source_path=str(source)))
+        b.plugin(render)
+        writer = hana.plugins.file_writer.FileWriter(deploy_path=str(output))
+        b.plugin(writer)
+        b.build()
+        return writer
+
+    build_render()
+    (source / 'b.md').write_text('bb')
+    writer = build_render()
+
+    # Outputs of files skipped by the step are kept, not overwritten with their sources
+    assert sorted(os.listdir(str(output))) == ['a.html', 'b.html', 'c.txt']
+    assert (output / 'a.html').read_text() == 'A'
+    assert (output / 'b.html').read_text() == 'BB'
+    assert (output / 'c.txt').read_text() == 'C'
+    assert writer.written == 1
+    assert writer.skipped == 2
+
+    # Kept outputs stay in the manifest
+    writer = build_render()
+
+    assert writer.written == 0
+    assert writer.skipped == 3
+    assert (output / 'a.html').read_text() == 'A'
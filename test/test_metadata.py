@@ -83,3 +83,86 @@ def test_md_eval_match():
     assert mdk.eval("a") == False
     assert mdk.eval(1) == True
 
+def test_md_eval_compare():
+
+    assert (MD.mykey < 5).eval(4) == True
+    assert (MD.mykey < 5).eval(5) == False
+    assert (MD.mykey <= 5).eval(5) == True
+    assert (MD.mykey > 5).eval(6) == True
+    assert (MD.mykey > 5).eval(5) == False
+    assert (MD.mykey >= 5).eval(5) == True
+    assert (MD.mykey >= 5).eval(4) == False
+
+
+def test_md_immutable():
+    key = MD.mykey
+    pred = key == 5
+
+    assert key.opname is None
+    assert pred.opname == 'eq'
+    assert (key > 1).value == 1
+    assert pred.value == 5
+
+    nested = MD['a']
+    assert nested['b'].name == ('a', 'b')
+    assert nested.name == ('a',)
+
+    assert MD.date.desc().order == 'desc'
+    assert MD.date.order == 'asc'
+
+def test_md_compile():
+    files = [
+        {'title': 'x', 'published': 1},
+        {'title': 'y', 'published': 2},
+        {'title': 'z', 'published': 3, 'nested': {'key': 'v'}},
+        {'published': 'later'},
+    ]
+
+    def matching(expression):
+        test = expression.compile()
+        return [f.get('title') for f in files if test(f)]
+
+    assert matching((MD.title == 'x') | (MD.title == 'y')) == ['x', 'y']
+    assert matching(((MD.title == 'x') | (MD.title == 'z')) & (MD.published > 1)) == ['z']
+    assert matching(~(MD.title == 'x')) == ['y', 'z', None]
+    assert matching(MD.nested) == ['z']
+    assert matching(~MD.title) == [None]
+    assert matching(MD['nested']['key'] == 'v') == ['z']
+    assert matching(MD.published >= 2) == ['y', 'z']
+    assert matching(~~(MD.title == 'y')) == ['y']
+
+def test_md_compile_shared_lookup():
+    lookups = []
+
+    class Tracking(dict):
+        def __getitem__(self, key):
+            lookups.append(key)
+            return super(Tracking, self).__getitem__(key)
+
+    test = ((MD.a > 1) & (MD.a < 5) & (MD.b == 1)).compile()
+
+    assert test(Tracking(a=3, b=1))
+    assert sorted(lookups) == ['a', 'b']
+
+def test_md_compile_selective_first():
+    evaluated = []
+
+    def tracking(name):
+        return MD(name).match('.*') if name == 'slow' else MD(name) == 1
+
+    class Tracking(dict):
+        def __getitem__(self, key):
+            evaluated.append(key)
+            return super(Tracking, self).__getitem__(key)
+
+    test = (tracking('slow') & tracking('fast')).compile()
+
+    assert not test(Tracking(slow='x', fast=2))
+    assert evaluated == ['fast']
+
+def test_md_no_truth_value():
+    with pytest.raises(TypeError):
+        1 < MD.mykey < 5
+
+    with pytest.raises(TypeError):
+        (MD.a == 1) and (MD.b == 2)
@@ -0,0 +1,62 @@
+import pytest
+import hana
+from hana.core import File, FSFile
+from hana.parallel import PerFilePlugin
+from hana.store import ContentStore
+
+
+def upper(filename, hfile):
+    hfile['contents'] = hfile['contents'].upper()
+    hfile['processed'] = filename
+
+def replace(filename, hfile):
+    return File(contents='replaced')
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_per_file(workers):
+    b = hana.Hana()
+
+    for i in range(40):
+        b.files.add('file{}.txt'.format(i), File(contents='file {}'.format(i), keep=i))
+    b.files.add('skip.md', File(contents='skip'))
+
+    b.file_plugin(upper, '*.txt', workers=workers, chunksize=3)
+    b.build()
+
+    assert b.files['file3.txt']['contents'] == 'FILE 3'
+    assert b.files['file3.txt']['processed'] == 'file3.txt'
+    assert b.files['file3.txt']['keep'] == 3
+    assert b.files['skip.md']['contents'] == 'skip'
+
+def test_per_file_replace():
+    b = hana.Hana()
+    b.files.add('a', File(contents='a', title='a'))
+
+    b.plugin(PerFilePlugin(replace))
+    b.build()
+
+    assert dict(b.files['a']) == {'contents': 'replaced'}
+
+def title(filename, hfile):
+    hfile['title'] = filename
+
+def test_per_file_evicted(tmp_path):
+    b = hana.Hana()
+    store = ContentStore(2500)
+
+    for idx in range(4):
+        path = tmp_path / 'file{}.txt'.format(idx)
+        path.write_text(str(idx) * 1000)
+
+        f = FSFile(str(path))
+        f.content_store = store
+        b.files.add(path.name, f)
+
+    b.file_plugin(title, workers=1)
+    b.build()
+
+    # Contents evicted while the files were sent aren't set again
+    assert store.evictions
+    for filename, f in b.files:
+        assert f['title'] == filename
+        assert not f.modified
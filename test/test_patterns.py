@@ -0,0 +1,43 @@
+import pytest
+import pathspec
+from hana.patterns import compile_patterns
+
+FILENAMES = [
+    'index.html',
+    'page.htm',
+    'blog/index.html',
+    'blog/post.md',
+    'blog/2017/post.md',
+    'blogger/post.md',
+    'images/a.jpg',
+    'images/blog/b.jpg',
+    'archive.html/index.txt',
+    'a/b/c.tar.gz',
+    '.html',
+]
+
+@pytest.mark.parametrize('patterns', [
+    ['*'],
+    ['**'],
+    ['*.html'],
+    ['*.md', '*.jpg'],
+    ['blog/**'],
+    ['/blog/**'],
+    ['blog/*.md'],
+    ['**/*.md'],
+    ['blog/**', '*.jpg'],
+    ['*.gz', 'index.*'],
+    ['images/**', '!*.jpg'],
+    ['*', '!blog/**'],
+    ['[ab]/**'],
+    ['b*g/**'],
+])
+def test_compile_patterns(patterns):
+    spec = pathspec.PathSpec.from_lines('gitwildmatch', patterns)
+    match = compile_patterns(patterns)
+
+    for filename in FILENAMES:
+        assert match(filename) == spec.match_file(filename), filename
+
+def test_compile_patterns_cached():
+    assert compile_patterns(['*.md', 'blog/**']) is compile_patterns(('blog/**', '*.md'))
@@ -0,0 +1,81 @@
+import json
+import pytest
+import hana
+from hana.plugins.file_loader import FileLoader
+from hana.plugins.file_writer import FileWriter
+from hana.profiling import BuildProfiler
+
+
+@pytest.fixture
+def source(tmp_path):
+    source = tmp_path / 'src'
+    source.mkdir()
+
+    for name in ['a.md', 'b.md', 'c.txt']:
+        (source / name).write_text(name * 10)
+
+    return source
+
+def upper(files, hana):
+    for filename, f in files:
+        f['contents'] = f['contents'].upper()
+
+def test_step_profiles(source, tmp_path):
+    reports = []
+
+    b = hana.Hana(profile={'top_files': 2, 'hooks': [reports.append]})
+    b.plugin(FileLoader(source_path=str(source)))
+    b.plugin(upper, '*.md')
+    b.plugin(FileWriter(deploy_path=str(tmp_path / 'out')))
+    b.build()
+
+    assert reports == [b.profiler.report]
+
+    loader, step, writer = reports[0]['steps']
+
+    assert loader['name'] == 'hana.plugins.file_loader.FileLoader'
+    assert loader['files_out'] == 3
+
+    assert step['name'] == 'test_profiling.upper'
+    assert step['patterns'] == ['*.md']
+    assert step['files_in'] == 2
+    assert step['files_out'] == 2
+    assert step['loads'] == 2
+    assert step['bytes_read'] == 2 * 40
+
+    assert writer['files_in'] == 3
+    assert writer['files_out'] == 0
+    assert writer['bytes_written'] == 2 * 40 + 50
+    assert writer['wall'] >= 0 and writer['cpu'] >= 0
+
+    assert len(reports[0]['files']) == 2
+    assert reports[0]['files'][0]['time'] >= reports[0]['files'][1]['time']
+
+def test_export(source, tmp_path):
+    json_path = str(tmp_path / 'profile.json')
+    trace_path = str(tmp_path / 'trace.json')
+
+    b = hana.Hana()
+    b.profiler = BuildProfiler(top_files=1, json_path=json_path, trace_path=trace_path)
+    b.plugin(FileLoader(source_path=str(source)))
+    b.plugin(upper, '*.md')
+    b.build()
+
+    with open(json_path) as fin:
+        assert [profile['name'] for profile in json.load(fin)['steps']] == [
+            'hana.plugins.file_loader.FileLoader', 'test_profiling.upper']
+
+    with open(trace_path) as fin:
+        events = json.load(fin)['traceEvents']
+
+    assert [event['cat'] for event in events] == ['step', 'step', 'file']
+    assert all(event['ph'] == 'X' and event['dur'] >= 0 for event in events)
+    assert events[1]['args']['files_in'] == 2
+    assert events[2]['name'] in ('a.md', 'b.md')
+
+def test_disabled(source):
+    b = hana.Hana()
+    b.plugin(FileLoader(source_path=str(source)))
+    b.build()
+
+    assert b.profiler is None
@@ -0,0 +1,125 @@
+import sys
+import threading
+import pytest
+import hana
+from hana.core import File
+from hana.scheduler import patterns_overlap
+
+
+@pytest.mark.parametrize('a, b, overlap', [
+    (None, ['*.md'], True),
+    (['*.md'], ['*.md'], True),
+    (['*.md'], ['*.jpg'], False),
+    (['*.md'], ['*.png', '*.jpg'], False),
+    (['*.gz'], ['*.tar.gz'], True),
+    (['blog/**'], ['images/**'], False),
+    (['blog/**'], ['blog/drafts/*.md'], True),
+    (['blog/*.md'], ['*.md'], True),
+    (['blog/*.md'], ['*.jpg'], False),
+    (['blog/**'], ['*.jpg'], True),
+    (['*.md'], ['!*.jpg'], True),
+    (['notes.md/'], ['*.html'], True),
+    (['*.md/'], ['*.html'], True),
+    ([], ['*'], False),
+])
+def test_patterns_overlap(a, b, overlap):
+    assert patterns_overlap(a, b) == overlap
+    assert patterns_overlap(b, a) == overlap
+
+def test_concurrent_steps():
+    barrier = threading.Barrier(2, timeout=5)
+    order = []
+
+    def images(files, hana):
+        barrier.wait()
+        order.append('images')
+
+    def markdown(files, hana):
+        barrier.wait()
+        order.append('markdown')
+
+    def collect(files, hana):
+        order.append('collect')
+
+    b = hana.Hana()
+    b.files.add('a.md', File(contents='a'))
+    b.files.add('a.jpg', File(contents=b'a'))
+
+    # Both steps wait for each other, so this only passes if they overlap
+    b.plugin(images, '*.jpg', writes='*.jpg')
+    b.plugin(markdown, '*.md', writes='*.md')
+    b.plugin(collect)
+    b.build(workers=2)
+
+    assert sorted(order[:2]) == ['images', 'markdown']
+    assert order[2] == 'collect'
+
+def test_conflicting_steps_ordered():
+    order = []
+
+    def step(name):
+        def plugin(files, hana):
+            order.append(name)
+        return plugin
+
+    b = hana.Hana()
+
+    for idx in range(5):
+        b.plugin(step(idx), '*.md', writes='*.md')
+
+    b.build(workers=4)
+
+    assert order == list(range(5))
+
+def test_step_error():
+    def fail(files, hana):
+        raise ValueError('fail')
+
+    def ok(files, hana):
+        pass
+
+    b = hana.Hana()
+    b.plugin(ok, '*.jpg', writes='*.jpg')
+    b.plugin(fail, '*.md', writes='*.md')
+
+    with pytest.raises(ValueError):
+        b.build(workers=2)
+
+def test_concurrent_steps_add_files():
+    count = 2000
+
+    # Switch threads often, so unguarded changes interleave
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+
+    def adder(prefix):
+        def plugin(files, hana):
+            for idx in range(count):
+                hana.files.add('{}/{}.md'.format(prefix, idx), File(contents='', w=idx))
+        return plugin
+
+    b = hana.Hana(metadata={})
+    index = b.files.add_index('w', kind='sorted')
+
+    b.plugin(adder('a'), 'a/**', writes='a/**')
+    b.plugin(adder('b'), 'b/**', writes='b/**')
+
+    try:
+        b.build(workers=2)
+    finally:
+        sys.setswitchinterval(interval)
+
+    assert len(b.files) == 2 * count
+
+    # Index entries are sorted and belong to their files
+    assert index._values == sorted(index._values)
+    assert [b.files[filename]['w'] for filename in index._filenames] == index._values
+
+    expected = [filename for filename, f in b.files if f['w'] >= 1500]
+    assert len(expected) == 1000
+    assert [filename for filename, _ in b.files.filter().metadata(hana.MD.w >= 1500)] == expected
+
+    # Every change got its own version
+    versions = [entry[0] for entry in b.files._journal]
+    assert versions == sorted(set(versions))
+    assert b.files.version == versions[-1]
@@ -0,0 +1,81 @@
+import pytest
+from hana.core import FSFile
+from hana.store import ContentStore
+
+
+def make_files(tmp_path, store, count=4, size=1000):
+    files = []
+
+    for idx in range(count):
+        path = tmp_path / 'file{}.txt'.format(idx)
+        path.write_text(str(idx) * size)
+
+        f = FSFile(str(path))
+        f.content_store = store
+        files.append(f)
+
+    return files
+
+def test_evict_unmodified(tmp_path):
+    store = ContentStore(2500)
+    files = make_files(tmp_path, store)
+
+    for f in files:
+        f['contents']
+
+    assert store.size <= 2500
+    assert store.evictions == 2
+    assert not files[0].loaded
+    assert files[3].loaded
+
+    # Evicted contents are loaded again from disk
+    assert files[0]['contents'] == '0' * 1000
+    assert store.loads == 5
+
+def test_lru(tmp_path):
+    store = ContentStore(2500)
+    files = make_files(tmp_path, store, count=3)
+
+    files[0]['contents']
+    files[1]['contents']
+    files[0]['contents']
+    files[2]['contents']
+
+    assert files[0].loaded
+    assert not files[1].loaded
+    assert store.hits == 4
+
+def test_spill(tmp_path):
+    store = ContentStore(2500, spill_dir=str(tmp_path))
+    files = make_files(tmp_path, store)
+
+    files[0]['contents'] = 'modified'
+    files[1]['contents'] = b'\0' * 1000
+
+    for f in files[2:]:
+        f['contents']
+
+    files[0]['contents'] = 'x' * 1000
+
+    assert store.spills >= 1
+    assert not files[1].loaded
+    assert files[1]['contents'] == b'\0' * 1000
+    assert store.unspills == 1
+    assert files[0]['contents'] == 'x' * 1000
+
+def test_hana_memory_budget(tmp_path):
+    import hana
+    from hana.plugins.file_loader import FileLoader
+
+    source = tmp_path / 'src'
+    source.mkdir()
+    make_files(source, None)
+
+    b = hana.Hana(memory_budget=2500)
+    b.plugin(FileLoader(source_path=str(source)))
+    b.build()
+
+    contents = [f['contents'] for _, f in b.files]
+
+    assert len(contents) == 4
+    assert b.content_store.size <= 2500
@@ -0,0 +1,141 @@
+import os
+import threading
+import time
+import pytest
+import hana
+from hana.plugins.file_loader import FileLoader
+from hana.plugins.file_writer import FileWriter
+from hana.watch import InotifyWatcher, PollingWatcher, create_watcher
+
+
+@pytest.fixture
+def site(tmp_path):
+    source = tmp_path / 'src'
+    output = tmp_path / 'out'
+
+    (source / 'blog').mkdir(parents=True)
+    (source / 'index.html').write_text('index')
+    (source / 'blog' / 'post.md').write_text('post')
+    (source / 'style.css').write_text('css')
+
+    return source, output
+
+def make_hana(source, output, seen, **writer_options):
+
+    def rename_md(files, hana):
+        for filename, f in files:
+            seen.append(filename)
+            hana.files.rename(filename, filename[:-3] + '.html')
+            f['contents'] = f['contents'].upper()
+
+    b = hana.Hana()
+    b.plugin(FileLoader(source_path=str(source)))
+    b.plugin(rename_md, '*.md')
+    b.plugin(FileWriter(deploy_path=str(output), **writer_options))
+
+    return b
+
+def test_rebuild(site):
+    source, output = site
+    seen = []
+
+    b = make_hana(source, output, seen)
+    b.build()
+
+    assert seen == [os.path.join('blog', 'post.md')]
+    assert (output / 'blog' / 'post.html').read_text() == 'POST'
+
+    del seen[:]
+    (source / 'blog' / 'post.md').write_text('edited')
+    (source / 'new.md').write_text('new')
+    b.rebuild([str(source / 'blog' / 'post.md'), str(source / 'new.md')])
+
+    assert sorted(seen) == [os.path.join('blog', 'post.md'), 'new.md']
+    assert (output / 'blog' / 'post.html').read_text() == 'EDITED'
+    assert (output / 'new.html').read_text() == 'NEW'
+    assert sorted(b.files.filenames()) == sorted([
+        'index.html', 'style.css', 'new.html', os.path.join('blog', 'post.html')])
+
+def test_rebuild_skips_unmatched_steps(site):
+    source, output = site
+    seen = []
+
+    b = make_hana(source, output, seen)
+    b.build()
+
+    del seen[:]
+    (source / 'style.css').write_text('changed')
+    b.rebuild([str(source / 'style.css')])
+
+    assert seen == []
+    assert (output / 'style.css').read_text() == 'changed'
+
+def test_rebuild_removed(site):
+    source, output = site
+    b = make_hana(source, output, [])
+    b.build()
+
+    os.remove(str(source / 'blog' / 'post.md'))
+    b.rebuild([str(source / 'blog')])
+
+    assert sorted(b.files.filenames()) == ['index.html', 'style.css']
+
+def test_rebuild_deleted_output(site):
+    source, output = site
+    b = make_hana(source, output, [], prune=True)
+    b.build()
+
+    # Only a deletion, nothing else changed
+    os.remove(str(source / 'blog' / 'post.md'))
+    b.rebuild([str(source / 'blog' / 'post.md')])
+
+    assert not (output / 'blog').exists()
+    assert sorted(os.listdir(str(output))) == ['index.html', 'style.css']
+
+@pytest.mark.parametrize('watcher_class', [PollingWatcher, InotifyWatcher])
+def test_watcher(tmp_path, watcher_class):
+    if watcher_class is InotifyWatcher:
+        watcher = create_watcher([str(tmp_path)])
+        watcher.close()
+        if not isinstance(watcher, InotifyWatcher):
+            pytest.skip('inotify not available')
+
+    (tmp_path / 'a.txt').write_text('a')
+
+    kwargs = {'interval': 0.01} if watcher_class is PollingWatcher else {}
+    watcher = watcher_class([str(tmp_path)], **kwargs)
+
+    try:
+        assert watcher.wait(0.05, 0.05) == set([])
+
+        (tmp_path / 'a.txt').write_text('changed')
+        (tmp_path / 'b.txt').write_text('b')
+
+        assert set([str(tmp_path / 'a.txt'), str(tmp_path / 'b.txt')]) <= watcher.wait(0.1, 1)
+    finally:
+        watcher.close()
+
+def test_watch(site):
+    source, output = site
+    stop = threading.Event()
+
+    b = make_hana(source, output, [])
+    thread = threading.Thread(target=b.watch, kwargs={'debounce': 0.05, 'interval': 0.05, 'stop': stop})
+    thread.start()
+
+    try:
+        deadline = time.time() + 10
+
+        # The watcher starts after the first build, keep saving until it's seen
+        while time.time() < deadline:
+            (source / 'blog' / 'post.md').write_text('watched')
+            time.sleep(0.2)
+
+            post = output / 'blog' / 'post.html'
+            if post.exists() and post.read_text() == 'WATCHED':
+                break
+
+        assert (output / 'blog' / 'post.html').read_text() == 'WATCHED'
+    finally:
+        stop.set()
+        thread.join()